@@ -0,0 +1,182 @@
+import base64
+import concurrent.futures
+import hashlib
+import hmac
+import multiprocessing
+import os
+import re
+import threading
+import time
+
+###############################################################################
+# SHARE ACCESS: PASSWORDS AND TOKENS
+#
+# A share may be protected by a password. The record keeps an scrypt hash
+# of it:
+#
+#   scrypt$<log2 n>$<r>$<p>$<salt>$<hash>        (salt, hash: base64url)
+#
+# scrypt is memory-hard: with the default n=2**14, r=8 every hash needs
+# 16 MiB and tens of milliseconds of CPU. The KDF runs in a pool of
+# processes (PasswordHasher), so request threads only wait on a future and
+# never hold the GIL for it. At most `processes` hashes run at a time and
+# at most `queue` more wait; callers beyond that get PasswordHasherBusy
+# straight away (the app answers 503), so a flood of guesses cannot pile up
+# unbounded work. Guessing is also rate limited per client and per share in
+# app.py.
+#
+# A correct password earns an access token, and every claim of a share a
+# download token. Both are HMACs under the server's secret, so checking one
+# is a single HMAC in whichever worker gets the request, with no KDF and no
+# shared state:
+#
+#   access token     <expires>.<mac of "access:<file_id>:<expires>">
+#   download token   <n>.<mac of "download:<file_id>:<n>">
+#
+# where n is the number of the claim (1 for the first download of the
+# share), see serving.py.
+###############################################################################
+
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+HASH_SIZE = 32
+# <number>.<base64url mac>; anything else in a cookie is not a token.
+_TOKEN = re.compile(r'([0-9]+)\.([A-Za-z0-9_-]+)')
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _scrypt(password, salt, n, r, p):
+    # Runs in a pool process; must stay a module-level function.
+    return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=256 * r * n,
+                          dklen=HASH_SIZE)
+
+
+def encode_hash(salt, digest, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    return 'scrypt$%d$%d$%d$%s$%s' % (n.bit_length() - 1, r, p, _b64encode(salt),
+                                      _b64encode(digest))
+
+
+def decode_hash(encoded):
+    # (salt, digest, n, r, p), or raise ValueError.
+    scheme, log_n, r, p, salt, digest = encoded.split('$')
+    if scheme != 'scrypt':
+        raise ValueError("Unknown password hash scheme %r" % (scheme,))
+    return _b64decode(salt), _b64decode(digest), 1 << int(log_n), int(r), int(p)
+
+
+class PasswordHasher:
+    # processes=0 runs the KDF in the calling thread (tests, benchmarks).
+
+    def __init__(self, processes=4, queue=64, timeout=10.0, n=SCRYPT_N, r=SCRYPT_R,
+                 p=SCRYPT_P):
+        self.processes = processes
+        self.timeout = timeout
+        self.params = (n, r, p)
+        self._slots = threading.BoundedSemaphore(max(1, processes) + queue)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def _executor(self):
+        # Started on first use in each worker, never inherited across fork.
+        # The forkserver context forks the pool processes from a clean,
+        # single-threaded parent.
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    self.processes, mp_context=multiprocessing.get_context('forkserver'))
+                self._pid = os.getpid()
+            return self._pool
+
+    def _run(self, password, salt, n, r, p):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        if not self.processes:
+            try:
+                return _scrypt(password, salt, n, r, p)
+            finally:
+                self._slots.release()
+        try:
+            future = self._executor().submit(_scrypt, password, salt, n, r, p)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is freed when the KDF is done, not when the caller gives
+        # up waiting: a running task cannot be cancelled, and it still uses
+        # a pool process.
+        future.add_done_callback(lambda future: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise PasswordHasherBusy()
+
+    def hash(self, password):
+        salt = os.urandom(SALT_SIZE)
+        n, r, p = self.params
+        return encode_hash(salt, self._run(password.encode('utf-8'), salt, n, r, p), n, r, p)
+
+    def verify(self, password, encoded):
+        salt, digest, n, r, p = decode_hash(encoded)
+        return hmac.compare_digest(self._run(password.encode('utf-8'), salt, n, r, p), digest)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+            self._pid = None
+
+
+def _mac(secret, message):
+    return _b64encode(hmac.new(secret, message.encode('utf-8'), hashlib.sha256).digest())
+
+
+def _split_token(token):
+    # (number, mac), or (None, None) for a malformed token.
+    match = _TOKEN.fullmatch(token or '')
+    if match is None:
+        return None, None
+    return int(match.group(1)), match.group(2)
+
+
+def _same_mac(mac, expected):
+    # Both are ASCII: `mac` passed _TOKEN and `expected` is base64url.
+    return hmac.compare_digest(mac.encode('ascii'), expected.encode('ascii'))
+
+
+def access_token(secret, file_id, lifetime, now=None):
+    expires = int((time.time() if now is None else now) + lifetime)
+    return '%d.%s' % (expires, _mac(secret, 'access:%s:%d' % (file_id, expires)))
+
+
+def check_access_token(secret, file_id, token, now=None):
+    expires, mac = _split_token(token)
+    if expires is None or expires <= (time.time() if now is None else now):
+        return False
+    return _same_mac(mac, _mac(secret, 'access:%s:%d' % (file_id, expires)))
+
+
+def download_token(secret, file_id, claim):
+    return '%d.%s' % (claim, _mac(secret, 'download:%s:%d' % (file_id, claim)))
+
+
+def download_claim(secret, file_id, token):
+    # The claim number a download token was issued for, or None.
+    claim, mac = _split_token(token)
+    if not claim or not _same_mac(mac, _mac(secret, 'download:%s:%d' % (file_id, claim))):
+        return None
+    return claim
@@ -0,0 +1,339 @@
+import collections
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from metadata import SQLiteDatabase
+
+###############################################################################
+# UPLOAD ADMISSION CONTROL
+#
+# MAX_CONTENT_LENGTH bounds one request, not all of them: fifty 256 MB
+# uploads at once can fill the disk, or the temporary folder request bodies
+# are spooled to, before any of them finishes. So an upload is admitted
+# (or not) before its body is read, from its Content-Length:
+#
+#   projected = bytes used on the filesystem
+#             + bytes reserved by admitted uploads still in flight
+#             + this upload
+#
+#   projected <= soft watermark     admitted at once, unless others queue
+#   projected >  hard watermark     rejected: 503 with Retry-After
+#   otherwise                       queued
+#
+# Queued uploads are admitted one at a time, round-robin by client, so one
+# client sending many uploads cannot starve the others. Once the disk is
+# back under the soft watermark, any upload in the queue can go. Between
+# the watermarks an upload can go only while fewer than
+# `overload_concurrency` uploads are in flight on the host. That slows
+# uploads down so the reaper and downloads can free space. An upload that
+# reaches the head of the queue over the hard watermark, waits longer than
+# `queue_timeout`, or finds `queue_size` others waiting is rejected.
+#
+# Watermarks are a fraction of the filesystem's size (0.85) or, if greater
+# than 1, a number of bytes used. Both the uploads folder and the temporary
+# folder are checked. Bodies that are spooled before the view runs
+# (multipart forms, the ASGI entry point) count against the temporary
+# folder as well. Two folders on the same filesystem count as one.
+#
+# Reservations are kept in a ledger:
+#
+#   MemoryLedger    per process; fine for a single worker.
+#   SQLiteLedger    shared by every worker on the host. Each reservation
+#                   has an expiry, so one left behind by a killed worker
+#                   stops counting.
+#
+# The queue itself is per process; fairness holds among the requests one
+# worker is holding. Queued requests hold a worker thread, so run gunicorn
+# with gthread workers (or the ASGI entry point) for queueing to help.
+###############################################################################
+
+# Where a server that admits uploads itself (asgi.py) leaves the Admission
+# for the view.
+ADMISSION_ENVIRON_KEY = 'secure_share.admission'
+
+
+class Rejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class Ledger:
+    def reserve(self, key, size, spooled, expires_at, admit):
+        # Add the reservation if admit(count, bytes, spooled bytes), called
+        # with the totals of those already held, says so; atomically.
+        # Returns whether it was added.
+        raise NotImplementedError
+
+    def release(self, key):
+        raise NotImplementedError
+
+    def totals(self, now=None):
+        # (count, bytes, spooled bytes) of current reservations.
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryLedger(Ledger):
+    def __init__(self):
+        self._reservations = {}
+        self._lock = threading.Lock()
+
+    def _totals(self, now):
+        live = [r for r in self._reservations.values() if r[2] > now]
+        return len(live), sum(r[0] for r in live), sum(r[1] for r in live)
+
+    def reserve(self, key, size, spooled, expires_at, admit):
+        with self._lock:
+            if not admit(*self._totals(time.time())):
+                return False
+            self._reservations[key] = (size, spooled, expires_at)
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._reservations.pop(key, None)
+
+    def totals(self, now=None):
+        with self._lock:
+            return self._totals(time.time() if now is None else now)
+
+
+class SQLiteLedger(SQLiteDatabase, Ledger):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS reservations (
+            key        TEXT PRIMARY KEY,
+            size       INTEGER NOT NULL,
+            spooled    INTEGER NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path, timeout=30.0):
+        super().__init__(path, timeout)
+        conn = self._connect()
+        try:
+            conn.executescript(self.SCHEMA)
+        finally:
+            conn.close()
+
+    def _totals(self, conn, now):
+        return conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(spooled), 0) "
+            "FROM reservations WHERE expires_at > ?", (now,)).fetchone()
+
+    def reserve(self, key, size, spooled, expires_at, admit):
+        now = time.time()
+
+        def reserve(conn):
+            # Expired reservations were left by workers that died.
+            conn.execute("DELETE FROM reservations WHERE expires_at <= ?", (now,))
+            if not admit(*self._totals(conn, now)):
+                return False
+            conn.execute("INSERT OR REPLACE INTO reservations VALUES (?, ?, ?, ?)",
+                         (key, size, spooled, expires_at))
+            return True
+        return self._transaction(reserve)
+
+    def release(self, key):
+        self._conn().execute("DELETE FROM reservations WHERE key = ?", (key,))
+
+    def totals(self, now=None):
+        return tuple(self._totals(self._conn(), time.time() if now is None else now))
+
+
+def create_ledger(backend, path=None):
+    if backend == 'memory':
+        return MemoryLedger()
+    if backend == 'sqlite':
+        return SQLiteLedger(path)
+    raise ValueError("Unknown admission backend: %r" % (backend,))
+
+
+def watermark_bytes(watermark, total):
+    return int(watermark * total) if watermark <= 1 else int(watermark)
+
+
+class Admission:
+    # An admitted upload; release() (idempotent) once its bytes are stored.
+
+    def __init__(self, controller, key, queued):
+        self.controller = controller
+        self.key = key
+        self.queued = queued
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.ledger.release(self.key)
+            self.controller.notify()
+
+
+class Attempt:
+    # An upload asking to be admitted. poll() returns its Admission, None
+    # while it has to wait (poll again after poll_interval), or raises
+    # Rejected. cancel() gives up its place in the queue.
+
+    def __init__(self, controller, client, size, spooled):
+        self.controller = controller
+        self.client = client
+        self.size = size
+        self.spooled = spooled
+        self.key = None
+        self.deadline = None
+        self.queued = False
+
+    def poll(self):
+        return self.controller._poll(self)
+
+    def cancel(self):
+        self.controller._cancel(self)
+
+
+class AdmissionController:
+    def __init__(self, ledger, upload_folder, soft_watermark=0.85, hard_watermark=0.95,
+                 overload_concurrency=2, queue_size=256, queue_timeout=30.0, retry_after=30,
+                 reservation_ttl=3600, temp_folder=None, poll_interval=0.2, observe=None):
+        self.ledger = ledger
+        self.soft_watermark = soft_watermark
+        self.hard_watermark = hard_watermark
+        self.overload_concurrency = overload_concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.reservation_ttl = reservation_ttl
+        self.poll_interval = poll_interval
+        # Called with 'admitted', 'queued' or 'rejected' per decision.
+        self.observe = observe or (lambda result: None)
+        # st_dev -> (folder, holds stored bytes, holds spooled bodies).
+        self.filesystems = {}
+        for folder, stores, spools in ((upload_folder, True, False),
+                                       (temp_folder or tempfile.gettempdir(), False, True)):
+            device = os.stat(folder).st_dev
+            _, held_stores, held_spools = self.filesystems.get(device, (folder, False, False))
+            self.filesystems[device] = (folder, held_stores or stores, held_spools or spools)
+        self._cond = threading.Condition()
+        # client -> deque of waiting attempts; clients take turns in order.
+        self._queues = collections.OrderedDict()
+        self._waiting = 0
+        self._counter = 0
+
+    def _decide(self, attempt, count, reserved, reserved_spooled):
+        # 'admit', 'wait' or 'reject', given the ledger totals.
+        projections = []
+        for folder, stores, spools in self.filesystems.values():
+            usage = shutil.disk_usage(folder)
+            used = usage.total - usage.free
+            if stores:
+                used += reserved + attempt.size
+            if spools:
+                used += reserved_spooled + attempt.spooled
+            projections.append((used, watermark_bytes(self.soft_watermark, usage.total),
+                                watermark_bytes(self.hard_watermark, usage.total)))
+        if any(used > hard for used, _, hard in projections):
+            return 'reject'
+        if all(used <= soft for used, soft, _ in projections):
+            # Nobody jumps the queue.
+            return 'admit' if attempt.queued or not self._waiting else 'wait'
+        return 'admit' if attempt.queued and count < self.overload_concurrency else 'wait'
+
+    def _reserve(self, attempt):
+        decision = []
+
+        def admit(*totals):
+            decision.append(self._decide(attempt, *totals))
+            return decision[-1] == 'admit'
+        self.ledger.reserve(attempt.key, attempt.size, attempt.spooled,
+                            time.time() + self.reservation_ttl, admit)
+        return decision[-1]
+
+    def attempt(self, client, size, spooled=0):
+        # An upload of `size` bytes from `client`, `spooled` of which are
+        # also written to the temporary folder before the view runs.
+        return Attempt(self, client, size, spooled)
+
+    def _poll(self, attempt):
+        with self._cond:
+            if attempt.key is None:
+                self._counter += 1
+                attempt.key = '%d-%d' % (os.getpid(), self._counter)
+                decision = self._reserve(attempt)
+                if decision == 'reject':
+                    self.observe('rejected')
+                    raise Rejected("Server storage is full.", self.retry_after)
+                if decision == 'admit':
+                    self.observe('admitted')
+                    return Admission(self, attempt.key, False)
+                if self._waiting >= self.queue_size:
+                    self.observe('rejected')
+                    raise Rejected("Too many uploads waiting.", self.retry_after)
+                self.observe('queued')
+                self._queues.setdefault(attempt.client, collections.deque()).append(attempt)
+                self._waiting += 1
+                attempt.queued = True
+                attempt.deadline = time.monotonic() + self.queue_timeout
+            if self._queues[next(iter(self._queues))][0] is attempt:
+                decision = self._reserve(attempt)
+                if decision == 'admit':
+                    self._leave(attempt)
+                    self.observe('admitted')
+                    return Admission(self, attempt.key, True)
+                if decision == 'reject':
+                    self._leave(attempt)
+                    self.observe('rejected')
+                    raise Rejected("Server storage is full.", self.retry_after)
+            if time.monotonic() >= attempt.deadline:
+                self._leave(attempt)
+                self.observe('rejected')
+                raise Rejected("Server storage is busy.", self.retry_after)
+            return None
+
+    def _leave(self, attempt):
+        # Take the attempt out of the queue; its client goes to the back of
+        # the line.
+        queue = self._queues[attempt.client]
+        queue.remove(attempt)
+        self._waiting -= 1
+        attempt.queued = False
+        if queue:
+            self._queues.move_to_end(attempt.client)
+        else:
+            del self._queues[attempt.client]
+        self._cond.notify_all()
+
+    def _cancel(self, attempt):
+        with self._cond:
+            if attempt.queued:
+                self._leave(attempt)
+
+    def notify(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def admit(self, client, size, spooled=0):
+        # Blocking version of attempt(): returns the Admission once there is
+        # one, or raises Rejected.
+        attempt = self.attempt(client, size, spooled)
+        try:
+            with self._cond:
+                while True:
+                    admission = attempt.poll()
+                    if admission is not None:
+                        return admission
+                    # Other workers free space and reservations too, so
+                    # poll rather than wait for a notification only.
+                    self._cond.wait(self.poll_interval)
+        except BaseException:
+            attempt.cancel()
+            raise
+
+    def in_flight(self):
+        # (uploads, bytes) currently admitted on the host.
+        count, reserved, _ = self.ledger.totals()
+        return count, reserved
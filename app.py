@@ -1,17 +1,323 @@
-from flask import Flask, request, render_template_string, send_file, url_for
+import click
+from flask import Flask, jsonify, request, url_for
+from flask.cli import with_appcontext
+from werkzeug.datastructures import ContentRange, EnvironHeaders
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import FileWrapper, wrap_file
+import atexit
+import base64
+import functools
+import gc
+import hashlib
+import hmac
 import os
-import uuid
+import shutil
+import threading
+import time
 
-app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['MAX_CONTENT_LENGTH'] = 256 * 1024 * 1024  # 256 MB
+from access import (PasswordHasher, PasswordHasherBusy, access_token, check_access_token,
+                    download_claim, download_token)
+from admission import ADMISSION_ENVIRON_KEY, AdmissionController, Rejected, create_ledger
+from cluster import HANDOFF_MODES, Cluster, ProxyError, parse_nodes
+from container import HEADER_SIZE, ContainerError, validate_container
+from expiry import Reaper
+from filenames import FilenameError, format_encrypted_filename, parse_encrypted_filename
+from limits import client_key, create_rate_limiter, load_secret
+from manifest import decode_manifest, encode_manifest, file_ranges
+from metadata import create_metadata_store
+from metrics import (CLAIM_CONFLICTS, HANDOFFS, PASSWORD_CHECKS, RECEIVED_BYTES, RENDER_DURATION,
+                     REQUEST_DURATION, REQUESTS, SENT_BYTES, STORAGE_WRITE_DURATION,
+                     UPLOAD_ADMISSIONS, registry)
+from pages import StaticAsset, StaticPage, html_response, write_assets
+from sidecars import SidecarMetadataStore, Sidecars, rebuild_index, save_snapshot
+from serving import OFFLOAD_MODES, SERVE_MODES, DeliveryTracker, RangeFile
+from storage import (ConcatReader, DigestReader, blob_path, copy_stream, create_storage,
+                     migrate_flat_layout, parse_fanout, read_exact)
 
-# In-memory storage for file metadata.
-# We store only the encrypted filename (not the plain name), the file path, and a download flag.
-files_data = {}
+def configure(config):
+    # Defaults, and settings from SECURE_SHARE_* environment variables.
+    config['UPLOAD_FOLDER'] = 'uploads'
+    # Fan-out of the uploads tree: "2,2" stores <id>.enc under uploads/ab/cd/,
+    # "" keeps every file directly in uploads/. See storage.py.
+    config['UPLOAD_FANOUT'] = parse_fanout(os.environ.get('SECURE_SHARE_UPLOAD_FANOUT', '2,2'))
+    # Where ciphertext is stored: 'local' (UPLOAD_FOLDER) or 's3' (any
+    # S3-compatible object store, needs boto3). Chunked uploads are always staged
+    # in UPLOAD_FOLDER. See storage.py.
+    config['STORAGE_BACKEND'] = os.environ.get('SECURE_SHARE_STORAGE_BACKEND', 'local')
+    config['S3_BUCKET'] = os.environ.get('SECURE_SHARE_S3_BUCKET')
+    config['S3_PREFIX'] = os.environ.get('SECURE_SHARE_S3_PREFIX', '')
+    config['S3_ENDPOINT_URL'] = os.environ.get('SECURE_SHARE_S3_ENDPOINT_URL')
+    config['S3_MULTIPART_THRESHOLD'] = 16 * 1024 * 1024  # 16 MB
+    config['S3_PART_SIZE'] = 8 * 1024 * 1024  # 8 MB
+    config['S3_MAX_CONCURRENCY'] = 8
+    config['MAX_CONTENT_LENGTH'] = 256 * 1024 * 1024  # 256 MB
+    # Chunked uploads: total size limit, server-chosen chunk size, and the fixed
+    # buffer used to copy request bodies to disk.
+    config['MAX_UPLOAD_SIZE'] = 256 * 1024 * 1024  # 256 MB
+    config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024  # 8 MB
+    config['COPY_BUFFER_SIZE'] = 64 * 1024  # 64 KB
+    # Most files one /upload request may bundle into a batch share; see
+    # manifest.py.
+    config['MAX_BATCH_FILES'] = 1000
+    # Request bodies received by the ASGI entry point (asgi.py) are kept in
+    # memory up to this size and spooled to a temporary file beyond it.
+    config['ASGI_SPOOL_SIZE'] = 1024 * 1024  # 1 MB
+    # How /file/<file_id> sends ciphertext: 'sendfile' (wsgi.file_wrapper, i.e.
+    # os.sendfile under gunicorn), 'stream', 'x-accel-redirect' or 'x-sendfile'.
+    # See serving.py.
+    config['FILE_SERVE_MODE'] = os.environ.get('SECURE_SHARE_FILE_SERVE_MODE', 'sendfile')
+    config['X_ACCEL_REDIRECT_PREFIX'] = os.environ.get(
+        'SECURE_SHARE_X_ACCEL_REDIRECT_PREFIX', '/protected-uploads/')
+    # After the first request for a file, the client that claimed it can resume
+    # or fetch ranges for this long. The file is deleted sooner once all of it has
+    # been sent or the client acknowledges the download.
+    config['DOWNLOAD_GRACE_PERIOD'] = 3600  # 1 hour
+    # Lifetime of a share that is never downloaded. Uploads may ask for a shorter
+    # or longer one (form field 'ttl', in seconds) up to MAX_TTL. Unfinished
+    # chunked uploads are dropped after UPLOAD_SESSION_TTL.
+    config['DEFAULT_TTL'] = 7 * 24 * 3600  # 7 days
+    config['MAX_TTL'] = 30 * 24 * 3600  # 30 days
+    config['UPLOAD_SESSION_TTL'] = 24 * 3600  # 1 day
+    # Downloads a share allows (form field 'max_downloads', default 1) before it
+    # is deleted.
+    config['MAX_DOWNLOADS'] = 100
+    # Optional share passwords (form field 'password'), hashed with scrypt in a
+    # pool of PASSWORD_PROCESSES processes per worker; at most PASSWORD_QUEUE
+    # more checks wait, beyond that requests get 503. See access.py. A correct
+    # password is remembered in a cookie for ACCESS_TOKEN_LIFETIME. Guesses are
+    # limited per client and, across all clients, per share (0 disables).
+    config['PASSWORD_PROCESSES'] = int(os.environ.get('SECURE_SHARE_PASSWORD_PROCESSES', 4))
+    config['PASSWORD_QUEUE'] = 64
+    config['PASSWORD_TIMEOUT'] = 10  # seconds
+    config['MAX_PASSWORD_LENGTH'] = 1024
+    config['ACCESS_TOKEN_LIFETIME'] = 3600  # 1 hour
+    config['PASSWORD_ATTEMPTS_PER_MINUTE'] = 10
+    config['SHARE_PASSWORD_ATTEMPTS_PER_MINUTE'] = 60
+    # The background reaper deletes expired files in batches every REAPER_INTERVAL
+    # seconds; see expiry.py.
+    config['REAPER_INTERVAL'] = 60  # seconds
+    config['REAPER_BATCH_SIZE'] = 500
+    # Each worker writes its metrics here for /metrics to aggregate; see
+    # metrics.py. None: in UPLOAD_FOLDER (see FOLDER_PATHS), as for the other
+    # paths below.
+    config['METRICS_DIR'] = None
+    config['METRICS_FLUSH_INTERVAL'] = 5  # seconds
+    # 'sqlite' is shared by every worker on the host and survives restarts;
+    # 'memory' keeps metadata in this process only (tests, single-worker runs).
+    config['METADATA_BACKEND'] = os.environ.get('SECURE_SHARE_METADATA_BACKEND', 'sqlite')
+    config['METADATA_PATH'] = os.environ.get('SECURE_SHARE_METADATA_PATH')
+    # Bytes of the SQLite database that every worker reads through a shared
+    # memory map (0: read through each connection's own page cache).
+    config['METADATA_MMAP_SIZE'] = int(os.environ.get(
+        'SECURE_SHARE_METADATA_MMAP_SIZE', 256 * 1024 * 1024))
+    # Threads reading sidecar records when the metadata index has to be rebuilt
+    # at startup; see sidecars.py.
+    config['REBUILD_WORKERS'] = 8
+    # With the memory backend, the index is saved here on a clean exit and
+    # loaded (instead of rescanning the sidecars) by the next start.
+    config['INDEX_SNAPSHOT_PATH'] = None
+    # Per-client limits, see limits.py; 0 disables a limit. The limiter state is
+    # per worker ('memory') or shared by the workers on a host ('sqlite').
+    # Clients are keyed by REMOTE_ADDR (on a request handed off by another
+    # node, the X-Forwarded-For that node sets), so behind a proxy wrap the
+    # app in werkzeug's ProxyFix.
+    config['RATE_LIMIT_BACKEND'] = os.environ.get('SECURE_SHARE_RATE_LIMIT_BACKEND', 'memory')
+    config['RATE_LIMIT_PATH'] = os.environ.get('SECURE_SHARE_RATE_LIMIT_PATH')
+    config['RATE_LIMIT_MAX_CLIENTS'] = 100000
+    config['REQUESTS_PER_SECOND'] = 10
+    config['REQUEST_BURST'] = 50
+    config['UPLOAD_BYTES_PER_DAY'] = 2 * 1024 * 1024 * 1024  # 2 GB
+    config['MAX_STORED_BYTES'] = 1024 * 1024 * 1024  # 1 GB outstanding per client
+    # Upload admission against disk watermarks, see admission.py. A watermark is
+    # a fraction of the filesystem (0.85) or, above 1, bytes used. Above the soft
+    # watermark uploads queue and go through a few at a time; above the hard one
+    # they get 503 before their body is read. The ledger of admitted uploads is
+    # per worker ('memory') or shared by the workers on a host ('sqlite').
+    config['UPLOAD_SOFT_WATERMARK'] = float(os.environ.get('SECURE_SHARE_UPLOAD_SOFT_WATERMARK', 0.85))
+    config['UPLOAD_HARD_WATERMARK'] = float(os.environ.get('SECURE_SHARE_UPLOAD_HARD_WATERMARK', 0.95))
+    config['ADMISSION_BACKEND'] = os.environ.get('SECURE_SHARE_ADMISSION_BACKEND', 'sqlite')
+    config['ADMISSION_PATH'] = os.environ.get('SECURE_SHARE_ADMISSION_PATH')
+    config['ADMISSION_OVERLOAD_CONCURRENCY'] = 2  # uploads in flight above the soft watermark
+    config['ADMISSION_QUEUE_SIZE'] = 256  # waiting uploads per worker
+    config['ADMISSION_QUEUE_TIMEOUT'] = 30  # seconds
+    config['ADMISSION_RETRY_AFTER'] = 30  # seconds
+    # A reservation left by a worker that was killed mid-upload stops counting
+    # after this long.
+    config['ADMISSION_RESERVATION_TTL'] = 6 * 3600  # 6 hours
+    # Several nodes behind one load balancer, see cluster.py. NODES maps node
+    # names to the URLs the nodes reach each other at ("n1=http://10.0.0.1:8000,
+    # n2=..."), NODE_PUBLIC_URLS to the URLs browsers are redirected to in
+    # 'redirect' mode (default: the same). Empty NODES: a single node.
+    config['NODE_NAME'] = os.environ.get('SECURE_SHARE_NODE_NAME', '')
+    config['NODES'] = parse_nodes(os.environ.get('SECURE_SHARE_NODES', ''))
+    config['NODE_PUBLIC_URLS'] = parse_nodes(os.environ.get('SECURE_SHARE_NODE_PUBLIC_URLS', ''))
+    config['HANDOFF_MODE'] = os.environ.get('SECURE_SHARE_HANDOFF_MODE', 'proxy')
+    config['PROXY_POOL_SIZE'] = 16  # idle keep-alive connections per node
+    config['PROXY_TIMEOUT'] = 30  # seconds
 
-# Ensure the uploads directory exists.
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Settings that default to a file in UPLOAD_FOLDER, and that file's name.
+FOLDER_PATHS = {
+    'METRICS_DIR': 'metrics',
+    'METADATA_PATH': 'metadata.db',
+    'RATE_LIMIT_PATH': 'limits.db',
+    'ADMISSION_PATH': 'admission.db',
+    'INDEX_SNAPSHOT_PATH': 'index.snapshot',
+}
+
+def resolve_paths(config):
+    # Put the FOLDER_PATHS left unset in the final UPLOAD_FOLDER, which may
+    # have been given to create_app().
+    for key, name in FOLDER_PATHS.items():
+        if config[key] is None:
+            config[key] = os.path.join(config['UPLOAD_FOLDER'], name)
+
+def check_config(config):
+    if config['FILE_SERVE_MODE'] not in SERVE_MODES:
+        raise ValueError("Unknown FILE_SERVE_MODE: %r" % (config['FILE_SERVE_MODE'],))
+    if config['FILE_SERVE_MODE'] in OFFLOAD_MODES and config['STORAGE_BACKEND'] != 'local':
+        raise ValueError("FILE_SERVE_MODE %r needs local storage" % (config['FILE_SERVE_MODE'],))
+    if config['HANDOFF_MODE'] not in HANDOFF_MODES:
+        raise ValueError("Unknown HANDOFF_MODE: %r" % (config['HANDOFF_MODE'],))
+
+# Suffix of a chunked upload still being written.
+PART_SUFFIX = '.part'
+# Suffix given to a ciphertext file once a download has claimed it.
+CLAIMED_SUFFIX = '.claimed'
+
+def blob_exists(record):
+    # Whether a sidecar's blob is still there. Checking remote storage would
+    # cost a request per record; those are left to the reaper.
+    if not storage.is_local:
+        return True
+    return (os.path.exists(record['filepath'])
+            or os.path.exists(record['filepath'] + CLAIMED_SUFFIX))
+
+def create_app(config=None):
+    # Build the application: settings from the environment, then `config`;
+    # the uploads folder, storage, the metadata index (rebuilt from sidecars
+    # if empty) and the other services; the routes. The views use this
+    # module's globals, which this sets, so there is one application per
+    # process. Importing the module does none of this: `app` is created on
+    # first use (see __getattr__ at the end of the file).
+    global app, rate_limiter, client_secret, upload_admission, password_hasher, cluster, \
+        storage, sidecars, metadata_store, reaper, pages
+    flask_app = Flask(__name__)
+    configure(flask_app.config)
+    flask_app.config.update(config or {})
+    resolve_paths(flask_app.config)
+    check_config(flask_app.config)
+    config = flask_app.config
+
+    # Ensure the uploads directory exists.
+    os.makedirs(config['UPLOAD_FOLDER'], exist_ok=True)
+
+    registry.configure(config['METRICS_DIR'], config['METRICS_FLUSH_INTERVAL'])
+
+    # Per-client rate limits and upload quotas.
+    rate_limiter = create_rate_limiter(config['RATE_LIMIT_BACKEND'], config['RATE_LIMIT_PATH'],
+                                       config['RATE_LIMIT_MAX_CLIENTS'])
+    client_secret = os.environ.get('SECURE_SHARE_CLIENT_KEY_SECRET', '').encode() or \
+        load_secret(os.path.join(config['UPLOAD_FOLDER'], 'client.key'))
+
+    # Upload admission; see admission.py.
+    upload_admission = AdmissionController(
+        create_ledger(config['ADMISSION_BACKEND'], config['ADMISSION_PATH']),
+        config['UPLOAD_FOLDER'],
+        soft_watermark=config['UPLOAD_SOFT_WATERMARK'],
+        hard_watermark=config['UPLOAD_HARD_WATERMARK'],
+        overload_concurrency=config['ADMISSION_OVERLOAD_CONCURRENCY'],
+        queue_size=config['ADMISSION_QUEUE_SIZE'],
+        queue_timeout=config['ADMISSION_QUEUE_TIMEOUT'],
+        retry_after=config['ADMISSION_RETRY_AFTER'],
+        reservation_ttl=config['ADMISSION_RESERVATION_TTL'],
+        observe=lambda result: registry.inc(UPLOAD_ADMISSIONS, result=result),
+    )
+
+    # Share passwords. The same secret signs access and download tokens; see
+    # access.py.
+    password_hasher = PasswordHasher(config['PASSWORD_PROCESSES'], config['PASSWORD_QUEUE'],
+                                     config['PASSWORD_TIMEOUT'])
+
+    # The other nodes, if any, and the pooled connections to them.
+    cluster = Cluster(config['NODE_NAME'], config['NODES'], config['NODE_PUBLIC_URLS'],
+                      os.environ.get('SECURE_SHARE_CLUSTER_SECRET', '').encode(),
+                      pool_size=config['PROXY_POOL_SIZE'], timeout=config['PROXY_TIMEOUT'],
+                      buffer_size=config['COPY_BUFFER_SIZE'])
+
+    # Ciphertext storage. Record 'filepath' values are locations in it.
+    storage = create_storage(
+        config['STORAGE_BACKEND'],
+        folder=config['UPLOAD_FOLDER'],
+        fanout=config['UPLOAD_FANOUT'],
+        buffer_size=config['COPY_BUFFER_SIZE'],
+        bucket=config['S3_BUCKET'],
+        prefix=config['S3_PREFIX'],
+        endpoint_url=config['S3_ENDPOINT_URL'],
+        multipart_threshold=config['S3_MULTIPART_THRESHOLD'],
+        part_size=config['S3_PART_SIZE'],
+        max_concurrency=config['S3_MAX_CONCURRENCY'],
+    )
+
+    # File metadata store.
+    # We store only the encrypted filename (not the plain name), the file path, and a download flag.
+    # Each record is also kept as a sidecar file, from which an empty store (a
+    # lost database, or the memory backend after a restart) is rebuilt before
+    # the first request.
+    sidecars = Sidecars(config['UPLOAD_FOLDER'], config['UPLOAD_FANOUT'],
+                        sync_blobs=storage.is_local)
+    metadata_store = SidecarMetadataStore(
+        create_metadata_store(config['METADATA_BACKEND'], config['METADATA_PATH'],
+                              config['METADATA_MMAP_SIZE'],
+                              functools.partial(storage.location, create=False)),
+        sidecars)
+
+    # The memory backend's index starts from its snapshot if there is one;
+    # see save_index_at_exit().
+    rebuild_index(metadata_store.store, sidecars,
+                  os.path.join(config['UPLOAD_FOLDER'], 'rebuild.lock'),
+                  workers=config['REBUILD_WORKERS'], blob_exists=blob_exists,
+                  snapshot=index_snapshot_path(config))
+
+    # Deletes expired shares and abandoned chunked uploads.
+    reaper = Reaper(
+        metadata_store,
+        storage,
+        config['UPLOAD_FOLDER'],
+        os.path.join(config['UPLOAD_FOLDER'], 'reaper.lock'),
+        interval=config['REAPER_INTERVAL'],
+        batch_size=config['REAPER_BATCH_SIZE'],
+        claimed_suffix=CLAIMED_SUFFIX,
+        part_suffix=PART_SUFFIX,
+        sidecars=sidecars,
+    )
+
+    # Pages and assets are built on first use, or by warmup().
+    pages = SitePages(flask_app.jinja_env)
+
+    for rule, view, options in _routes:
+        flask_app.add_url_rule(rule, view_func=view, **options)
+    flask_app.before_request(start_threads)
+    flask_app.wsgi_app = instrumented(flask_app.wsgi_app)
+    for cli_command in _commands:
+        flask_app.cli.add_command(cli_command)
+    app = flask_app
+    return flask_app
+
+# Routes and CLI commands, added to the application by create_app().
+_routes = []
+_commands = []
+
+def route(rule, **options):
+    def decorator(view):
+        _routes.append((rule, view, options))
+        return view
+    return decorator
+
+def command(name):
+    def decorator(func):
+        _commands.append(click.command(name)(with_appcontext(func)))
+        return func
+    return decorator
 
 ###############################################################################
 # 1) SHARED NAVBAR & HELPER HTML
@@ -38,154 +344,284 @@ NAVBAR_HTML = """
 </nav>
 """
 
+# Stylesheet shared by all pages, served as a static asset (see pages.py).
+SITE_CSS = """
+body {
+  margin: 0;
+  padding: 0;
+  background: linear-gradient(135deg, #ffffff 0%, #f2f2f2 100%);
+  font-family: 'Poppins', sans-serif;
+}
+/* Navbar styling */
+.navbar {
+  background: linear-gradient(45deg, #3b5998, #8b9dc3);
+}
+.navbar-toggler {
+  border-color: rgba(255,255,255,0.1);
+}
+.navbar-toggler-icon {
+  background-image: url("data:image/svg+xml;charset=utf8,%3Csvg viewBox='0 0 30 30' xmlns='http://www.w3.org/2000/svg'%3E%3Cpath stroke='rgba(255, 255, 255, 0.8)' stroke-width='2' stroke-linecap='round' stroke-miterlimit='10' d='M4 7h22M4 15h22M4 23h22'/%3E%3C/svg%3E");
+}
+
+/* Card styling; each page has its own header colour */
+.card {
+  max-width: 600px;
+  margin: 40px auto;
+  border-radius: 8px;
+  box-shadow: 0 0 20px rgba(0,0,0,0.05);
+}
+.card-header {
+  border-top-left-radius: 8px;
+  border-top-right-radius: 8px;
+  color: #fff;
+  font-weight: 600;
+}
+.page-upload .card-header {
+  background: #3b5998;
+}
+.page-download .card-header {
+  background: #6c757d;
+}
+.page-help .card-header {
+  background: #17a2b8;
+}
+
+/* Upload button & progress bar */
+.page-upload .btn-success {
+  background: linear-gradient(45deg, #4CAF50, #81C784);
+  border: none;
+  color: #fff;
+}
+.page-upload .btn-success:hover {
+  background: linear-gradient(45deg, #388E3C, #66BB6A);
+  color: #fff;
+}
+.page-upload #progressBar {
+  transition: width 0.4s ease;
+}
+
+/* Footer */
+footer {
+  text-align: center;
+  margin: 40px 0 20px;
+  color: #999;
+}
+"""
+
 ###############################################################################
-# 2) UPLOAD (HOME) PAGE
-###############################################################################
-INDEX_HTML = """
-<!doctype html>
-<html>
-<head>
-  <title>Secure Share - Upload</title>
-  <!-- Bootstrap CSS -->
-  <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
-  <!-- Font Awesome for icons -->
-  <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/5.15.3/css/all.min.css">
-  <!-- Google Fonts -->
-  <link rel="preconnect" href="https://fonts.gstatic.com">
-  <link href="https://fonts.googleapis.com/css2?family=Poppins:wght@300;400;600&display=swap" rel="stylesheet">
-  <style>
-    body {
-      margin: 0;
-      padding: 0;
-      background: linear-gradient(135deg, #ffffff 0%, #f2f2f2 100%);
-      font-family: 'Poppins', sans-serif;
-    }
-    /* Navbar styling */
-    .navbar {
-      background: linear-gradient(45deg, #3b5998, #8b9dc3);
-    }
-    .navbar-toggler {
-      border-color: rgba(255,255,255,0.1);
-    }
-    .navbar-toggler-icon {
-      background-image: url("data:image/svg+xml;charset=utf8,%3Csvg viewBox='0 0 30 30' " +
-        "xmlns='http://www.w3.org/2000/svg'%3E%3Cpath stroke='rgba(255, 255, 255, 0.8)' " +
-        "stroke-width='2' stroke-linecap='round' stroke-miterlimit='10' d='M4 7h22M4 15h22M4 23h22' " +
-        "/%3E%3C/svg%3E");
-    }
+# Script shared by the upload and download pages, served as a static asset
+# and loaded before each page's own script.
+COMMON_JS = """
+// Segmented AES-GCM container; see container.py for the reference format.
+const CONTAINER_MAGIC = [0x53, 0x53, 0x45, 0x43]; // "SSEC"
+const CONTAINER_VERSION = 1;
+const HEADER_SIZE = 32;
+const TAG_SIZE = 16;
+// Version byte of encrypted filenames; see filenames.py.
+const FILENAME_VERSION = 1;
+// Most Web Workers a page runs at once.
+const MAX_WORKERS = 8;
 
-    /* Card styling */
-    .card {
-      max-width: 600px; 
-      margin: 40px auto;
-      border-radius: 8px;
-      box-shadow: 0 0 20px rgba(0,0,0,0.05);
-    }
-    .card-header {
-      border-top-left-radius: 8px;
-      border-top-right-radius: 8px;
-      background: #3b5998;
-      color: #fff;
-      font-weight: 600;
-    }
+// Nonce of a segment: the container's 7-byte prefix, the segment index and
+// a flag for the last segment.
+function segmentNonce(noncePrefix, index, last) {
+  const nonce = new Uint8Array(12);
+  nonce.set(noncePrefix, 0);
+  new DataView(nonce.buffer).setUint32(7, index);
+  nonce[11] = last ? 1 : 0;
+  return nonce;
+}
 
-    /* Buttons & progress bar */
-    .btn-success {
-      background: linear-gradient(45deg, #4CAF50, #81C784);
-      border: none;
-      color: #fff;
-    }
-    .btn-success:hover {
-      background: linear-gradient(45deg, #388E3C, #66BB6A);
-      color: #fff;
-    }
-    #progressBar {
-      transition: width 0.4s ease;
+// Runs jobs on a fixed set of workers, queueing the rest. run() resolves
+// with the worker's result.
+class WorkerPool {
+  constructor(source, size) {
+    this.url = URL.createObjectURL(new Blob([source], { type: 'text/javascript' }));
+    this.workers = Array.from({ length: size }, () => new Worker(this.url));
+    this.idle = this.workers.slice();
+    this.jobs = [];
+  }
+  run(message, transfer) {
+    return new Promise((resolve, reject) => {
+      this.jobs.push({ message: message, transfer: transfer || [], resolve: resolve, reject: reject });
+      this.dispatch();
+    });
+  }
+  dispatch() {
+    while (this.idle.length && this.jobs.length) {
+      const worker = this.idle.pop();
+      const job = this.jobs.shift();
+      const done = () => {
+        this.idle.push(worker);
+        this.dispatch();
+      };
+      worker.onmessage = (event) => {
+        done();
+        if (event.data.error) {
+          job.reject(new Error(event.data.error));
+        } else {
+          job.resolve(event.data.result);
+        }
+      };
+      worker.onerror = (event) => {
+        done();
+        job.reject(new Error(event.message));
+      };
+      worker.postMessage(job.message, job.transfer);
     }
+  }
+  close() {
+    this.workers.forEach((worker) => worker.terminate());
+    URL.revokeObjectURL(this.url);
+  }
+}
 
-    /* Footer */
-    footer {
-      text-align: center;
-      margin: 40px 0 20px;
-      color: #999;
+// FIFO of byte chunks, from which exact-sized pieces are taken.
+class ByteQueue {
+  constructor() {
+    this.chunks = [];
+    this.length = 0;
+  }
+  push(chunk) {
+    this.chunks.push(chunk);
+    this.length += chunk.length;
+  }
+  take(n) {
+    const out = new Uint8Array(n);
+    let offset = 0;
+    while (offset < n) {
+      const head = this.chunks[0];
+      const m = Math.min(head.length, n - offset);
+      out.set(head.subarray(0, m), offset);
+      offset += m;
+      if (m === head.length) {
+        this.chunks.shift();
+      } else {
+        this.chunks[0] = head.subarray(m);
+      }
     }
-  </style>
-</head>
-<body>
-""" + NAVBAR_HTML + """
-  <div class="container">
-    <div class="card shadow-sm">
-      <div class="card-header">
-        <h4 class="mb-0"><i class="fas fa-lock"></i> Secure File Upload</h4>
-      </div>
-      <div class="card-body">
-        <form id="uploadForm">
-          <div class="form-group">
-            <label for="fileInput">Select a file (max 256 MB):</label>
-            <input type="file" class="form-control-file" id="fileInput" required>
-          </div>
-          <button type="submit" class="btn btn-success">
-            <i class="fas fa-cloud-upload-alt"></i> Encrypt & Upload
-          </button>
-        </form>
+    this.length -= n;
+    return out;
+  }
+}
 
-        <div id="progressContainer" class="mt-3" style="display:none;">
-          <div class="progress">
-            <div id="progressBar" class="progress-bar progress-bar-striped progress-bar-animated" 
-                 role="progressbar" style="width: 0%"></div>
-          </div>
-          <small id="progressText" class="form-text text-muted"></small>
-        </div>
+function formatRate(bytes, seconds) {
+  return (bytes / 1048576 / Math.max(seconds, 0.001)).toFixed(1) + ' MB/s';
+}
+"""
 
-        <div id="result" class="mt-4"></div>
-      </div>
-    </div>
-  </div>
+###############################################################################
+# 2) UPLOAD (HOME) PAGE
+###############################################################################
+# Script of the upload page, served as a static asset.
+UPLOAD_JS = """
+// Utility: Convert bytes to unpadded base64url.
+function bytesToBase64url(bytes) {
+  let binary = '';
+  for (let i = 0; i < bytes.length; i += 0x8000) {
+    binary += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+  }
+  return btoa(binary).replace(/\\+/g, '-').replace(/\\//g, '_').replace(/=+$/, '');
+}
 
-  <!-- Bootstrap JS (for responsive navbar toggling) -->
-  <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
-  <script src="https://cdn.jsdelivr.net/npm/bootstrap@4.5.2/dist/js/bootstrap.bundle.min.js"></script>
+// Segmented AES-GCM container (see container.py for the reference format,
+// and common.js for its constants). Segments are encrypted independently, so
+// a pool of Web Workers encrypts several at once while the main thread only
+// moves bytes around.
+const SEGMENT_SIZE = 1024 * 1024;
 
-<script>
-// Utility: Convert ArrayBuffer to hex string.
-function buf2hex(buffer) {
-  return Array.from(new Uint8Array(buffer))
-    .map(b => ('00' + b.toString(16)).slice(-2))
-    .join('');
+// Pipeline bounds: encrypted segments waiting to be uploaded, and chunk
+// PUTs in flight. Together they cap memory use at a few tens of MB whatever
+// the file size.
+const MAX_PENDING_SEGMENTS = 16;
+const UPLOAD_CONCURRENCY = 3;
+const UPLOAD_ATTEMPTS = 5;
+
+function buildHeader(plaintextSize, segmentSize, noncePrefix) {
+  const header = new Uint8Array(HEADER_SIZE);
+  const view = new DataView(header.buffer);
+  header.set(CONTAINER_MAGIC, 0);
+  header[4] = CONTAINER_VERSION;
+  view.setUint32(8, segmentSize);
+  view.setBigUint64(12, BigInt(plaintextSize));
+  header.set(noncePrefix, 20);
+  return header;
 }
 
-// Encrypt the file content using AES-GCM.
-async function encryptFile(file) {
-    // Generate a random AES-256 key.
+function ciphertextSize(plaintextSize) {
+  const count = Math.max(1, Math.ceil(plaintextSize / SEGMENT_SIZE));
+  return HEADER_SIZE + plaintextSize + count * TAG_SIZE;
+}
+
+// Encrypt one segment: job.blob is its slice of the file. Runs in a worker.
+async function encryptSegment(job) {
+    const plaintext = await job.blob.arrayBuffer();
+    return crypto.subtle.encrypt(
+        { name: "AES-GCM", iv: segmentNonce(job.noncePrefix, job.index, job.last), additionalData: job.header },
+        job.key,
+        plaintext
+    );
+}
+
+// Encrypt a whole (small) file into a container Blob. Runs in a worker.
+async function encryptContainer(file, key) {
+    // Random 7-byte nonce prefix; each segment adds its index and a last flag.
+    const noncePrefix = crypto.getRandomValues(new Uint8Array(7));
+    const header = buildHeader(file.size, SEGMENT_SIZE, noncePrefix);
+
+    // Encrypt segment by segment, binding each one to the header.
+    const count = Math.max(1, Math.ceil(file.size / SEGMENT_SIZE));
+    const parts = [header];
+    for (let i = 0; i < count; i++) {
+        const start = i * SEGMENT_SIZE;
+        parts.push(new Blob([await encryptSegment({
+            blob: file.slice(start, start + SEGMENT_SIZE), key: key, header: header,
+            noncePrefix: noncePrefix, index: i, last: i === count - 1
+        })]));
+    }
+    return new Blob(parts);
+}
+
+// The worker script is assembled from the functions above and common.js.
+const ENCRYPT_WORKER_SOURCE = [
+    "const CONTAINER_MAGIC = " + JSON.stringify(CONTAINER_MAGIC) + ";",
+    "const CONTAINER_VERSION = " + CONTAINER_VERSION + ";",
+    "const HEADER_SIZE = " + HEADER_SIZE + ";",
+    "const SEGMENT_SIZE = " + SEGMENT_SIZE + ";",
+    String(buildHeader),
+    String(segmentNonce),
+    String(encryptSegment),
+    String(encryptContainer),
+    "self.onmessage = async (event) => {" +
+    "  try {" +
+    "    if (event.data.file) {" +
+    "      self.postMessage({ result: await encryptContainer(event.data.file, event.data.key) });" +
+    "    } else {" +
+    "      const result = await encryptSegment(event.data);" +
+    "      self.postMessage({ result: result }, [result]);" +
+    "    }" +
+    "  } catch (e) { self.postMessage({ error: String(e) }); }" +
+    "};"
+].join("\\n");
+
+function workerCount(jobs) {
+    return Math.max(1, Math.min(jobs, navigator.hardwareConcurrency || 4, MAX_WORKERS));
+}
+
+// Generate a random AES-256 key, and its base64url form for the link's
+// fragment.
+async function generateKey() {
     const key = await window.crypto.subtle.generateKey(
         { name: "AES-GCM", length: 256 },
         true,
         ["encrypt", "decrypt"]
     );
-    // Export the key as a hex string.
     const rawKey = await window.crypto.subtle.exportKey("raw", key);
-    const keyHex = buf2hex(rawKey);
-    
-    // Generate a random 12-byte IV.
-    const iv = window.crypto.getRandomValues(new Uint8Array(12));
-    
-    // Read the file as an ArrayBuffer.
-    const arrayBuffer = await file.arrayBuffer();
-    
-    // Encrypt the file content.
-    const encryptedContent = await window.crypto.subtle.encrypt(
-        { name: "AES-GCM", iv: iv },
-        key,
-        arrayBuffer
-    );
-    
-    // Concatenate the IV and the encrypted content.
-    const encryptedBlob = new Blob([iv, new Uint8Array(encryptedContent)]);
-    
-    return { encryptedBlob, keyHex, keyObj: key };
+    return { keyObj: key, keyText: bytesToBase64url(new Uint8Array(rawKey)) };
 }
 
-// Encrypt the filename using the same key (with a separate IV).
+// Encrypt the filename using the same key (with a separate IV), encoded as
+// base64url(version || iv || ciphertext); see filenames.py.
 async function encryptFilename(filename, key) {
     const encoder = new TextEncoder();
     const filenameBytes = encoder.encode(filename);
@@ -195,9 +631,153 @@ async function encryptFilename(filename, key) {
         key,
         filenameBytes
     );
-    const ivHex = buf2hex(iv);
-    const cipherHex = buf2hex(encryptedBuffer);
-    return ivHex + ":" + cipherHex;
+    const out = new Uint8Array(1 + iv.length + encryptedBuffer.byteLength);
+    out[0] = FILENAME_VERSION;
+    out.set(iv, 1);
+    out.set(new Uint8Array(encryptedBuffer), 1 + iv.length);
+    return bytesToBase64url(out);
+}
+
+// Send a request with XMLHttpRequest, which (unlike fetch) reports upload
+// progress: onProgress(bytes sent so far). Resolves with the response text.
+function send(method, url, body, onProgress) {
+    return new Promise((resolve, reject) => {
+        const xhr = new XMLHttpRequest();
+        xhr.open(method, url);
+        if (onProgress) {
+            xhr.upload.onprogress = (event) => onProgress(event.loaded);
+        }
+        xhr.onload = () => {
+            if (xhr.status >= 200 && xhr.status < 300) {
+                resolve(xhr.responseText);
+            } else {
+                const error = new Error(xhr.responseText || xhr.statusText);
+                error.status = xhr.status;
+                error.retryAfter = parseInt(xhr.getResponseHeader("Retry-After"), 10) || 0;
+                reject(error);
+            }
+        };
+        xhr.onerror = () => reject(new Error("Network error"));
+        xhr.send(body);
+    });
+}
+
+// send() for the steps of a chunked upload, retrying network and server
+// errors and, after its Retry-After, the per-client request limit (429).
+async function sendRetrying(method, url, body, onProgress) {
+    for (let attempt = 1; ; attempt++) {
+        try {
+            return await send(method, url, body, onProgress);
+        } catch (e) {
+            if (attempt >= UPLOAD_ATTEMPTS || (e.status && e.status < 500 && e.status !== 429)) {
+                throw e;
+            }
+            if (onProgress) onProgress(0);
+            const delay = 1000 * Math.max(e.retryAfter || 0, attempt);
+            await new Promise((resolve) => setTimeout(resolve, delay));
+        }
+    }
+}
+
+// Upload one file through the chunked upload API: workers encrypt its
+// segments in parallel, the ciphertext is cut into the server's chunks, and
+// up to UPLOAD_CONCURRENCY chunks are sent at once. onProgress(sent, total)
+// counts bytes actually sent. Returns the server's result HTML and the key.
+async function uploadFile(file, options, onProgress) {
+    const { keyObj, keyText } = await generateKey();
+    const noncePrefix = crypto.getRandomValues(new Uint8Array(7));
+    const header = buildHeader(file.size, SEGMENT_SIZE, noncePrefix);
+    const total = ciphertextSize(file.size);
+
+    const form = new FormData();
+    form.append("encrypted_filename", await encryptFilename(file.name, keyObj));
+    form.append("size", total);
+    appendOptions(form, options);
+    const session = JSON.parse(await send("POST", "/upload/start", form));
+
+    const count = Math.max(1, Math.ceil(file.size / SEGMENT_SIZE));
+    const pool = new WorkerPool(ENCRYPT_WORKER_SOURCE, workerCount(count));
+    const sent = new Map();
+    const report = () => onProgress(Array.from(sent.values()).reduce((a, b) => a + b, 0), total);
+    const uploads = new Set();
+    const queue = new ByteQueue();
+    queue.push(header);
+    let chunk = 0;
+    try {
+        const pending = [];
+        let next = 0;
+        while (next < count || pending.length) {
+            while (next < count && pending.length < MAX_PENDING_SEGMENTS) {
+                const start = next * SEGMENT_SIZE;
+                pending.push(pool.run({
+                    blob: file.slice(start, start + SEGMENT_SIZE), key: keyObj, header: header,
+                    noncePrefix: noncePrefix, index: next, last: next === count - 1
+                }));
+                next++;
+            }
+            queue.push(new Uint8Array(await pending.shift()));
+            const finished = next === count && !pending.length;
+            while (queue.length >= session.chunk_size || (finished && queue.length)) {
+                while (uploads.size >= UPLOAD_CONCURRENCY) {
+                    await Promise.race(uploads);
+                }
+                const n = chunk++;
+                const body = queue.take(Math.min(session.chunk_size, queue.length));
+                const url = "/upload/" + session.upload_id + "/chunk/" + n;
+                const upload = sendRetrying("PUT", url, body, (bytes) => {
+                    sent.set(n, bytes);
+                    report();
+                }).then(() => {
+                    sent.set(n, body.length);
+                    report();
+                    uploads.delete(upload);
+                });
+                uploads.add(upload);
+            }
+        }
+        await Promise.all(uploads);
+    } finally {
+        pool.close();
+    }
+    const html = await sendRetrying("POST", "/upload/" + session.upload_id + "/finish", null);
+    return { html: html, keyText: keyText };
+}
+
+// Several files: one key and one link, each file encrypted in a worker,
+// uploaded together in one request.
+async function uploadBatch(files, options, onEncrypted, onProgress) {
+    const { keyObj, keyText } = await generateKey();
+    const pool = new WorkerPool(ENCRYPT_WORKER_SOURCE, workerCount(files.length));
+    let done = 0;
+    let blobs;
+    try {
+        blobs = await Promise.all(files.map((file) =>
+            pool.run({ file: file, key: keyObj }).then((blob) => {
+                onEncrypted(++done, files.length);
+                return blob;
+            })));
+    } finally {
+        pool.close();
+    }
+    const encryptedFilenames = await Promise.all(
+        files.map((file) => encryptFilename(file.name, keyObj)));
+    const form = new FormData();
+    blobs.forEach((blob, i) => {
+        form.append("file", blob, "file" + i);
+        form.append("encrypted_filename", encryptedFilenames[i]);
+        form.append("size", blob.size);
+    });
+    appendOptions(form, options);
+    const total = blobs.reduce((sum, blob) => sum + blob.size, 0);
+    const html = await send("POST", "/upload", form, (bytes) => onProgress(bytes, total));
+    return { html: html, keyText: keyText };
+}
+
+// Share options from the form: lifetime, downloads allowed, password.
+function appendOptions(form, options) {
+    form.append("ttl", options.ttl);
+    form.append("max_downloads", options.maxDownloads);
+    if (options.password) form.append("password", options.password);
 }
 
 document.getElementById("uploadForm").addEventListener("submit", async function(event) {
@@ -207,61 +787,85 @@ document.getElementById("uploadForm").addEventListener("submit", async function(
         alert("Please select a file.");
         return;
     }
-    const file = fileInput.files[0];
+    const files = Array.from(fileInput.files);
+    const options = {
+        ttl: document.getElementById("ttlSelect").value,
+        maxDownloads: document.getElementById("maxDownloadsInput").value,
+        password: document.getElementById("passwordInput").value
+    };
+    const progressBar = document.getElementById("progressBar");
+    const progressText = document.getElementById("progressText");
+    const resultContainer = document.getElementById("result");
 
     // Show progress indicator.
     document.getElementById("progressContainer").style.display = "block";
-    document.getElementById("progressText").innerText = "Encrypting file...";
-    document.getElementById("progressBar").style.width = "20%";
-    
-    // Encrypt file content.
-    const { encryptedBlob, keyHex, keyObj } = await encryptFile(file);
-    
-    // Encrypt the filename.
-    const encryptedFilename = await encryptFilename(file.name, keyObj);
-    
-    // Update progress.
-    document.getElementById("progressText").innerText = "Uploading file...";
-    document.getElementById("progressBar").style.width = "50%";
-    
-    // Prepare form data.
-    const formData = new FormData();
-    formData.append("file", encryptedBlob, file.name);
-    formData.append("encrypted_filename", encryptedFilename);
-    
-    // Upload the encrypted file and encrypted filename to the server.
-    const response = await fetch("/upload", {
-        method: "POST",
-        body: formData
-    });
-    const resultText = await response.text();
-    
+    progressText.innerText = "Encrypting...";
+    progressBar.style.width = "0%";
+    resultContainer.innerHTML = "";
+
+    const started = performance.now();
+    const onProgress = (bytes, total) => {
+        progressBar.style.width = (100 * bytes / total) + "%";
+        progressText.innerText = "Encrypting and uploading... " + Math.floor(100 * bytes / total) + "% (" +
+            formatRate(bytes, (performance.now() - started) / 1000) + ")";
+    };
+    let result;
+    try {
+        if (files.length === 1) {
+            result = await uploadFile(files[0], options, onProgress);
+        } else {
+            result = await uploadBatch(files, options, (done, count) => {
+                progressText.innerText = "Encrypting files (" + done + " of " + count + ")...";
+            }, onProgress);
+        }
+    } catch (e) {
+        progressText.innerText = "Upload failed.";
+        resultContainer.innerText = e.message;
+        return;
+    }
+
     // Finalize progress.
-    document.getElementById("progressBar").style.width = "100%";
-    document.getElementById("progressText").innerText = "Upload complete!";
-    
+    progressBar.style.width = "100%";
+    progressText.innerText = "Upload complete!";
+
     // Replace placeholder with the actual encryption key in the URL fragment.
-    const resultContainer = document.getElementById("result");
-    const finalHtml = resultText.replace("YOUR_ENCRYPTION_KEY", keyHex);
-    resultContainer.innerHTML = finalHtml;
+    resultContainer.innerHTML = result.html.replace("YOUR_ENCRYPTION_KEY", result.keyText);
 });
-</script>
 
-<footer>
-  <small>© 2025 Secure Share. All rights reserved.</small>
-</footer>
-</body>
-</html>
+// Copy button of the upload result (see upload_result_html).
+async function copyLink() {
+  const linkElement = document.getElementById('downloadURL');
+  const linkText = linkElement.value;
+  
+  if (navigator.clipboard && window.isSecureContext) {
+    // Modern Async Clipboard API
+    try {
+      await navigator.clipboard.writeText(linkText);
+      alert("Download link copied to clipboard!");
+    } catch (e) {
+      console.error(e);
+      alert("Unable to copy link. Please copy manually.");
+    }
+  } else {
+    // Fallback for older browsers
+    linkElement.select();
+    linkElement.setSelectionRange(0, 99999);
+    try {
+      document.execCommand('copy');
+      alert("Download link copied to clipboard!");
+    } catch (e) {
+      console.error(e);
+      alert("Unable to copy link. Please copy manually.");
+    }
+  }
+}
 """
 
-###############################################################################
-# 3) DOWNLOAD PAGE
-###############################################################################
-DOWNLOAD_HTML = """
+INDEX_HTML = """
 <!doctype html>
 <html>
 <head>
-  <title>Secure Share - Download</title>
+  <title>Secure Share - Upload</title>
   <!-- Bootstrap CSS -->
   <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
   <!-- Font Awesome for icons -->
@@ -269,103 +873,358 @@ DOWNLOAD_HTML = """
   <!-- Google Fonts -->
   <link rel="preconnect" href="https://fonts.gstatic.com">
   <link href="https://fonts.googleapis.com/css2?family=Poppins:wght@300;400;600&display=swap" rel="stylesheet">
-  <style>
-    body {
-      margin: 0;
-      padding: 0;
-      background: linear-gradient(135deg, #ffffff 0%, #f2f2f2 100%);
-      font-family: 'Poppins', sans-serif;
-    }
-    .navbar {
-      background: linear-gradient(45deg, #3b5998, #8b9dc3);
-    }
-    .navbar-toggler {
-      border-color: rgba(255,255,255,0.1);
-    }
-    .navbar-toggler-icon {
-      background-image: url("data:image/svg+xml;charset=utf8,%3Csvg viewBox='0 0 30 30' " +
-        "xmlns='http://www.w3.org/2000/svg'%3E%3Cpath stroke='rgba(255, 255, 255, 0.8)' " +
-        "stroke-width='2' stroke-linecap='round' stroke-miterlimit='10' d='M4 7h22M4 15h22M4 23h22' " +
-        "/%3E%3C/svg%3E");
-    }
-    .card {
-      max-width: 600px; 
-      margin: 40px auto;
-      border-radius: 8px;
-      box-shadow: 0 0 20px rgba(0,0,0,0.05);
-    }
-    .card-header {
-      border-top-left-radius: 8px;
-      border-top-right-radius: 8px;
-      background: #6c757d;
-      color: #fff;
-      font-weight: 600;
-    }
-    footer {
-      text-align: center;
-      margin: 40px 0 20px;
-      color: #999;
-    }
-  </style>
+  <link rel="stylesheet" href="{{ assets['site.css'] }}">
 </head>
-<body>
+<body class="page-upload">
 """ + NAVBAR_HTML + """
   <div class="container">
     <div class="card shadow-sm">
       <div class="card-header">
-        <h4 class="mb-0"><i class="fas fa-file-download"></i> Decrypt & Download File</h4>
+        <h4 class="mb-0"><i class="fas fa-lock"></i> Secure File Upload</h4>
       </div>
       <div class="card-body">
-        <p id="status" class="mb-0">Preparing your download...</p>
-        <a href="/" class="btn btn-link mt-3">← Return Home</a>
+        <form id="uploadForm">
+          <div class="form-group">
+            <label for="fileInput">Select one or more files (max 256 MB in total):</label>
+            <input type="file" class="form-control-file" id="fileInput" multiple required>
+          </div>
+          <div class="form-group">
+            <label for="ttlSelect">Delete if not downloaded within:</label>
+            <select class="form-control" id="ttlSelect">
+              <option value="3600">1 hour</option>
+              <option value="86400">1 day</option>
+              <option value="604800" selected>7 days</option>
+              <option value="2592000">30 days</option>
+            </select>
+          </div>
+          <div class="form-group">
+            <label for="maxDownloadsInput">Number of downloads allowed:</label>
+            <input type="number" class="form-control" id="maxDownloadsInput" min="1" max="100" value="1">
+          </div>
+          <div class="form-group">
+            <label for="passwordInput">Password (optional, asked for before downloading):</label>
+            <input type="password" class="form-control" id="passwordInput" autocomplete="new-password">
+          </div>
+          <button type="submit" class="btn btn-success">
+            <i class="fas fa-cloud-upload-alt"></i> Encrypt & Upload
+          </button>
+        </form>
+
+        <div id="progressContainer" class="mt-3" style="display:none;">
+          <div class="progress">
+            <div id="progressBar" class="progress-bar progress-bar-striped progress-bar-animated" 
+                 role="progressbar" style="width: 0%"></div>
+          </div>
+          <small id="progressText" class="form-text text-muted"></small>
+        </div>
+
+        <div id="result" class="mt-4"></div>
       </div>
     </div>
   </div>
 
-  <!-- Bootstrap JS -->
-  <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
-  <script src="https://cdn.jsdelivr.net/npm/bootstrap@4.5.2/dist/js/bootstrap.bundle.min.js"></script>
+  <!-- Bootstrap JS (for responsive navbar toggling) -->
+  <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
+  <script src="https://cdn.jsdelivr.net/npm/bootstrap@4.5.2/dist/js/bootstrap.bundle.min.js"></script>
+
+<script src="{{ assets['common.js'] }}"></script>
+<script src="{{ assets['upload.js'] }}"></script>
+
+<footer>
+  <small>© 2025 Secure Share. All rights reserved.</small>
+</footer>
+</body>
+</html>
+"""
+
+###############################################################################
+# 3) DOWNLOAD PAGE
+###############################################################################
+# Script of the download page, served as a static asset. The page passes it
+# the list of files as JSON.
+DOWNLOAD_JS = """
+function base64urlToBytes(text) {
+  const binary = atob(text.replace(/-/g, '+').replace(/_/g, '/'));
+  const bytes = new Uint8Array(binary.length);
+  for (let i = 0; i < binary.length; i++) {
+    bytes[i] = binary.charCodeAt(i);
+  }
+  return bytes;
+}
+
+// Links made before base64url keys carry 64 hex characters.
+function keyToBytes(text) {
+  if (/^[0-9a-fA-F]{64}$/.test(text)) {
+    return Uint8Array.from(text.match(/../g), h => parseInt(h, 16));
+  }
+  return base64urlToBytes(text);
+}
+
+// base64url(version || iv || ciphertext); see filenames.py.
+async function decryptFilename(encryptedStr, cryptoKey) {
+  const data = base64urlToBytes(encryptedStr);
+  if (data[0] !== FILENAME_VERSION) throw new Error("Unsupported encrypted filename version");
+  const iv = data.subarray(1, 13);
+  const cipherBytes = data.subarray(13);
+  const decryptedBuffer = await crypto.subtle.decrypt(
+     { name: "AES-GCM", iv: iv },
+     cryptoKey,
+     cipherBytes
+  );
+  const decoder = new TextDecoder();
+  return decoder.decode(decryptedBuffer);
+}
+
+// Segmented AES-GCM container (see container.py for the reference format,
+// and common.js for its constants). Segments are decrypted in a pool of Web
+// Workers, several at once, and written out in order as they complete.
+// Segments handed to the workers but not yet written out.
+const MAX_PENDING_SEGMENTS = 16;
+
+// Decrypt one segment. Runs in a worker.
+function decryptSegment(job) {
+  return crypto.subtle.decrypt(
+    { name: 'AES-GCM', iv: segmentNonce(job.noncePrefix, job.index, job.last), additionalData: job.header },
+    job.key,
+    job.ciphertext
+  );
+}
+
+// The worker script is assembled from the functions above and common.js.
+const DECRYPT_WORKER_SOURCE = [
+  String(segmentNonce),
+  String(decryptSegment),
+  "self.onmessage = async (event) => {" +
+  "  try {" +
+  "    const result = await decryptSegment(event.data);" +
+  "    self.postMessage({ result: result }, [result]);" +
+  "  } catch (e) { self.postMessage({ error: String(e) }); }" +
+  "};"
+].join("\\n");
+
+function isContainer(header) {
+  return header.length >= HEADER_SIZE &&
+    CONTAINER_MAGIC.every((b, i) => header[i] === b);
+}
+
+// Reader over the body of /file/<id>, or of its bytes [start, end). If the
+// connection drops, the rest is fetched with a Range request; the download
+// token cookie set by the first response lets us back in. onProgress, if
+// set, is called with the bytes received so far.
+function resumableReader(url, response, attempts, start = 0, end = null) {
+  const total = Number(response.headers.get('Content-Length')) || null;
+  let reader = response.body.getReader();
+  let received = 0;
+  let failures = 0;
+  return {
+    total: total,
+    onProgress: null,
+    async read() {
+      while (true) {
+        try {
+          const result = await reader.read();
+          if (!result.done) {
+            received += result.value.length;
+            if (this.onProgress) this.onProgress(received);
+            return result;
+          }
+          if (total === null || received >= total) return result;
+          throw new Error("Connection closed early");
+        } catch (e) {
+          if (++failures > attempts) throw e;
+          await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+          const range = 'bytes=' + (start + received) + '-' + (end === null ? '' : end - 1);
+          const next = await fetch(url, { headers: { 'Range': range } }).catch(() => null);
+          if (next && next.status === 206) {
+            reader = next.body.getReader();
+          }
+        }
+      }
+    }
+  };
+}
+
+// Where decrypted bytes go: memory, turned into a Blob at the end...
+function blobSink() {
+  const parts = [];
+  return {
+    async write(bytes) { parts.push(bytes); },
+    async close() {},
+    blob() { return new Blob(parts); }
+  };
+}
+
+// ...or straight to a file the user picked (File System Access API), so
+// large files never have to fit in memory.
+async function fileSink(handle) {
+  const writable = await handle.createWritable();
+  return {
+    write: (bytes) => writable.write(bytes),
+    close: () => writable.close(),
+    abort: () => writable.abort()
+  };
+}
+
+// Decrypt a body reader into `sink` as it streams in. Segments go to the
+// worker pool as soon as they are complete.
+async function decryptResponse(reader, cryptoKey, sink, pool) {
+  const queue = new ByteQueue();
+  let done = false;
+  async function fill(n) {
+    while (queue.length < n && !done) {
+      const result = await reader.read();
+      if (result.done) {
+        done = true;
+      } else {
+        queue.push(result.value);
+      }
+    }
+    return queue.length >= n;
+  }
+
+  await fill(HEADER_SIZE);
+  const header = queue.take(Math.min(HEADER_SIZE, queue.length));
+  if (!isContainer(header)) {
+    // Files uploaded before the container format: [12-byte IV][ciphertext].
+    await fill(Infinity);
+    const data = new Uint8Array(header.length + queue.length);
+    data.set(header, 0);
+    data.set(queue.take(queue.length), header.length);
+    const plaintext = await crypto.subtle.decrypt(
+      { name: 'AES-GCM', iv: data.subarray(0, 12) }, cryptoKey, data.subarray(12));
+    await sink.write(new Uint8Array(plaintext));
+    await sink.close();
+    return;
+  }
+
+  const view = new DataView(header.buffer);
+  if (header[4] !== CONTAINER_VERSION) throw new Error("Unsupported container version " + header[4]);
+  const segmentSize = view.getUint32(8);
+  const plaintextSize = Number(view.getBigUint64(12));
+  const noncePrefix = header.subarray(20, 27);
+  const count = Math.max(1, Math.ceil(plaintextSize / segmentSize));
+
+  const pending = [];
+  let remaining = plaintextSize;
+  for (let i = 0; i < count; i++) {
+    const length = Math.min(segmentSize, remaining) + TAG_SIZE;
+    if (!await fill(length)) throw new Error("File is truncated");
+    const ciphertext = queue.take(length);
+    pending.push(pool.run({
+      ciphertext: ciphertext.buffer, key: cryptoKey, header: header,
+      noncePrefix: noncePrefix, index: i, last: i === count - 1
+    }, [ciphertext.buffer]));
+    remaining -= length - TAG_SIZE;
+    if (pending.length >= MAX_PENDING_SEGMENTS) {
+      await sink.write(new Uint8Array(await pending.shift()));
+    }
+  }
+  while (pending.length) {
+    await sink.write(new Uint8Array(await pending.shift()));
+  }
+  await sink.close();
+}
+
+function saveBlob(blob, filename) {
+    const a = document.createElement('a');
+    a.href = URL.createObjectURL(blob);
+    a.download = filename;
+    document.body.appendChild(a);
+    a.click();
+    a.remove();
+}
+
+function setProgress(fraction, text) {
+    document.getElementById("progressContainer").style.display = "block";
+    document.getElementById("progressBar").style.width = (100 * fraction) + "%";
+    document.getElementById("status").innerText = text;
+}
 
-<script>
-function hexToBytes(hex) {
-  const bytes = new Uint8Array(hex.length / 2);
-  for (let i = 0; i < bytes.length; i++) {
-    bytes[i] = parseInt(hex.substr(i * 2, 2), 16);
-  }
-  return bytes;
+function decryptionPool() {
+    return new WorkerPool(DECRYPT_WORKER_SOURCE, Math.min(navigator.hardwareConcurrency || 4, MAX_WORKERS));
 }
 
-async function decryptFilename(encryptedStr, cryptoKey) {
-  const parts = encryptedStr.split(":");
-  if (parts.length !== 2) throw new Error("Invalid encrypted filename format");
-  const iv = hexToBytes(parts[0]);
-  const cipherBytes = hexToBytes(parts[1]);
-  const decryptedBuffer = await crypto.subtle.decrypt(
-     { name: "AES-GCM", iv: iv },
-     cryptoKey,
-     cipherBytes
-  );
-  const decoder = new TextDecoder();
-  return decoder.decode(decryptedBuffer);
+const BATCH_CONCURRENCY = 4;
+
+// A batch share: fetch each file's slice of the blob with a Range request
+// and decrypt them concurrently. The first request claims the share and
+// gets the download token cookie, so it goes on its own; the rest follow
+// in parallel. Each file gets a save link.
+async function downloadBatch(fileUrl, files, cryptoKey, pool) {
+    const status = document.getElementById("status");
+    const list = document.createElement('ul');
+    status.after(list);
+    const total = files[files.length - 1][2];
+    const received = new Map();
+    const started = performance.now();
+    let done = 0;
+    async function fetchFile(entry) {
+        const [encryptedName, start, end] = entry;
+        const name = await decryptFilename(encryptedName, cryptoKey);
+        const response = await fetch(fileUrl, { headers: { 'Range': 'bytes=' + start + '-' + (end - 1) } });
+        if (response.status !== 206) throw new Error('Could not fetch ' + name + ' from server.');
+        const reader = resumableReader(fileUrl, response, 5, start, end);
+        reader.onProgress = (bytes) => {
+            received.set(start, bytes);
+            const sum = Array.from(received.values()).reduce((a, b) => a + b, 0);
+            setProgress(sum / total, 'Downloading and decrypting... ' + done + ' of ' + files.length +
+                        ' files (' + formatRate(sum, (performance.now() - started) / 1000) + ')');
+        };
+        const sink = blobSink();
+        await decryptResponse(reader, cryptoKey, sink, pool);
+        const item = document.createElement('li');
+        const link = document.createElement('a');
+        link.href = URL.createObjectURL(sink.blob());
+        link.download = name;
+        link.textContent = name;
+        item.appendChild(link);
+        list.appendChild(item);
+        done++;
+    }
+    await fetchFile(files[0]);
+    let next = 1;
+    await Promise.all(Array.from({ length: Math.min(BATCH_CONCURRENCY, files.length - 1) }, async () => {
+        while (next < files.length) {
+            await fetchFile(files[next++]);
+        }
+    }));
+    setProgress(1, 'All ' + files.length + ' files decrypted. Click a name to save it:');
+}
+
+// A single file, into `sink`.
+async function downloadFile(fileUrl, cryptoKey, sink, pool) {
+    const response = await fetch(fileUrl);
+    if (!response.ok) {
+        throw new Error('Could not fetch file from server.');
+    }
+    const reader = resumableReader(fileUrl, response, 5);
+    const started = performance.now();
+    reader.onProgress = (bytes) => {
+        setProgress(reader.total ? bytes / reader.total : 0, 'Downloading and decrypting... ' +
+                    formatRate(bytes, (performance.now() - started) / 1000));
+    };
+    await decryptResponse(reader, cryptoKey, sink, pool);
+    // We have all of it; let the server delete the file now.
+    fetch(fileUrl, { method: 'DELETE' }).catch(() => {});
 }
 
 async function downloadAndDecrypt() {
     const hash = window.location.hash.substring(1);
     const params = new URLSearchParams(hash);
-    const keyHex = params.get('key');
-    if (!keyHex) {
+    const keyText = params.get('key');
+    if (!keyText) {
         document.getElementById("status").innerText = 'Error: No encryption key provided in URL.';
         return;
     }
-    
+
     // Remove the key from the URL for security
     window.history.replaceState(null, '', window.location.pathname);
-    
+
     const pathParts = window.location.pathname.split('/');
     const fileId = pathParts[pathParts.length - 1];
-    
+
     // Import the encryption key
-    const keyBytes = hexToBytes(keyHex);
+    const keyBytes = keyToBytes(keyText);
     const cryptoKey = await crypto.subtle.importKey(
         'raw',
         keyBytes,
@@ -373,52 +1232,166 @@ async function downloadAndDecrypt() {
         false,
         ['decrypt']
     );
-    
-    // This placeholder will be replaced in the route handler:
-    const encryptedFilename = "__ENCRYPTED_FILENAME__";
+
+    // Filled in by the download template in the route handler:
+    // [encrypted name, start, end] per file.
+    const files = JSON.parse(document.getElementById('files').textContent);
+    const fileUrl = '/file/' + fileId;
+    if (files.length > 1) {
+        const pool = decryptionPool();
+        try {
+            await downloadBatch(fileUrl, files, cryptoKey, pool);
+            // We have all of it; let the server delete the files now.
+            fetch(fileUrl, { method: 'DELETE' }).catch(() => {});
+        } catch (e) {
+            document.getElementById("status").innerText = 'Error during download: ' + e;
+        } finally {
+            pool.close();
+        }
+        return;
+    }
+
     let decryptedFilename;
     try {
-        decryptedFilename = await decryptFilename(encryptedFilename, cryptoKey);
+        decryptedFilename = await decryptFilename(files[0][0], cryptoKey);
     } catch (e) {
         document.getElementById("status").innerText = 'Error decrypting filename: ' + e;
         return;
     }
-    
-    // Fetch the encrypted file
-    const response = await fetch('/file/' + fileId);
-    if (!response.ok) {
-        document.getElementById("status").innerText = 'Error: Could not fetch file from server.';
+
+    const pool = decryptionPool();
+    if (window.showSaveFilePicker) {
+        // Stream to disk. The picker needs a user gesture, so wait for a
+        // click; nothing is fetched (and the share is not used up) before.
+        const button = document.getElementById("saveButton");
+        document.getElementById("status").innerText = 'Ready to download ' + decryptedFilename + '.';
+        button.style.display = "inline-block";
+        button.onclick = async () => {
+            let sink;
+            try {
+                sink = await fileSink(await window.showSaveFilePicker({ suggestedName: decryptedFilename }));
+            } catch (e) {
+                return;  // Picker cancelled.
+            }
+            button.style.display = "none";
+            try {
+                await downloadFile(fileUrl, cryptoKey, sink, pool);
+                setProgress(1, 'Saved ' + decryptedFilename + '.');
+            } catch (e) {
+                sink.abort().catch(() => {});
+                document.getElementById("status").innerText = 'Error during download: ' + e;
+            } finally {
+                pool.close();
+            }
+        };
         return;
     }
-    const encryptedArrayBuffer = await response.arrayBuffer();
-    
-    // The file structure is: [12-byte IV][ciphertext]
-    const iv = encryptedArrayBuffer.slice(0, 12);
-    const ciphertext = encryptedArrayBuffer.slice(12);
-    
+
     try {
-        const decryptedBuffer = await crypto.subtle.decrypt(
-            { name: 'AES-GCM', iv: new Uint8Array(iv) },
-            cryptoKey,
-            ciphertext
-        );
-        
-        const decryptedBlob = new Blob([decryptedBuffer]);
-        const downloadUrl = URL.createObjectURL(decryptedBlob);
-        const a = document.createElement('a');
-        a.href = downloadUrl;
-        a.download = decryptedFilename;
-        document.body.appendChild(a);
-        a.click();
-        a.remove();
-        document.getElementById("status").innerText = 'Download started.';
+        const sink = blobSink();
+        await downloadFile(fileUrl, cryptoKey, sink, pool);
+        saveBlob(sink.blob(), decryptedFilename);
+        setProgress(1, 'Download started.');
     } catch (e) {
-        document.getElementById("status").innerText = 'Error during decryption: ' + e;
+        document.getElementById("status").innerText = 'Error during download: ' + e;
+    } finally {
+        pool.close();
     }
 }
 
 downloadAndDecrypt();
-</script>
+"""
+
+DOWNLOAD_HTML = """
+<!doctype html>
+<html>
+<head>
+  <title>Secure Share - Download</title>
+  <!-- Bootstrap CSS -->
+  <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
+  <!-- Font Awesome for icons -->
+  <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/5.15.3/css/all.min.css">
+  <!-- Google Fonts -->
+  <link rel="preconnect" href="https://fonts.gstatic.com">
+  <link href="https://fonts.googleapis.com/css2?family=Poppins:wght@300;400;600&display=swap" rel="stylesheet">
+  <link rel="stylesheet" href="{{ assets['site.css'] }}">
+</head>
+<body class="page-download">
+""" + NAVBAR_HTML + """
+  <div class="container">
+    <div class="card shadow-sm">
+      <div class="card-header">
+        <h4 class="mb-0"><i class="fas fa-file-download"></i> Decrypt & Download File</h4>
+      </div>
+      <div class="card-body">
+        <p id="status" class="mb-0">Preparing your download...</p>
+        <div id="progressContainer" class="progress mt-3" style="display:none;">
+          <div id="progressBar" class="progress-bar progress-bar-striped progress-bar-animated"
+               role="progressbar" style="width: 0%"></div>
+        </div>
+        <button id="saveButton" type="button" class="btn btn-success mt-3" style="display:none;">
+          <i class="fas fa-save"></i> Save File
+        </button>
+        <a href="/" class="btn btn-link mt-3">← Return Home</a>
+      </div>
+    </div>
+  </div>
+
+  <!-- Bootstrap JS -->
+  <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
+  <script src="https://cdn.jsdelivr.net/npm/bootstrap@4.5.2/dist/js/bootstrap.bundle.min.js"></script>
+
+<script id="files" type="application/json">{{ files|tojson }}</script>
+<script src="{{ assets['common.js'] }}"></script>
+<script src="{{ assets['download.js'] }}"></script>
+
+<footer>
+  <small>© 2025 Secure Share. All rights reserved.</small>
+</footer>
+</body>
+</html>
+"""
+
+# Asked for before the download page of a password-protected share. Posts
+# to the page's own URL; the browser keeps the #key fragment through the
+# redirect that follows.
+PASSWORD_HTML = """
+<!doctype html>
+<html>
+<head>
+  <title>Secure Share - Password</title>
+  <!-- Bootstrap CSS -->
+  <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
+  <!-- Font Awesome for icons -->
+  <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/5.15.3/css/all.min.css">
+  <!-- Google Fonts -->
+  <link rel="preconnect" href="https://fonts.gstatic.com">
+  <link href="https://fonts.googleapis.com/css2?family=Poppins:wght@300;400;600&display=swap" rel="stylesheet">
+  <link rel="stylesheet" href="{{ assets['site.css'] }}">
+</head>
+<body class="page-download">
+""" + NAVBAR_HTML + """
+  <div class="container">
+    <div class="card shadow-sm">
+      <div class="card-header">
+        <h4 class="mb-0"><i class="fas fa-key"></i> Password Required</h4>
+      </div>
+      <div class="card-body">
+        <form method="post">
+          <div class="form-group">
+            <label for="passwordInput">This share is protected. Enter its password:</label>
+            <input type="password" class="form-control" id="passwordInput" name="password"
+                   autocomplete="off" required autofocus>
+          </div>
+          {% if error %}<p class="text-danger">{{ error }}</p>{% endif %}
+          <button type="submit" class="btn btn-success">
+            <i class="fas fa-unlock"></i> Continue
+          </button>
+          <a href="/" class="btn btn-link">← Return Home</a>
+        </form>
+      </div>
+    </div>
+  </div>
 
 <footer>
   <small>© 2025 Secure Share. All rights reserved.</small>
@@ -442,37 +1415,9 @@ HELP_HTML = """
   <!-- Google Fonts -->
   <link rel="preconnect" href="https://fonts.gstatic.com">
   <link href="https://fonts.googleapis.com/css2?family=Poppins:wght@300;400;600&display=swap" rel="stylesheet">
-  <style>
-    body {
-      margin: 0;
-      padding: 0;
-      background: linear-gradient(135deg, #ffffff 0%, #f2f2f2 100%);
-      font-family: 'Poppins', sans-serif;
-    }
-    .navbar {
-      background: linear-gradient(45deg, #3b5998, #8b9dc3);
-    }
-    .card {
-      max-width: 600px; 
-      margin: 40px auto;
-      border-radius: 8px;
-      box-shadow: 0 0 20px rgba(0,0,0,0.05);
-    }
-    .card-header {
-      border-top-left-radius: 8px;
-      border-top-right-radius: 8px;
-      background: #17a2b8;
-      color: #fff;
-      font-weight: 600;
-    }
-    footer {
-      text-align: center;
-      margin: 40px 0 20px;
-      color: #999;
-    }
-  </style>
+  <link rel="stylesheet" href="{{ assets['site.css'] }}">
 </head>
-<body>
+<body class="page-help">
 """ + NAVBAR_HTML + """
   <div class="container">
     <div class="card shadow-sm">
@@ -488,7 +1433,9 @@ HELP_HTML = """
           <li>The recipient opens the link, decrypts the file in their browser, and downloads it.</li>
         </ol>
         <p class="mt-3">
-          Your file is removed from our server as soon as it’s downloaded (one-time download). 
+          Your file is removed from our server as soon as it’s downloaded (one-time download),
+          unless you allow more downloads when uploading it. You can also set a password that
+          the recipient must enter before downloading.
           The original filename is never stored in plaintext on our servers.
         </p>
         <a href="/" class="btn btn-primary mt-3"><i class="fas fa-home"></i> Back to Home</a>
@@ -510,77 +1457,308 @@ HELP_HTML = """
 ###############################################################################
 # 5) ROUTES & LOGIC
 ###############################################################################
-@app.route('/')
+class SitePages:
+    # The stylesheet and scripts are static assets under fingerprinted
+    # names, cached by browsers for good. The index and help pages are
+    # identical for every visitor, so they are kept as pre-compressed bytes
+    # too; the download page only differs by the list of files, so its
+    # template is compiled once and rendered with that variable. Each is
+    # built on first use, so an instance that only ever serves API calls or
+    # files never compiles a template; warmup() builds them all before the
+    # workers fork.
+
+    def __init__(self, jinja_env):
+        self.jinja_env = jinja_env
+
+    @functools.cached_property
+    def assets(self):
+        return {asset.name: asset for asset in (
+            StaticAsset('site.css', SITE_CSS, 'text/css'),
+            StaticAsset('common.js', COMMON_JS, 'text/javascript'),
+            StaticAsset('upload.js', UPLOAD_JS, 'text/javascript'),
+            StaticAsset('download.js', DOWNLOAD_JS, 'text/javascript'),
+        )}
+
+    @functools.cached_property
+    def asset_urls(self):
+        return {asset.source: '/assets/' + name for name, asset in self.assets.items()}
+
+    @functools.cached_property
+    def index(self):
+        return StaticPage(self.jinja_env.from_string(INDEX_HTML).render(assets=self.asset_urls))
+
+    @functools.cached_property
+    def help(self):
+        return StaticPage(self.jinja_env.from_string(HELP_HTML).render(assets=self.asset_urls))
+
+    @functools.cached_property
+    def download_template(self):
+        return self.jinja_env.from_string(DOWNLOAD_HTML, globals={'assets': self.asset_urls})
+
+    @functools.cached_property
+    def password_template(self):
+        return self.jinja_env.from_string(PASSWORD_HTML, globals={'assets': self.asset_urls})
+
+    def build(self):
+        # Everything, with every compressed variant.
+        for page in list(self.assets.values()) + [self.index, self.help]:
+            page.compress()
+        for name in ('download_template', 'password_template'):
+            getattr(self, name)
+
+def start_threads():
+    # The reaper and the metrics flush thread. Started from the first request
+    # rather than at import so that, with gunicorn --preload, they exist in
+    # each worker, not the master.
+    reaper.start()
+    registry.start()
+    save_index_at_exit()
+
+def index_snapshot_path(config):
+    # Only an index kept in memory needs a snapshot; see sidecars.py.
+    if config['METADATA_BACKEND'] != 'memory':
+        return None
+    return config['INDEX_SNAPSHOT_PATH']
+
+_snapshot_pid = None
+
+def save_index_at_exit():
+    # Save the memory index when this process exits. Registered by the
+    # process serving requests: with gunicorn --preload, the master's copy
+    # of the index goes stale once the worker is forked.
+    global _snapshot_pid
+    path = index_snapshot_path(app.config)
+    if path is None or _snapshot_pid == os.getpid():
+        return
+    _snapshot_pid = os.getpid()
+    atexit.register(save_snapshot, metadata_store.store, path)
+
+def instrumented(wsgi_app):
+    # Request metrics, recorded around the Flask app when it starts the
+    # response: time to the response headers (bodies stream after this),
+    # status and bytes. Unlike request hooks, this costs no Flask context
+    # lookups on every request.
+    def instrumented_app(environ, start_response):
+        started = time.perf_counter()
+
+        def recording_start_response(status, headers, exc_info=None):
+            flask_request = environ.get('werkzeug.request')
+            endpoint = (flask_request and flask_request.endpoint) or 'none'
+            registry.observe(REQUEST_DURATION, time.perf_counter() - started, endpoint=endpoint)
+            registry.inc(REQUESTS, endpoint=endpoint, status=int(status[:3]))
+            received = environ.get('CONTENT_LENGTH')
+            if received and received.isascii() and received.isdigit() and received != '0':
+                registry.inc(RECEIVED_BYTES, int(received), endpoint=endpoint)
+            for name, value in headers:
+                if name.lower() == 'content-length':
+                    if value.isascii() and value.isdigit() and value != '0':
+                        registry.inc(SENT_BYTES, int(value), endpoint=endpoint)
+                    break
+            return start_response(status, headers, exc_info)
+
+        return wsgi_app(environ, recording_start_response)
+    return instrumented_app
+
+def staging_path(file_id, suffix):
+    return blob_path(app.config['UPLOAD_FOLDER'], file_id, app.config['UPLOAD_FANOUT'],
+                     suffix, create=True)
+
+def requested_ttl():
+    # TTL for a new upload: the 'ttl' form field if given, else DEFAULT_TTL.
+    # Returns None if the value is invalid.
+    ttl = request.form.get('ttl')
+    if not ttl:
+        return app.config['DEFAULT_TTL']
+    try:
+        ttl = int(ttl)
+    except ValueError:
+        return None
+    if ttl <= 0 or ttl > app.config['MAX_TTL']:
+        return None
+    return ttl
+
+def requested_max_downloads():
+    # The 'max_downloads' form field (default 1), or None if it is invalid.
+    value = request.form.get('max_downloads')
+    if not value:
+        return 1
+    try:
+        value = int(value)
+    except ValueError:
+        return None
+    if value < 1 or value > app.config['MAX_DOWNLOADS']:
+        return None
+    return value
+
+def requested_password_hash():
+    # scrypt hash of the 'password' form field, or None without one. Raises
+    # ValueError for an invalid password, PasswordHasherBusy if the hasher
+    # is overloaded.
+    password = request.form.get('password')
+    if not password:
+        return None
+    if len(password) > app.config['MAX_PASSWORD_LENGTH']:
+        raise ValueError("Password is too long")
+    return password_hasher.hash(password)
+
+def service_busy(message):
+    response = app.response_class(message, status=503)
+    response.headers['Retry-After'] = '1'
+    return response
+
+def client_address(environ):
+    # A request handed off by another node comes from that node; it names the
+    # client in X-Forwarded-For.
+    headers = EnvironHeaders(environ)
+    if cluster.is_forwarded(headers):
+        return headers.get('X-Forwarded-For') or environ.get('REMOTE_ADDR') or ''
+    return environ.get('REMOTE_ADDR') or ''
+
+def current_client():
+    return client_key(client_address(request.environ), client_secret)
+
+def too_many_requests(message, wait):
+    response = app.response_class(message, status=429)
+    if wait is not None:
+        response.headers['Retry-After'] = str(max(1, int(wait + 0.999)))
+    return response
+
+def rate_limited(view):
+    # Apply the per-client requests-per-second limit to a view.
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        # A request handed off by another node was limited there.
+        if app.config['REQUESTS_PER_SECOND'] and not cluster.is_forwarded(request.headers):
+            wait = rate_limiter.take(current_client() + ':requests', 1,
+                                     app.config['REQUESTS_PER_SECOND'],
+                                     app.config['REQUEST_BURST'])
+            if wait:
+                return too_many_requests("Too many requests.", wait)
+        return view(*args, **kwargs)
+    return wrapper
+
+def handed_off(redirect=False):
+    # Send requests for a share that another node owns to that node: a
+    # redirect (if `redirect` and HANDOFF_MODE allow it) or a proxied fetch.
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            node = cluster.owner(kwargs.get('file_id') or kwargs.get('upload_id'))
+            if node is None or cluster.is_forwarded(request.headers):
+                return view(*args, **kwargs)
+            if redirect and app.config['HANDOFF_MODE'] == 'redirect':
+                registry.inc(HANDOFFS, mode='redirect')
+                return app.redirect(cluster.public_url(node, request.path,
+                                                       request.query_string.decode('latin-1')),
+                                    code=307)
+            registry.inc(HANDOFFS, mode='proxy')
+            body = request.stream if request.content_length else None
+            try:
+                status, headers, stream = cluster.forward(
+                    node, request.method, request.full_path.rstrip('?'), request.headers, body,
+                    request.remote_addr)
+            except ProxyError:
+                return "The node holding this share is unavailable.", 502
+            return app.response_class(stream, status=status, headers=headers,
+                                      direct_passthrough=True)
+        return wrapper
+    return decorator
+
+# Endpoint -> whether the body is also spooled to the temporary folder
+# before the view stores it, for the views under @admitted.
+admitted_endpoints = {}
+
+def admitted(spooled=False):
+    # Admit an upload against the disk watermarks before its body is read;
+    # see admission.py. `spooled`: the body goes through the temporary
+    # folder (a multipart form) on its way to storage. The reservation is
+    # held until the view returns, by which time the body is stored.
+    def decorator(view):
+        admitted_endpoints[view.__name__] = spooled
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # A server that spools bodies (asgi.py) has admitted it already.
+            admission = request.environ.get(ADMISSION_ENVIRON_KEY)
+            if admission is None:
+                size = request.content_length or app.config['MAX_CONTENT_LENGTH']
+                try:
+                    admission = upload_admission.admit(current_client(), size,
+                                                       size if spooled else 0)
+                except Rejected as e:
+                    return upload_rejected(e)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                admission.release()
+        return wrapper
+    return decorator
+
+def upload_rejected(error):
+    response = app.response_class(str(error), status=503)
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def upload_attempt(environ):
+    # For servers that receive the whole body before calling the app
+    # (asgi.py): an Attempt to admit the request, judged from its headers,
+    # or None if it is not an upload. Its Admission goes to the view under
+    # ADMISSION_ENVIRON_KEY.
+    try:
+        endpoint, _ = app.url_map.bind_to_environ(environ).match()
+    except HTTPException:
+        return None
+    if endpoint not in admitted_endpoints:
+        return None
+    size = int(environ.get('CONTENT_LENGTH') or 0) or app.config['MAX_CONTENT_LENGTH']
+    # The server spools the body, and a multipart form is spooled again.
+    spooled = size * (2 if admitted_endpoints[endpoint] else 1)
+    return upload_admission.attempt(client_key(client_address(environ), client_secret),
+                                    size, spooled)
+
+def check_upload_quota(owner, size):
+    # Error response if storing `size` more bytes would put the client over
+    # its quotas, else None.
+    limit = app.config['MAX_STORED_BYTES']
+    if limit and metadata_store.stored_bytes(owner) + size > limit:
+        return "Storage quota exceeded; wait for your shares to be downloaded or expire.", 429
+    daily = app.config['UPLOAD_BYTES_PER_DAY']
+    if daily:
+        wait = rate_limiter.take(owner + ':bytes', size, daily / 86400.0, daily)
+        if wait is None:
+            return "Upload is larger than the daily quota.", 413
+        if wait:
+            return too_many_requests("Daily upload quota exceeded.", wait)
+    return None
+
+def is_expired(file_info):
+    return file_info['expires_at'] is not None and file_info['expires_at'] <= time.time()
+
+@route('/')
 def index():
-    return render_template_string(INDEX_HTML)
+    return pages.index.response(request, app.response_class)
 
-@app.route('/help')
+@route('/help')
 def help_page():
-    return render_template_string(HELP_HTML)
+    return pages.help.response(request, app.response_class)
 
-@app.route('/upload', methods=['POST'])
-def upload():
-    if 'file' not in request.files:
-        return "Missing file", 400
-    file = request.files['file']
-    if file.filename == '':
-        return "No selected file", 400
-    
-    # Generate a unique file identifier
-    file_id = str(uuid.uuid4())
-    random_filename = file_id + ".enc"  # Obfuscate the file on disk
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], random_filename)
-    file.save(file_path)
-    
-    encrypted_filename = request.form.get('encrypted_filename')
-    if not encrypted_filename:
-        return "Missing encrypted filename", 400
-    
-    files_data[file_id] = {
-        'encrypted_filename': encrypted_filename,
-        'filepath': file_path,
-        'downloaded': False
-    }
-    
+@route('/assets/<name>')
+def static_asset(name):
+    asset = pages.assets.get(name)
+    if asset is None:
+        return "Not found.", 404
+    return asset.response(request, app.response_class)
+
+def upload_result_html(file_id, max_downloads=1, password=False):
     download_url = request.url_root.rstrip("/") + url_for("download_page", file_id=file_id)
-    
-    # Use the Async Clipboard API fallback approach
-    # We do NOT use an f-string for the large HTML block, but a normal string + .format()
-    copy_js = """
-<script>
-async function copyLink() {
-  const linkElement = document.getElementById('downloadURL');
-  const linkText = linkElement.value;
-  
-  if (navigator.clipboard && window.isSecureContext) {
-    // Modern Async Clipboard API
-    try {
-      await navigator.clipboard.writeText(linkText);
-      alert("Download link copied to clipboard!");
-    } catch (e) {
-      console.error(e);
-      alert("Unable to copy link. Please copy manually.");
-    }
-  } else {
-    // Fallback for older browsers
-    linkElement.select();
-    linkElement.setSelectionRange(0, 99999);
-    try {
-      document.execCommand('copy');
-      alert("Download link copied to clipboard!");
-    } catch (e) {
-      console.error(e);
-      alert("Unable to copy link. Please copy manually.");
-    }
-  }
-}
-</script>
-"""
+    usage = "one-time use" if max_downloads == 1 else "up to %d downloads" % max_downloads
+    if password:
+        usage += ", password required"
 
     # Build the HTML response with .format() for the download URL
     message = (
         "<h2>File Uploaded Successfully!</h2>"
-        "<p>Download URL (one-time use):</p>"
+        f"<p>Download URL ({usage}):</p>"
         "<div class='input-group mb-3'>"
         f"<input type='text' id='downloadURL' class='form-control' value='{download_url}#key=YOUR_ENCRYPTION_KEY' readonly>"
         "<div class='input-group-append'>"
@@ -589,37 +1767,642 @@ async function copyLink() {
         "</button>"
         "</div>"
         "</div>"
-        + copy_js
     )
     return message
 
-@app.route('/download/<file_id>')
+def requested_filename():
+    # Raw encrypted filename from the form, or raise FilenameError.
+    encrypted_filename = request.form.get('encrypted_filename')
+    if not encrypted_filename:
+        raise FilenameError("Missing encrypted filename")
+    return parse_encrypted_filename(encrypted_filename)
+
+@route('/upload', methods=['POST'])
+@rate_limited
+@admitted(spooled=True)
+def upload():
+    # One file, or a batch: repeated 'file', 'encrypted_filename' and 'size'
+    # fields, in the same order, stored as one share (see manifest.py).
+    # Validate everything before anything is written to storage.
+    files = request.files.getlist('file')
+    if not files:
+        return "Missing file", 400
+    if len(files) > app.config['MAX_BATCH_FILES']:
+        return "Too many files (at most %d)" % app.config['MAX_BATCH_FILES'], 400
+    if any(file.filename == '' for file in files):
+        return "No selected file", 400
+    names = request.form.getlist('encrypted_filename')
+    if not names:
+        return "Missing encrypted filename", 400
+    if len(names) != len(files):
+        return "Expected one encrypted filename per file", 400
+    try:
+        encrypted_filenames = [parse_encrypted_filename(name) for name in names]
+    except FilenameError as e:
+        return str(e), 400
+    ttl = requested_ttl()
+    if ttl is None:
+        return "Invalid ttl", 400
+    max_downloads = requested_max_downloads()
+    if max_downloads is None:
+        return "Invalid max_downloads", 400
+    declared = request.form.getlist('size')
+    if declared and len(declared) != len(files):
+        return "Expected one size per file", 400
+    
+    # Check each container header against the size of its uploaded body and,
+    # if the client declared one, against that.
+    sizes = []
+    for i, file in enumerate(files):
+        header = file.stream.read(HEADER_SIZE)
+        size = file.stream.seek(0, os.SEEK_END)
+        file.stream.seek(0)
+        if declared and declared[i] != str(size):
+            return "Upload should be %s bytes, got %d" % (declared[i], size), 400
+        try:
+            validate_container(header, size)
+        except ContainerError as e:
+            return "Invalid encrypted file: %s" % e, 400
+        sizes.append(size)
+    try:
+        password_hash = requested_password_hash()
+    except ValueError as e:
+        return str(e), 400
+    except PasswordHasherBusy:
+        return service_busy("Server busy, try again.")
+    size = sum(sizes)
+    owner = current_client()
+    error = check_upload_quota(owner, size)
+    if error:
+        return error
+    
+    # Generate a unique file identifier
+    file_id = cluster.new_id()
+    # Obfuscate the file on disk, hashing it on the way. A batch is stored
+    # as its files' containers back to back.
+    file_path = storage.location(file_id)
+    reader = DigestReader(ConcatReader(file.stream for file in files))
+    started = time.perf_counter()
+    storage.put(file_path, reader, size)
+    registry.observe(STORAGE_WRITE_DURATION, time.perf_counter() - started)
+    if reader.bytes_read != size:
+        storage.delete(file_path)
+        return "Incomplete upload", 400
+    
+    if len(files) == 1:
+        encrypted_filename, manifest = encrypted_filenames[0], None
+    else:
+        encrypted_filename, manifest = b'', encode_manifest(list(zip(encrypted_filenames, sizes)))
+    now = time.time()
+    metadata_store.add(file_id, {
+        'encrypted_filename': encrypted_filename,
+        'filepath': file_path,
+        'downloaded': False,
+        'created_at': now,
+        'expires_at': now + ttl,
+        'size': size,
+        'sha256': reader.digest(),
+        'owner': owner,
+        'manifest': manifest,
+        'max_downloads': max_downloads,
+        'password_hash': password_hash,
+    })
+    
+    return upload_result_html(file_id, max_downloads, password_hash is not None)
+
+def chunk_count(session):
+    return -(-session['size'] // session['chunk_size'])
+
+@route('/upload/start', methods=['POST'])
+@rate_limited
+def upload_start():
+    # Begin a chunked upload. The client then PUTs each chunk's raw bytes to
+    # /upload/<id>/chunk/<n> (in any order, retrying as needed) and finally
+    # POSTs /upload/<id>/finish. GET /upload/<id> reports which chunks the
+    # server already has, so an interrupted upload can be resumed.
+    try:
+        encrypted_filename = requested_filename()
+    except FilenameError as e:
+        return str(e), 400
+    try:
+        size = int(request.form.get('size', ''))
+    except ValueError:
+        return "Missing or invalid size", 400
+    if size > app.config['MAX_UPLOAD_SIZE']:
+        return "Invalid size", 413
+    if size < HEADER_SIZE:
+        return "Invalid size", 400
+    ttl = requested_ttl()
+    if ttl is None:
+        return "Invalid ttl", 400
+    max_downloads = requested_max_downloads()
+    if max_downloads is None:
+        return "Invalid max_downloads", 400
+    try:
+        password_hash = requested_password_hash()
+    except ValueError as e:
+        return str(e), 400
+    except PasswordHasherBusy:
+        return service_busy("Server busy, try again.")
+    owner = current_client()
+    error = check_upload_quota(owner, size)
+    if error:
+        return error
+    
+    upload_id = cluster.new_id()
+    part_path = staging_path(upload_id, PART_SUFFIX)
+    with open(part_path, 'wb') as f:
+        f.truncate(size)
+    
+    session = {
+        'encrypted_filename': encrypted_filename,
+        'filepath': part_path,
+        'size': size,
+        'chunk_size': app.config['UPLOAD_CHUNK_SIZE'],
+        'ttl': ttl,
+        'expires_at': time.time() + app.config['UPLOAD_SESSION_TTL'],
+        'owner': owner,
+        'max_downloads': max_downloads,
+        'password_hash': password_hash,
+    }
+    metadata_store.create_upload(upload_id, session)
+    return jsonify(upload_id=upload_id, chunk_size=session['chunk_size'],
+                   chunks=chunk_count(session))
+
+@route('/upload/<upload_id>', methods=['GET'])
+@rate_limited
+@handed_off()
+def upload_status(upload_id):
+    session = metadata_store.get_upload(upload_id)
+    if not session:
+        return "Upload not found.", 404
+    return jsonify(upload_id=upload_id, size=session['size'], chunk_size=session['chunk_size'],
+                   chunks=chunk_count(session), received=session['received'])
+
+@route('/upload/<upload_id>/chunk/<int:chunk>', methods=['PUT'])
+@rate_limited
+@handed_off()
+@admitted()
+def upload_chunk(upload_id, chunk):
+    session = metadata_store.get_upload(upload_id)
+    if not session:
+        return "Upload not found.", 404
+    if chunk >= chunk_count(session):
+        return "Chunk out of range", 400
+    
+    offset = chunk * session['chunk_size']
+    expected = min(session['chunk_size'], session['size'] - offset)
+    if request.content_length != expected:
+        return "Chunk %d must be exactly %d bytes" % (chunk, expected), 400
+    
+    # The first chunk starts with the container header: check it against the
+    # declared size before writing anything.
+    reader = DigestReader(request.stream)
+    header = b''
+    if chunk == 0:
+        header = read_exact(reader, HEADER_SIZE)
+        try:
+            validate_container(header, session['size'])
+        except ContainerError as e:
+            return "Invalid encrypted file: %s" % e, 400
+    
+    # Stream the body straight to its place in the part file, hashing it on
+    # the way. A retried chunk simply overwrites the same byte range.
+    with open(session['filepath'], 'r+b') as f:
+        f.seek(offset)
+        f.write(header)
+        written = len(header) + copy_stream(reader, f, expected - len(header),
+                                            app.config['COPY_BUFFER_SIZE'])
+    if written != expected:
+        return "Incomplete chunk", 400
+    
+    metadata_store.mark_chunk(upload_id, chunk, reader.digest())
+    return "", 204
+
+@route('/upload/<upload_id>/finish', methods=['POST'])
+@rate_limited
+@handed_off()
+def upload_finish(upload_id):
+    session = metadata_store.get_upload(upload_id)
+    if not session:
+        return "Upload not found.", 404
+    missing = sorted(set(range(chunk_count(session))) - set(session['received']))
+    if missing:
+        return jsonify(error="Upload incomplete", missing=missing), 409
+    
+    # Chunks arrive in any order, so each was hashed on its own as it was
+    # written; the file's digest is taken over theirs, in order, without
+    # reading it again. Chunks stored by older versions have no digest.
+    with open(session['filepath'], 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    sha256 = None
+    if None not in session['digests']:
+        sha256 = hashlib.sha256(b''.join(session['digests'])).digest()
+    try:
+        validate_container(header, session['size'])
+    except ContainerError as e:
+        os.remove(session['filepath'])
+        metadata_store.delete_upload(upload_id)
+        return "Invalid encrypted file: %s" % e, 400
+    
+    file_path = storage.location(upload_id)
+    try:
+        started = time.perf_counter()
+        storage.put_file(file_path, session['filepath'])
+        registry.observe(STORAGE_WRITE_DURATION, time.perf_counter() - started)
+    except FileNotFoundError:
+        # A concurrent finish call got here first.
+        return "Upload not found.", 404
+    now = time.time()
+    metadata_store.add(upload_id, {
+        'encrypted_filename': session['encrypted_filename'],
+        'filepath': file_path,
+        'downloaded': False,
+        'created_at': now,
+        'expires_at': now + (session['ttl'] or app.config['DEFAULT_TTL']),
+        'size': session['size'],
+        'sha256': sha256,
+        'sha256_chunk_size': session['chunk_size'] if sha256 is not None else None,
+        'owner': session['owner'],
+        'max_downloads': session['max_downloads'],
+        'password_hash': session['password_hash'],
+    })
+    metadata_store.delete_upload(upload_id)
+    
+    return upload_result_html(upload_id, session['max_downloads'],
+                              session['password_hash'] is not None)
+
+def has_access(file_id):
+    # Whether the request carries an access token for the share, i.e. its
+    # password was entered recently.
+    return check_access_token(client_secret, file_id, request.cookies.get('share_access'))
+
+def password_attempt_wait(file_id):
+    # Seconds until this client may guess the share's password again (0: now).
+    # Both limits are applied on the node that owns the share, which knows a
+    # forwarded request's client from X-Forwarded-For.
+    limits = [(file_id + ':password', app.config['SHARE_PASSWORD_ATTEMPTS_PER_MINUTE']),
+              (current_client() + ':password', app.config['PASSWORD_ATTEMPTS_PER_MINUTE'])]
+    for key, per_minute in limits:
+        if per_minute:
+            wait = rate_limiter.take(key, 1, per_minute / 60.0, per_minute)
+            if wait:
+                return wait
+    return 0
+
+def password_page(file_id, file_info):
+    # The password form of a protected share. A POST checks the password
+    # and, if it is right, sends the client back to the download page with
+    # an access cookie, valid for the page and the file.
+    error = None
+    if request.method == 'POST':
+        wait = password_attempt_wait(file_id)
+        if wait:
+            return too_many_requests("Too many password attempts.", wait)
+        password = request.form.get('password', '')[:app.config['MAX_PASSWORD_LENGTH']]
+        try:
+            correct = password_hasher.verify(password, file_info['password_hash'])
+        except PasswordHasherBusy:
+            registry.inc(PASSWORD_CHECKS, result='busy')
+            return service_busy("Server busy, try again.")
+        registry.inc(PASSWORD_CHECKS, result='ok' if correct else 'wrong')
+        if correct:
+            # 303 to the same page: the browser keeps the #key fragment.
+            response = app.redirect(url_for('download_page', file_id=file_id), code=303)
+            token = access_token(client_secret, file_id, app.config['ACCESS_TOKEN_LIFETIME'])
+            for path in (url_for('download_page', file_id=file_id), download_cookie_path(file_id)):
+                response.set_cookie('share_access', token, path=path,
+                                    max_age=app.config['ACCESS_TOKEN_LIFETIME'],
+                                    secure=request.is_secure, httponly=True, samesite='Strict')
+            return response
+        error = "Wrong password."
+    response = html_response(request, app.response_class, pages.password_template.render(error=error))
+    if error:
+        response.status_code = 403
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@route('/download/<file_id>', methods=['GET', 'POST'])
+@rate_limited
+@handed_off(redirect=True)
 def download_page(file_id):
-    if file_id not in files_data:
+    file_info = metadata_store.get(file_id)
+    if not file_info or file_info['downloaded'] or is_expired(file_info):
         return "File not found or already downloaded.", 404
+    if file_info.get('password_hash') and not has_access(file_id):
+        return password_page(file_id, file_info)
     
-    # Insert the encrypted filename into the download HTML
-    page_html = DOWNLOAD_HTML.replace("__ENCRYPTED_FILENAME__", files_data[file_id]['encrypted_filename'])
-    return render_template_string(page_html)
+    # Insert the encrypted filename(s) into the download HTML: one
+    # [name, start, end] per file, where a batch share's files are slices of
+    # its blob. The end of a single file is unknown for old records.
+    if file_info.get('manifest'):
+        files = [[format_encrypted_filename(name), start, end]
+                 for name, start, end in file_ranges(decode_manifest(file_info['manifest']))]
+    else:
+        files = [[format_encrypted_filename(file_info['encrypted_filename']), 0,
+                  file_info['size']]]
+    started = time.perf_counter()
+    page_html = pages.download_template.render(files=files)
+    registry.observe(RENDER_DURATION, time.perf_counter() - started)
+    response = html_response(request, app.response_class, page_html)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def remove_claimed_file(file_id, claimed_path):
+    storage.delete(claimed_path)
+    metadata_store.delete(file_id)
 
-@app.route('/file/<file_id>')
+def download_cookie_path(file_id):
+    return url_for('serve_file', file_id=file_id)
+
+def request_claim(file_id, file_info):
+    # The number of the claim whose download token the request carries, or
+    # None. Records claimed by older versions store their (only) token.
+    token = request.cookies.get('download_token')
+    claim = download_claim(client_secret, file_id, token)
+    if claim is not None and claim <= file_info['downloads']:
+        return claim
+    stored = file_info.get('download_token')
+    if token and stored and token.isascii() and \
+            hmac.compare_digest(token.encode('ascii'), stored.encode('ascii')):
+        return file_info['max_downloads']
+    return None
+
+def claimed_path(file_info):
+    # Where the ciphertext is once the last download has claimed it.
+    if storage.is_local:
+        return file_info['filepath'] + CLAIMED_SUFFIX
+    return file_info['filepath']
+
+def record_claim_delivery(file_id, file_info, claim, size, start, end):
+    # Record that bytes [start, end) reached the holder of claim `claim`, and
+    # delete the share once every claim has had all of it. Claim n's ranges
+    # are recorded shifted by (n - 1) * size, so one set of delivered ranges
+    # covers every claim.
+    offset = (claim - 1) * size
+    if metadata_store.record_delivery(file_id, offset + start, offset + end,
+                                      size * file_info['max_downloads']):
+        remove_claimed_file(file_id, claimed_path(file_info))
+
+def delivery_callback(file_id, file_info, claim, size):
+    # Count the bytes a response sent, across however many (range)
+    # responses a download takes.
+    def delivered(start, end):
+        record_claim_delivery(file_id, file_info, claim, size, start, end)
+    return delivered
+
+def requested_range(size):
+    # (start, end) of the requested byte range, None for the whole file, or
+    # False if the range cannot be satisfied. Multi-range requests get the
+    # whole file.
+    if request.range is None or request.range.units != 'bytes' or len(request.range.ranges) != 1:
+        return None
+    byte_range = request.range.range_for_length(size)
+    return byte_range if byte_range is not None else False
+
+def set_digest(response, file_info):
+    # RFC 9530 digest of the whole file, recorded at upload time. It covers
+    # the full file even in a 206 response. A chunked upload's digest is
+    # over its chunks' digests (see metadata.py), which Repr-Digest has no
+    # algorithm for.
+    if not file_info.get('sha256'):
+        return
+    digest = base64.b64encode(file_info['sha256']).decode('ascii')
+    if file_info.get('sha256_chunk_size'):
+        response.headers['Chunked-Digest'] = 'sha-256=:%s:; chunk-size=%d' % (
+            digest, file_info['sha256_chunk_size'])
+    else:
+        response.headers['Repr-Digest'] = 'sha-256=:%s:' % (digest,)
+
+def download_response(body, size, byte_range):
+    response = app.response_class(body, mimetype='application/octet-stream',
+                                  direct_passthrough=True)
+    response.headers.set('Content-Disposition', 'attachment', filename='encrypted_file')
+    response.headers['Accept-Ranges'] = 'bytes'
+    start, end = byte_range or (0, size)
+    response.content_length = end - start
+    if byte_range:
+        response.status_code = 206
+        response.content_range = ContentRange('bytes', start, end, size)
+    return response
+
+def offload_response(path):
+    # Let the front proxy stream the file; it also handles Range itself.
+    response = app.response_class(mimetype='application/octet-stream')
+    if app.config['FILE_SERVE_MODE'] == 'x-accel-redirect':
+        response.headers['X-Accel-Redirect'] = (
+            app.config['X_ACCEL_REDIRECT_PREFIX'].rstrip('/') + '/'
+            + os.path.relpath(path, app.config['UPLOAD_FOLDER']))
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+    response.headers.set('Content-Disposition', 'attachment', filename='encrypted_file')
+    return response
+
+def local_file_response(file_id, file_info, path, claim):
+    if app.config['FILE_SERVE_MODE'] in OFFLOAD_MODES:
+        return offload_response(path)
+    size = file_info['size']
+    if size is None:
+        size = os.path.getsize(path)
+    byte_range = requested_range(size)
+    if byte_range is False:
+        return range_not_satisfiable(size)
+    start, end = byte_range or (0, size)
+    range_file = RangeFile(path, start, end, delivery_callback(file_id, file_info, claim, size))
+    if app.config['FILE_SERVE_MODE'] == 'stream':
+        body = FileWrapper(range_file, app.config['COPY_BUFFER_SIZE'])
+    else:
+        body = wrap_file(request.environ, range_file, app.config['COPY_BUFFER_SIZE'])
+    return download_response(body, size, byte_range)
+
+def claimed_file_response(file_id, file_info, claim, claiming):
+    file_path = file_info['filepath']
+    if claim >= file_info['max_downloads']:
+        # Move the ciphertext aside when claiming it. rename() is atomic
+        # as well, so the file on disk can never be handed to two clients.
+        if claiming:
+            os.rename(file_path, claimed_path(file_info))
+        return local_file_response(file_id, file_info, claimed_path(file_info), claim)
+    # Earlier downloads of a share read the file where it is, until the last
+    # claim (which may come at any moment) moves it aside.
+    try:
+        return local_file_response(file_id, file_info, file_path, claim)
+    except FileNotFoundError:
+        return local_file_response(file_id, file_info, claimed_path(file_info), claim)
+
+def blob_response(file_id, file_info, file_path, claim):
+    # The recorded size saves a HEAD request to the object store.
+    size = file_info['size']
+    if size is None:
+        size = storage.size(file_path)
+    byte_range = requested_range(size)
+    if byte_range is False:
+        return range_not_satisfiable(size)
+    start, end = byte_range or (0, size)
+    body = storage.get(file_path, start, end)
+    body = DeliveryTracker(body, start, end, delivery_callback(file_id, file_info, claim, size))
+    return download_response(body, size, byte_range)
+
+def range_not_satisfiable(size):
+    response = app.response_class("Requested range not satisfiable.", status=416)
+    response.content_range = ContentRange('bytes', None, None, size)
+    return response
+
+@route('/file/<file_id>')
+@rate_limited
+@handed_off(redirect=True)
 def serve_file(file_id):
-    file_info = files_data.get(file_id)
+    # A request without a download token claims one of the share's downloads
+    # atomically, so no more clients than allowed ever get it, and receives
+    # a token for that claim. Further (Range) requests must present it. A
+    # protected share is only claimed with an access cookie (see
+    # password_page). See serving.py.
+    file_info = metadata_store.get(file_id)
+    claim = request_claim(file_id, file_info) if file_info else None
+    token = None
+    if claim is None:
+        if file_info and not file_info['downloaded'] and file_info.get('password_hash') \
+                and not has_access(file_id):
+            return "Password required.", 403
+        known = file_info is not None
+        file_info = metadata_store.claim(
+            file_id, expires_at=time.time() + app.config['DOWNLOAD_GRACE_PERIOD'])
+        if known and not file_info:
+            registry.inc(CLAIM_CONFLICTS)
+        if file_info:
+            claim = file_info['downloads']
+            token = download_token(client_secret, file_id, claim)
     if not file_info:
         return "File not found or already downloaded.", 404
-    if file_info.get('downloaded'):
-        return "File already downloaded.", 404
-    
-    file_info['downloaded'] = True
-    file_path = file_info['filepath']
-    if os.path.exists(file_path):
-        response = send_file(file_path, as_attachment=True, download_name="encrypted_file")
-        os.remove(file_path)
-        del files_data[file_id]
-        return response
-    else:
+    if is_expired(file_info):
+        # Expired but not reaped yet; the reaper removes the file.
+        return "File not found or already downloaded.", 404
+
+    try:
+        if not storage.is_local:
+            response = blob_response(file_id, file_info, file_info['filepath'], claim)
+        else:
+            response = claimed_file_response(file_id, file_info, claim, token is not None)
+    except FileNotFoundError:
+        # Only the last claim finds out the file is lost: for the others it
+        # may just have been removed, once every claim was delivered.
+        if claim >= file_info['max_downloads']:
+            metadata_store.delete(file_id)
         return "File not found on server.", 404
+    # Ciphertext does not compress; a proxy must neither try nor, as the
+    # Range offsets refer to these exact bytes, change the encoding.
+    response.headers['Cache-Control'] = 'no-store, no-transform'
+    response.headers['Content-Encoding'] = 'identity'
+    set_digest(response, file_info)
+    if token is not None:
+        response.set_cookie('download_token', token, path=download_cookie_path(file_id),
+                            max_age=app.config['DOWNLOAD_GRACE_PERIOD'],
+                            secure=request.is_secure, httponly=True, samesite='Strict')
+    return response
+
+@route('/file/<file_id>', methods=['DELETE'])
+@rate_limited
+@handed_off()
+def acknowledge_download(file_id):
+    # The client has the whole file. Once every download of the share has
+    # been delivered or acknowledged, delete it now rather than at the end of
+    # the grace period.
+    file_info = metadata_store.get(file_id)
+    claim = request_claim(file_id, file_info) if file_info else None
+    if claim is None:
+        return "File not found or already downloaded.", 404
+    size = file_info['size']
+    try:
+        if size is None:
+            path = file_info['filepath']
+            if storage.is_local and not os.path.exists(path):
+                path = claimed_path(file_info)
+            size = storage.size(path)
+    except FileNotFoundError:
+        pass
+    else:
+        record_claim_delivery(file_id, file_info, claim, size, 0, size)
+    response = app.response_class(status=204)
+    response.delete_cookie('download_token', path=download_cookie_path(file_id))
+    return response
+
+@route('/metrics')
+def metrics_page():
+    # Prometheus scrape endpoint. Restrict access to it at the proxy.
+    disk = shutil.disk_usage(app.config['UPLOAD_FOLDER'])
+    in_flight, in_flight_bytes = upload_admission.in_flight()
+    text = registry.render([
+        ('secure_share_pending_files', 'Shares stored and not yet deleted.',
+         metadata_store.count()),
+        ('secure_share_pending_bytes', 'Ciphertext bytes held for pending shares.',
+         metadata_store.total_size()),
+        ('secure_share_upload_disk_free_bytes', 'Free space on the uploads filesystem.',
+         disk.free),
+        ('secure_share_upload_disk_used_bytes', 'Used space on the uploads filesystem.',
+         disk.used),
+        ('secure_share_upload_in_flight', 'Uploads admitted and not yet stored.', in_flight),
+        ('secure_share_upload_in_flight_bytes', 'Bytes reserved by admitted uploads.',
+         in_flight_bytes),
+    ])
+    return app.response_class(text, mimetype='text/plain; version=0.0.4')
+
+@command('rebuild-index')
+def rebuild_index_command():
+    # flask --app app rebuild-index
+    # Add records for sidecars the metadata store does not have, e.g. after
+    # restoring the uploads folder from a backup.
+    restored = rebuild_index(metadata_store.store, sidecars,
+                             os.path.join(app.config['UPLOAD_FOLDER'], 'rebuild.lock'),
+                             workers=app.config['REBUILD_WORKERS'], blob_exists=blob_exists,
+                             force=True)
+    print("Restored %d records." % restored)
+
+@command('build-assets')
+@click.argument('folder')
+def build_assets_command(folder):
+    # flask --app app build-assets /srv/secure-share/assets
+    # Write the static assets with their .gz/.br variants, for a front proxy
+    # serving /assets/ itself (nginx: gzip_static on; brotli_static on;).
+    write_assets(pages.assets.values(), folder)
+    for name in pages.assets:
+        print(name)
+
+@command('migrate-uploads')
+def migrate_uploads_command():
+    # flask --app app migrate-uploads
+    # Move files from a flat uploads folder into the UPLOAD_FANOUT tree.
+    # Stop the app first.
+    moved = migrate_flat_layout(metadata_store, app.config['UPLOAD_FOLDER'],
+                                app.config['UPLOAD_FANOUT'])
+    print("Moved %d files." % moved)
+
+def warmup():
+    # Pre-fork warmup, for gunicorn --preload 'app:warmup()': create the
+    # app, opening storage and the metadata index once, and build every
+    # page and compressed variant in the master. The workers then share all
+    # of it copy-on-write instead of each building its own. The master's
+    # database connections are closed so that no worker inherits them, and
+    # gc.freeze() keeps the collector from touching (and so copying) the
+    # shared objects in the workers.
+    flask_app = __getattr__('app')
+    pages.build()
+    for database in (metadata_store.store, rate_limiter, upload_admission.ledger):
+        database.close()
+    gc.freeze()
+    return flask_app
+
+_create_lock = threading.Lock()
+
+def __getattr__(name):
+    # `app` is created on first access (`from app import app`, gunicorn
+    # app:app, flask --app app), not at import.
+    if name != 'app':
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    with _create_lock:
+        if 'app' not in globals():
+            create_app()
+    return globals()['app']
 
 if __name__ == '__main__':
-    app.run(debug=True, use_reloader=False)
+    create_app().run(debug=True, use_reloader=False)
 
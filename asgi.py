@@ -0,0 +1,213 @@
+import asyncio
+import sys
+import tempfile
+
+from admission import ADMISSION_ENVIRON_KEY, Rejected
+from app import app, upload_attempt
+
+###############################################################################
+# ASGI ENTRY POINT
+#
+#   uvicorn asgi:application --workers 4
+#
+# Runs the same Flask app under an ASGI server (uvicorn, hypercorn, ...), so
+# that slow clients wait on the event loop instead of holding a worker
+# thread. Request bodies are received asynchronously into a spooled temporary
+# file (in memory up to ASGI_SPOOL_SIZE, then on disk) before the view runs;
+# views run in the default thread pool, which they occupy only while doing
+# actual work; and response bodies are pulled from the app one chunk at a time
+# in that pool and sent asynchronously.
+#
+# Because the views are the Flask ones, one-time download semantics (claim,
+# download token, delivery tracking) are unchanged. The 'sendfile' serve mode
+# falls back to a read loop here, as ASGI servers have no wsgi.file_wrapper,
+# so every body is iterated in Python and counts as delivered once it has
+# been read to the end (see serving.py). A body is closed without being read
+# to the end if the client disconnects, so an interrupted transfer never
+# counts.
+#
+# Uploads are admitted (admission.py) from the request headers before the
+# body is received, since spooling it is what fills the disk. While an
+# upload waits in the admission queue the event loop polls it; it holds no
+# thread.
+###############################################################################
+
+
+def _environ(scope, body, length):
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'CONTENT_LENGTH': str(length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    server = scope.get('server') or ('localhost', 80)
+    environ['SERVER_NAME'] = server[0]
+    environ['SERVER_PORT'] = str(server[1])
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        if name != 'CONTENT_TYPE':
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ('; ' if name == 'HTTP_COOKIE' else ',') + value
+        environ[name] = value
+    return environ
+
+
+def _declared_length(scope):
+    # The Content-Length header, or None.
+    for name, value in scope['headers']:
+        if name.lower() == b'content-length' and value.strip().isdigit():
+            return int(value)
+    return None
+
+
+class ASGIApplication:
+    def __init__(self, wsgi_app, max_body_size=None, spool_size=1024 * 1024, admission=None):
+        self.wsgi_app = wsgi_app
+        self.max_body_size = max_body_size
+        self.spool_size = spool_size
+        # environ -> an admission Attempt for the request, or None.
+        self.admission = admission
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+        declared = _declared_length(scope)
+        if self.max_body_size is not None and (declared or 0) > self.max_body_size:
+            await self._send_simple(send, 413, b"Request body too large.")
+            return
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        environ = _environ(scope, body, '' if declared is None else declared)
+        admission = None
+        try:
+            if self.admission is not None:
+                try:
+                    admission = await self._admit(environ)
+                except Rejected as e:
+                    await self._send_simple(send, 503, str(e).encode('utf-8'),
+                                            [(b'retry-after', str(e.retry_after).encode())])
+                    return
+                environ[ADMISSION_ENVIRON_KEY] = admission
+            length = await self._receive_body(receive, body)
+            if length is None:
+                return
+            if length is False:
+                await self._send_simple(send, 413, b"Request body too large.")
+                return
+            body.seek(0)
+            environ['CONTENT_LENGTH'] = str(length)
+            await self._respond(environ, receive, send)
+        finally:
+            body.close()
+            if admission is not None:
+                await asyncio.to_thread(admission.release)
+
+    async def _admit(self, environ):
+        # The request's Admission, None if it needs none, or raise Rejected.
+        attempt = await asyncio.to_thread(self.admission, environ)
+        if attempt is None:
+            return None
+        try:
+            while True:
+                admission = await asyncio.to_thread(attempt.poll)
+                if admission is not None:
+                    return admission
+                await asyncio.sleep(attempt.controller.poll_interval)
+        except BaseException:
+            attempt.cancel()
+            raise
+
+    async def _receive_body(self, receive, body):
+        # Returns the body length, None if the client went away, or False if
+        # the body is over max_body_size.
+        length = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            length += len(chunk)
+            if self.max_body_size is not None and length > self.max_body_size:
+                return False
+            if chunk:
+                if length > self.spool_size:
+                    # Spilled to disk: write off the event loop.
+                    await asyncio.to_thread(body.write, chunk)
+                else:
+                    body.write(chunk)
+            if not message.get('more_body', False):
+                return length
+
+    async def _send_simple(self, send, status, text, headers=()):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'text/plain; charset=utf-8'),
+                                (b'content-length', str(len(text)).encode())] + list(headers)})
+        await send({'type': 'http.response.body', 'body': text})
+
+    async def _respond(self, environ, receive, send):
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+            return lambda data: None
+
+        app_iter = await asyncio.to_thread(self.wsgi_app, environ, start_response)
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            status, headers = started
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in headers],
+            })
+            chunks = iter(app_iter)
+            while not disconnected.is_set():
+                chunk = await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    await send({'type': 'http.response.body', 'body': b''})
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            watcher.cancel()
+            close = getattr(app_iter, 'close', None)
+            if close is not None:
+                await asyncio.to_thread(close)
+
+
+application = ASGIApplication(
+    app,
+    max_body_size=app.config['MAX_CONTENT_LENGTH'],
+    spool_size=app.config['ASGI_SPOOL_SIZE'],
+    admission=upload_attempt,
+)
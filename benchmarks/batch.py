@@ -0,0 +1,121 @@
+import argparse
+import http.client
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import container
+from benchmarks.common import multipart, start_server, stop_server, write_report
+
+###############################################################################
+# BATCH SHARE BENCHMARK
+#
+#   python -m benchmarks.batch --files 100 --size 10240
+#
+# Sharing --files files of --size bytes each against gunicorn (--workers
+# sync workers), --repeat times each way, best run reported:
+#
+#   batch     one POST /upload with repeated file, encrypted_filename and
+#             size fields, as the upload page sends a selection
+#   per_file  one POST /upload per file, --clients at a time (a browser
+#             opens about six connections to a host)
+#
+# Reports the seconds and requests of each and how many times faster the
+# batch was.
+###############################################################################
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def request(base, method, path, body=None, headers=None):
+    parsed = urllib.parse.urlsplit(base)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=300)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def upload(base, blobs):
+    fields = []
+    for blob in blobs:
+        fields += [('encrypted_filename', None, b'AQ' + b'A' * 40),
+                   ('size', None, str(len(blob)).encode()),
+                   ('file', 'blob', blob)]
+    content_type, body = multipart(fields)
+    status, _ = request(base, 'POST', '/upload', body, {'Content-Type': content_type})
+    if status != 200:
+        raise BenchmarkError("upload of %d files: %d" % (len(blobs), status))
+
+
+def batch(base, blobs):
+    started = time.perf_counter()
+    upload(base, blobs)
+    return time.perf_counter() - started
+
+
+def per_file(base, blobs, clients):
+    blobs = list(blobs)
+    errors = []
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if not blobs:
+                    return
+                blob = blobs.pop()
+            try:
+                upload(base, [blob])
+            except Exception as e:
+                errors.append(repr(e))
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise BenchmarkError(errors[0])
+    return time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch share benchmark.")
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--size', type=int, default=10 * 1024,
+                        help="plaintext bytes per file")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=6)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    key = os.urandom(32)
+    blobs = [container.encrypt(key, os.urandom(args.size)) for _ in range(args.files)]
+    with tempfile.TemporaryDirectory() as directory:
+        server, base = start_server(directory, args.workers, limits=False)
+        try:
+            batch_seconds = min(batch(base, blobs) for _ in range(args.repeat))
+            per_file_seconds = min(per_file(base, blobs, args.clients)
+                                   for _ in range(args.repeat))
+        finally:
+            stop_server(server)
+    write_report({
+        'files': args.files,
+        'size': args.size,
+        'batch': {'requests': 1, 'seconds': round(batch_seconds, 4)},
+        'per_file': {'requests': args.files, 'clients': args.clients,
+                     'seconds': round(per_file_seconds, 4)},
+        'speedup': round(per_file_seconds / batch_seconds, 1),
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
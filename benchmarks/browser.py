@@ -0,0 +1,106 @@
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.common import start_server, stop_server, write_report
+
+###############################################################################
+# BROWSER BENCHMARK
+#
+#   pip install playwright && python -m playwright install chromium
+#   python -m benchmarks.browser --size-mb 10 100 --runs 3
+#
+# End-to-end throughput of the browser client: a headless Chromium uploads a
+# random file through the upload page (workers encrypting, chunk PUTs) and a
+# second, fresh browser context opens the link and downloads and decrypts it.
+# The app runs under gunicorn in a temporary directory. Timings are from the
+# click to the result link, and from opening the link to the browser's
+# download event; the saved file is checked against the original.
+#
+# Chromium has the File System Access API, but its save picker needs a user,
+# so the download page is made to use its in-memory fallback.
+###############################################################################
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def run_once(browser, base, path, size):
+    # Returns (upload seconds, download seconds).
+    context = browser.new_context()
+    page = context.new_page()
+    page.goto(base + '/')
+    page.set_input_files('#fileInput', path)
+    started = time.perf_counter()
+    page.click('#uploadForm button[type=submit]')
+    page.wait_for_selector('#downloadURL', timeout=0)
+    upload = time.perf_counter() - started
+    link = page.input_value('#downloadURL')
+    context.close()
+
+    context = browser.new_context(accept_downloads=True)
+    context.add_init_script('delete window.showSaveFilePicker;')
+    page = context.new_page()
+    started = time.perf_counter()
+    with page.expect_download(timeout=0) as download_info:
+        page.goto(link)
+    download = time.perf_counter() - started
+    saved = download_info.value.path()
+    if os.path.getsize(saved) != size or sha256_file(saved) != sha256_file(path):
+        raise RuntimeError("Downloaded file does not match the upload")
+    context.close()
+    return upload, download
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end browser upload/download benchmark.")
+    parser.add_argument('--size-mb', type=float, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=4, help="gunicorn workers")
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+
+    try:
+        from playwright.sync_api import sync_playwright
+    except ImportError:
+        sys.exit("The browser benchmark needs playwright: pip install playwright && "
+                 "python -m playwright install chromium")
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        server, base = start_server(directory, args.workers)
+        try:
+            with sync_playwright() as playwright:
+                browser = playwright.chromium.launch()
+                for size_mb in args.size_mb:
+                    size = int(size_mb * 1024 * 1024)
+                    path = os.path.join(directory, 'plain-%d.bin' % size)
+                    with open(path, 'wb') as f:
+                        f.write(os.urandom(size))
+                    runs = [run_once(browser, base, path, size) for _ in range(args.runs)]
+                    upload = min(run[0] for run in runs)
+                    download = min(run[1] for run in runs)
+                    results.append({
+                        'size_bytes': size,
+                        'runs': args.runs,
+                        'upload_seconds': upload,
+                        'upload_mb_per_s': size / 1048576 / upload,
+                        'download_seconds': download,
+                        'download_mb_per_s': size / 1048576 / download,
+                    })
+                browser.close()
+        finally:
+            stop_server(server)
+
+    write_report({'benchmark': 'browser', 'results': results}, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import argparse
+import http.client
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from benchmarks.common import REPO, multipart, percentiles, start_server, stop_server, write_report
+
+###############################################################################
+# CONCURRENT CLAIM STRESS TEST
+#
+#   python -m benchmarks.claims --requests 500 --rounds 5
+#
+# Many clients racing for one share: each round uploads a share allowing
+# --downloads downloads, then --requests threads, released together by a
+# barrier, each GET /file/<id> on a connection of their own. Exactly
+# --downloads of them must get the whole file (200, checked for length) and
+# every other one a 404; anything else is a failure, reported with the round
+# and the status codes seen, and the exit status is 1.
+#
+# Runs under gunicorn (--workers processes of --threads threads, so the
+# claims race across processes as well as threads), once per --serve-modes
+# entry. Reports the outcome of every round and p50/p95/p99 latency to the
+# end of the response body, separately for winners and losers.
+###############################################################################
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def request(base, method, path, body=None, headers=None):
+    parsed = urllib.parse.urlsplit(base)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=300)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.headers, response.read()
+    finally:
+        conn.close()
+
+
+def upload(base, blob, downloads):
+    content_type, body = multipart([
+        ('encrypted_filename', None, b'AQ' + b'A' * 40),
+        ('max_downloads', None, str(downloads).encode()),
+        ('file', 'blob', blob),
+    ])
+    status, _, page = request(base, 'POST', '/upload', body, {'Content-Type': content_type})
+    if status != 200:
+        raise BenchmarkError("upload: %d" % status)
+    return re.search(rb'/download/([0-9a-z-]+)', page).group(1).decode()
+
+
+def race(base, file_id, requests):
+    # GET the file from `requests` threads at once. Returns [(status, bytes
+    # received, seconds)].
+    barrier = threading.Barrier(requests)
+    results = []
+    lock = threading.Lock()
+
+    def client():
+        barrier.wait()
+        started = time.perf_counter()
+        try:
+            status, _, data = request(base, 'GET', '/file/' + file_id)
+            result = (status, len(data), time.perf_counter() - started)
+        except Exception as e:
+            result = (repr(e), 0, time.perf_counter() - started)
+        with lock:
+            results.append(result)
+
+    threads = [threading.Thread(target=client) for _ in range(requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def milliseconds(samples):
+    return {name: round(value * 1000, 1) if value is not None else None
+            for name, value in percentiles(samples).items()}
+
+
+def run(base, blob, downloads, requests, rounds):
+    winners, losers, failures = [], [], []
+    for n in range(rounds):
+        file_id = upload(base, blob, downloads)
+        results = race(base, file_id, requests)
+        won = [seconds for status, received, seconds in results
+               if status == 200 and received == len(blob)]
+        lost = [seconds for status, _, seconds in results if status == 404]
+        winners.extend(won)
+        losers.extend(lost)
+        if len(won) != downloads or len(won) + len(lost) != requests:
+            statuses = {}
+            for status, received, _ in results:
+                key = '%s/%s' % (status, 'full' if received == len(blob) else received)
+                statuses[key] = statuses.get(key, 0) + 1
+            failures.append({'round': n, 'statuses': statuses})
+    return {
+        'rounds': rounds,
+        'winners': len(winners),
+        'losers': len(losers),
+        'failures': failures,
+        'winner_ms': milliseconds(winners),
+        'loser_ms': milliseconds(losers),
+        'all_ms': milliseconds(winners + losers),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Many parallel fetches of one share.")
+    parser.add_argument('--requests', type=int, default=500, help="parallel fetches per round")
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--downloads', type=int, default=1, help="downloads each share allows")
+    parser.add_argument('--size', type=int, default=64 * 1024, help="plaintext bytes per file")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=32, help="threads per gunicorn worker")
+    parser.add_argument('--serve-modes', nargs='+', default=['sendfile', 'stream'],
+                        choices=['sendfile', 'stream'])
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    sys.path.insert(0, REPO)
+    import container
+    blob = container.encrypt(os.urandom(32), os.urandom(args.size))
+    results = []
+    for mode in args.serve_modes:
+        with tempfile.TemporaryDirectory() as directory:
+            server, base = start_server(directory, args.workers, limits=False,
+                                        worker_class='gthread', threads=args.threads,
+                                        env={'SECURE_SHARE_FILE_SERVE_MODE': mode})
+            try:
+                result = run(base, blob, args.downloads, args.requests, args.rounds)
+            finally:
+                stop_server(server)
+        result['serve_mode'] = mode
+        results.append(result)
+    write_report({'requests': args.requests, 'downloads': args.downloads,
+                  'workers': args.workers, 'threads': args.threads, 'results': results},
+                 args.output)
+    failed = [result for result in results if result['failures']]
+    for result in failed:
+        for failure in result['failures']:
+            print("FAILED %s round %d: %s" % (result['serve_mode'], failure['round'],
+                                               failure['statuses']), file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
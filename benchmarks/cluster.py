@@ -0,0 +1,116 @@
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.request
+
+from benchmarks.common import free_port, start_server, stop_server, write_report
+from benchmarks.pages import create_share
+
+###############################################################################
+# CLUSTER SCALING BENCHMARK
+#
+#   python -m benchmarks.cluster --nodes 1 2 3 4 --clients 16 --seconds 20
+#
+# Starts N app nodes on localhost ports (gunicorn, gthread workers), each in
+# its own directory, and drives them the way a load balancer would: every
+# request goes to a random node. One operation is an upload, then the
+# download page and the file, so with N nodes (N-1)/N of the downloads are
+# handed off to the owner (--mode proxy or redirect). Reports operations
+# per second for each N; with enough cores for the nodes and the client it
+# should grow about linearly. Rate limits and quotas are disabled.
+###############################################################################
+
+def start_nodes(directory, count, mode, threads):
+    ports = [free_port() for _ in range(count)]
+    nodes = ','.join('n%d=http://127.0.0.1:%d' % (i, port) for i, port in enumerate(ports))
+    servers = []
+    bases = []
+    try:
+        for i in range(count):
+            node_dir = os.path.join(directory, 'n%d' % i)
+            os.makedirs(node_dir)
+            env = {'SECURE_SHARE_NODE_NAME': 'n%d' % i, 'SECURE_SHARE_HANDOFF_MODE': mode,
+                   'SECURE_SHARE_CLUSTER_SECRET': 'benchmark'}
+            if count > 1:
+                env['SECURE_SHARE_NODES'] = nodes
+            server, base = start_server(node_dir, 1, limits=False, worker_class='gthread',
+                                        threads=threads, env=env, port=ports[i])
+            servers.append(server)
+            bases.append(base)
+    except Exception:
+        stop_nodes(servers)
+        raise
+    return servers, bases
+
+
+def stop_nodes(servers):
+    for server in servers:
+        stop_server(server)
+
+
+def operation(bases):
+    # Upload on one node, view and download on (usually) another. The file
+    # request has a fresh cookie jar, like the recipient's browser.
+    file_id = create_share(random.choice(bases))
+    urllib.request.urlopen(random.choice(bases) + '/download/' + file_id).read()
+    urllib.request.urlopen(random.choice(bases) + '/file/' + file_id).read()
+
+
+def run(bases, clients, seconds):
+    done = []
+    errors = []
+    stop = time.monotonic() + seconds
+
+    def client():
+        count = 0
+        while time.monotonic() < stop:
+            try:
+                operation(bases)
+                count += 1
+            except Exception as e:
+                errors.append(repr(e))
+        done.append(count)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    return sum(done) / elapsed, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Throughput of 1..N app nodes.")
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1, 2, 3, 4])
+    parser.add_argument('--mode', choices=('proxy', 'redirect'), default='proxy')
+    parser.add_argument('--clients', type=int, default=16, help="concurrent client threads")
+    parser.add_argument('--threads', type=int, default=8, help="gunicorn threads per node")
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+
+    results = []
+    for count in args.nodes:
+        with tempfile.TemporaryDirectory() as directory:
+            servers, bases = start_nodes(directory, count, args.mode, args.threads)
+            try:
+                ops, errors = run(bases, args.clients, args.seconds)
+            finally:
+                stop_nodes(servers)
+        results.append({'nodes': count, 'ops_per_second': ops, 'errors': len(errors),
+                        'first_error': errors[0] if errors else None})
+    base = results[0]['ops_per_second'] / results[0]['nodes'] if results else 0
+    for result in results:
+        result['speedup'] = result['ops_per_second'] / base if base else None
+
+    write_report({'benchmark': 'cluster', 'mode': args.mode, 'cpus': os.cpu_count(),
+                  'results': results}, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+import uuid
+
+###############################################################################
+# BENCHMARK HELPERS
+#
+# Shared by the benchmarks in this package: starting the app under gunicorn
+# (or asgi.py under uvicorn) on a free localhost port, multipart bodies,
+# latency percentiles, memory, CPU time and disk I/O of the server processes
+# (from /proc, so Linux only), and JSON reports.
+###############################################################################
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# gunicorn entry point that turns off the per-client limits (and password
+# guessing limits): all requests of a benchmark come from one address.
+BENCHMARK_APP = """
+import app as benchmarked
+benchmarked.app.config['REQUESTS_PER_SECOND'] = 0
+benchmarked.app.config['UPLOAD_BYTES_PER_DAY'] = 0
+benchmarked.app.config['MAX_STORED_BYTES'] = 0
+benchmarked.app.config['PASSWORD_ATTEMPTS_PER_MINUTE'] = 0
+benchmarked.app.config['SHARE_PASSWORD_ATTEMPTS_PER_MINUTE'] = 0
+app = benchmarked.app
+"""
+
+# The same for asgi.py, which wraps that app object.
+BENCHMARK_ASGI = BENCHMARK_APP + """
+from asgi import application
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(base, server, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(base + '/help').close()
+            return
+        except OSError:
+            if time.monotonic() > deadline or server.poll() is not None:
+                server.kill()
+                raise RuntimeError("gunicorn did not start")
+            time.sleep(0.2)
+
+
+def start_server(directory, workers, limits=True, worker_class='sync', threads=1, env=None,
+                 port=None, source=REPO, patch=''):
+    # Run the app under gunicorn with `directory` as its working directory
+    # (and so its uploads folder), from the code in `source` (see checkout()).
+    # Without limits, `patch` is more code for the entry point to run.
+    # Returns (process, base URL).
+    port = port or free_port()
+    pythonpath = source
+    module = 'app:app'
+    if not limits:
+        with open(os.path.join(directory, 'benchmark_app.py'), 'w') as f:
+            f.write(BENCHMARK_APP + patch)
+        pythonpath += ',' + directory
+        module = 'benchmark_app:app'
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--pythonpath', pythonpath, '-w', str(workers),
+         '-k', worker_class, '--threads', str(threads), '-b', '127.0.0.1:%d' % port, module],
+        cwd=directory, env=dict(os.environ, **(env or {})),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = 'http://127.0.0.1:%d' % port
+    wait_ready(base, server)
+    return server, base
+
+
+def start_asgi_server(directory, workers, limits=True, env=None, port=None, source=REPO):
+    # Run asgi.py under uvicorn, like start_server(). Returns (process, base
+    # URL).
+    port = port or free_port()
+    pythonpath = source
+    module = 'asgi:application'
+    if not limits:
+        with open(os.path.join(directory, 'benchmark_asgi.py'), 'w') as f:
+            f.write(BENCHMARK_ASGI)
+        pythonpath += os.pathsep + directory
+        module = 'benchmark_asgi:application'
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', '--workers', str(workers), '--host', '127.0.0.1',
+         '--port', str(port), '--no-access-log', module],
+        cwd=directory, env=dict(os.environ, PYTHONPATH=pythonpath, **(env or {})),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = 'http://127.0.0.1:%d' % port
+    wait_ready(base, server)
+    return server, base
+
+
+def checkout(revision, directory):
+    # Extract `revision` of this repository into `directory`, e.g. to run
+    # an older version with start_server(source=directory).
+    archive = subprocess.run(['git', 'archive', revision], cwd=REPO, capture_output=True,
+                             check=True).stdout
+    subprocess.run(['tar', '-x', '-C', directory], input=archive, check=True)
+
+
+def stop_server(server):
+    server.terminate()
+    server.wait()
+
+
+def multipart(fields):
+    # (content type, body) for [(name, filename or None, bytes), ...].
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, filename, value in fields:
+        disposition = 'form-data; name="%s"' % name
+        if filename:
+            disposition += '; filename="%s"' % filename
+        parts.append(('--%s\r\nContent-Disposition: %s\r\n\r\n' % (boundary, disposition)).encode())
+        parts.append(value)
+        parts.append(b'\r\n')
+    parts.append(('--%s--\r\n' % boundary).encode())
+    return 'multipart/form-data; boundary=' + boundary, b''.join(parts)
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    # Nearest-rank percentiles, in the unit of the samples.
+    if not samples:
+        return {'p%d' % p: None for p in points}
+    ordered = sorted(samples)
+    return {'p%d' % p: ordered[min(len(ordered) - 1, max(0, -(-p * len(ordered) // 100) - 1))]
+            for p in points}
+
+
+def process_tree(pid):
+    # `pid` and its children (gunicorn workers).
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            pids.append(int(entry))
+    return pids
+
+
+def process_stats(pids):
+    # Peak RSS (largest process and sum) and bytes read from and written to
+    # storage, summed over `pids`.
+    stats = {'peak_rss_bytes': 0, 'peak_rss_total_bytes': 0,
+             'disk_read_bytes': 0, 'disk_write_bytes': 0}
+    for pid in pids:
+        try:
+            with open('/proc/%d/status' % pid) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        rss = int(line.split()[1]) * 1024
+                        stats['peak_rss_bytes'] = max(stats['peak_rss_bytes'], rss)
+                        stats['peak_rss_total_bytes'] += rss
+            with open('/proc/%d/io' % pid) as f:
+                for line in f:
+                    name, value = line.split(':')
+                    if name == 'read_bytes':
+                        stats['disk_read_bytes'] += int(value)
+                    elif name == 'write_bytes':
+                        stats['disk_write_bytes'] += int(value)
+        except OSError:
+            continue
+    return stats
+
+
+def process_cpu(pids):
+    # CPU seconds (user + system) used so far, summed over `pids`.
+    ticks = 0
+    for pid in pids:
+        try:
+            with open('/proc/%d/stat' % pid) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        ticks += int(fields[11]) + int(fields[12])
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+
+def write_report(report, path=None):
+    text = json.dumps(report, indent=2)
+    if path:
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import time
+
+import app
+from benchmarks.common import write_report
+from filenames import format_encrypted_filename, parse_encrypted_filename
+
+###############################################################################
+# FILENAME AND KEY ENCODING BENCHMARK
+#
+#   python -m benchmarks.encoding --iterations 200000
+#
+# Time per call of encoding and decoding the encrypted filename (a version
+# byte, 12-byte IV, a 24-byte name and a 16-byte tag) and the 32-byte key,
+# in the current base64url format and the older hex one, and the length of
+# each form:
+#
+# - server: filenames.py parsing the form field and formatting a stored
+#   record for the download page (legacy records are stored as hex text);
+# - browser: the page scripts' bytesToBase64url()/base64urlToBytes() against
+#   the former buf2hex()/hexToBytes(), run under Node.js if `node` is on the
+#   PATH (the functions are taken from the scripts app.py serves).
+###############################################################################
+
+NAME_SIZE = 24
+
+# The hex helpers the page scripts used before base64url.
+LEGACY_JS = """
+function buf2hex(buffer) {
+  return Array.from(new Uint8Array(buffer))
+    .map(b => ('00' + b.toString(16)).slice(-2))
+    .join('');
+}
+
+function hexToBytes(hex) {
+  const bytes = new Uint8Array(hex.length / 2);
+  for (let i = 0; i < bytes.length; i++) {
+    bytes[i] = parseInt(hex.substr(i * 2, 2), 16);
+  }
+  return bytes;
+}
+"""
+
+NODE_HARNESS = """
+const iterations = %d;
+const filename = Uint8Array.from(%s);
+const key = Uint8Array.from(%s);
+function time(fn, input) {
+  for (let i = 0; i < 1000; i++) fn(input);
+  const started = process.hrtime.bigint();
+  for (let i = 0; i < iterations; i++) fn(input);
+  return Number(process.hrtime.bigint() - started) / iterations;
+}
+const results = {};
+for (const [name, value] of [['filename', filename], ['key', key]]) {
+  const b64 = bytesToBase64url(value);
+  const hex = buf2hex(value);
+  results[name] = {
+    base64url_encode_ns: time(bytesToBase64url, value),
+    base64url_decode_ns: time(base64urlToBytes, b64),
+    hex_encode_ns: time(buf2hex, value),
+    hex_decode_ns: time(hexToBytes, hex),
+  };
+}
+console.log(JSON.stringify(results));
+"""
+
+
+def per_call_ns(func, argument, iterations):
+    for _ in range(1000):
+        func(argument)
+    started = time.perf_counter_ns()
+    for _ in range(iterations):
+        func(argument)
+    return (time.perf_counter_ns() - started) / iterations
+
+
+def legacy_form(raw):
+    return raw[1:13].hex() + ':' + raw[13:].hex()
+
+
+def server(raw, iterations):
+    text = format_encrypted_filename(raw)
+    legacy = legacy_form(raw)
+    return {
+        'base64url_chars': len(text),
+        'hex_chars': len(legacy),
+        'parse_base64url_ns': round(per_call_ns(parse_encrypted_filename, text, iterations)),
+        'parse_hex_ns': round(per_call_ns(parse_encrypted_filename, legacy, iterations)),
+        'format_stored_bytes_ns': round(per_call_ns(format_encrypted_filename, raw, iterations)),
+        'format_stored_hex_ns': round(per_call_ns(format_encrypted_filename, legacy, iterations)),
+    }
+
+
+def js_function(name):
+    # Source of function `name` in the scripts app.py serves.
+    for source in (value for key, value in vars(app).items() if key.endswith('_JS')):
+        match = re.search(r'^function %s\(.*?^}$' % name, source, re.M | re.S)
+        if match:
+            return match.group(0)
+    raise LookupError(name)
+
+
+def browser(raw, key, iterations):
+    node = shutil.which('node')
+    if node is None:
+        return None
+    script = '\n'.join([js_function('bytesToBase64url'), js_function('base64urlToBytes'),
+                        LEGACY_JS, NODE_HARNESS % (iterations, list(raw), list(key))])
+    output = subprocess.run([node, '-'], input=script, capture_output=True, text=True,
+                            check=True).stdout
+    return {name: {k: round(v) for k, v in values.items()}
+            for name, values in json.loads(output).items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Filename and key encoding, base64url vs hex.")
+    parser.add_argument('--iterations', type=int, default=200000)
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    raw = b'\x01' + os.urandom(12 + NAME_SIZE + 16)
+    key = os.urandom(32)
+    write_report({
+        'filename_bytes': len(raw),
+        'key_chars': {'base64url': len(format_encrypted_filename(key)), 'hex': len(key.hex())},
+        'server': server(raw, args.iterations),
+        'browser': browser(raw, key, args.iterations),
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import argparse
+import hashlib
+import http.client
+import io
+import json
+import os
+import tempfile
+import time
+import urllib.parse
+
+import container
+from benchmarks.common import (checkout, percentiles, start_server, stop_server,
+                               write_report)
+from storage import DigestReader, copy_stream
+
+###############################################################################
+# UPLOAD HASHING BENCHMARK
+#
+#   python -m benchmarks.hashing --size 268435456
+#   python -m benchmarks.hashing --baseline HEAD~1 --finishes 10
+#
+# What recording the SHA-256 of an upload costs. In process, --size bytes
+# from memory written to a file (with the app's copy buffer):
+#
+#   copy      copy_stream() alone
+#   inline    copy_stream() through a DigestReader, as uploads are stored
+#   reread    hashing the written file afterwards (in the page cache)
+#
+# reported as MB/s. Then, against gunicorn, --finishes chunked uploads of
+# --upload-size bytes, timing POST /upload/<id>/finish, which used to hash
+# the assembled file and now only combines the chunks' digests; --baseline
+# runs a git revision for comparison.
+###############################################################################
+
+BUFFER_SIZE = 256 * 1024
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def request(base, method, path, body=None, headers=None):
+    parsed = urllib.parse.urlsplit(base)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=300)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def throughput(size, repeat, directory):
+    data = os.urandom(size)
+    path = os.path.join(directory, 'copy')
+    results = {}
+    for name in ('copy', 'inline', 'reread'):
+        best = None
+        for _ in range(repeat):
+            if name == 'reread':
+                # The file the copies left, as finish used to read it.
+                with open(path, 'rb') as f:
+                    started = time.perf_counter()
+                    hashlib.file_digest(f, 'sha256')
+                    seconds = time.perf_counter() - started
+            else:
+                stream = io.BytesIO(data)
+                with open(path, 'wb') as f:
+                    started = time.perf_counter()
+                    copy_stream(DigestReader(stream) if name == 'inline' else stream,
+                                f, size, BUFFER_SIZE)
+                    seconds = time.perf_counter() - started
+            best = seconds if best is None else min(best, seconds)
+        results[name] = round(size / 1048576 / best, 1)
+    os.remove(path)
+    return results
+
+
+def finish_times(base, blob, finishes):
+    times = []
+    for _ in range(finishes):
+        body = urllib.parse.urlencode({'encrypted_filename': 'AQ' + 'A' * 40,
+                                       'size': len(blob)})
+        status, data = request(base, 'POST', '/upload/start', body,
+                               {'Content-Type': 'application/x-www-form-urlencoded'})
+        if status != 200:
+            raise BenchmarkError("start: %d" % status)
+        session = json.loads(data)
+        for n in range(session['chunks']):
+            start = n * session['chunk_size']
+            status, _ = request(base, 'PUT', '/upload/%s/chunk/%d' % (session['upload_id'], n),
+                                memoryview(blob)[start:start + session['chunk_size']],
+                                {'Content-Type': 'application/octet-stream'})
+            if status != 204:
+                raise BenchmarkError("chunk %d: %d" % (n, status))
+        started = time.perf_counter()
+        status, _ = request(base, 'POST', '/upload/%s/finish' % session['upload_id'])
+        times.append(time.perf_counter() - started)
+        if status != 200:
+            raise BenchmarkError("finish: %d" % status)
+    return {name: round(value * 1000, 1)
+            for name, value in percentiles(times).items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Upload hashing benchmark.")
+    parser.add_argument('--size', type=int, default=256 * 1024 * 1024)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--upload-size', type=int, default=128 * 1024 * 1024)
+    parser.add_argument('--finishes', type=int, default=5)
+    parser.add_argument('--baseline', help="git revision to compare against")
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    report = {'size': args.size}
+    with tempfile.TemporaryDirectory() as directory:
+        report['mb_per_s'] = throughput(args.size, args.repeat, directory)
+    blob = container.encrypt(os.urandom(32), os.urandom(args.upload_size))
+    report['finish_ms'] = {}
+    versions = [('current', None)] + ([(args.baseline, args.baseline)] if args.baseline else [])
+    for name, revision in versions:
+        with tempfile.TemporaryDirectory() as directory:
+            kwargs = {}
+            if revision:
+                source = os.path.join(directory, 'source')
+                os.mkdir(source)
+                checkout(revision, source)
+                kwargs['source'] = source
+            server, base = start_server(directory, 1, limits=False, **kwargs)
+            try:
+                report['finish_ms'][name] = finish_times(base, blob, args.finishes)
+            finally:
+                stop_server(server)
+    write_report(report, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+import uuid
+
+from benchmarks.common import percentiles, write_report
+from metadata import MemoryMetadataStore, SQLiteMetadataStore
+
+###############################################################################
+# METADATA INDEX BENCHMARK
+#
+#   python -m benchmarks.index --entries 10000000 --lookups 100000
+#
+# Fills each index with --entries pending shares and reports the bytes it
+# takes per entry and the latency of random get()s:
+#
+# - dict: the original in-process dict of dicts (hex filename, path,
+#   downloaded flag), as a baseline;
+# - memory: MemoryMetadataStore, fixed-width records and a blob, with the
+#   app's default file paths left out;
+# - sqlite: SQLiteMetadataStore, read through a shared memory map.
+#
+# Every --shares-per-owner consecutive shares have the same owner, as a
+# client that uploads several files. Each index is built in its own process. For the in-process ones, bytes per
+# entry is the growth of the process's RSS; for SQLite it is the size of the
+# database file, which the page cache holds once for all workers.
+###############################################################################
+
+BATCH = 10000
+SHARES_PER_OWNER = 10
+
+
+def rss_bytes():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def location(file_id):
+    return os.path.join('uploads', file_id[:2], file_id[2:4], file_id + '.enc')
+
+
+def make_entry(n, shares_per_owner):
+    # A file id and a record like the ones /upload stores.
+    file_id = str(uuid.UUID(int=random.getrandbits(128), version=4))
+    now = time.time()
+    return file_id, {
+        'encrypted_filename': b'\x01' + os.urandom(12 + 24 + 16),
+        'filepath': location(file_id),
+        'downloaded': False,
+        'created_at': now,
+        'expires_at': now + 7 * 24 * 3600 + n,
+        'size': 1024 * 1024,
+        'sha256': os.urandom(32),
+        'owner': '%032x' % (n // shares_per_owner),
+        'manifest': None,
+    }
+
+
+def build(backend, entries, directory, shares_per_owner):
+    # (index, get, its size in bytes, seconds to build, sampled ids).
+    sample = []
+    started = time.perf_counter()
+    before = rss_bytes()
+    if backend == 'dict':
+        index = {}
+        for n in range(entries):
+            file_id, record = make_entry(n, shares_per_owner)
+            index[file_id] = {'encrypted_filename': record['encrypted_filename'].hex(),
+                              'filepath': record['filepath'], 'downloaded': False}
+            if n % 100 == 0:
+                sample.append(file_id)
+        get = index.get
+    elif backend == 'memory':
+        index = MemoryMetadataStore(location)
+        for n in range(entries):
+            file_id, record = make_entry(n, shares_per_owner)
+            index.add(file_id, record)
+            if n % 100 == 0:
+                sample.append(file_id)
+        get = index.get
+    else:
+        path = os.path.join(directory, 'index.db')
+        index = SQLiteMetadataStore(path, mmap_size=1 << 40)
+        for start in range(0, entries, BATCH):
+            batch = [make_entry(n, shares_per_owner)
+                     for n in range(start, min(entries, start + BATCH))]
+            index.add_many(batch)
+            sample.extend(file_id for file_id, _ in batch[::100])
+        index._conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        get = index.get
+    seconds = time.perf_counter() - started
+    if backend == 'sqlite':
+        size = sum(os.path.getsize(path + suffix) for suffix in ('', '-wal')
+                   if os.path.exists(path + suffix))
+    else:
+        # The sample list is not part of the index.
+        size = rss_bytes() - before - len(sample) * 8
+    return index, get, size, seconds, sample
+
+
+def measure(backend, entries, lookups, shares_per_owner, directory, results):
+    random.seed(1)
+    index, get, size, seconds, sample = build(backend, entries, directory, shares_per_owner)
+    hits = [random.choice(sample) for _ in range(lookups)]
+    misses = [str(uuid.uuid4()) for _ in range(lookups // 10)]
+    for file_id in hits[:1000]:
+        get(file_id)
+    hit_times = []
+    for file_id in hits:
+        started = time.perf_counter_ns()
+        get(file_id)
+        hit_times.append((time.perf_counter_ns() - started) / 1000)
+    miss_times = []
+    for file_id in misses:
+        started = time.perf_counter_ns()
+        get(file_id)
+        miss_times.append((time.perf_counter_ns() - started) / 1000)
+    results.put({
+        'backend': backend,
+        'entries': entries,
+        'build_seconds': round(seconds, 2),
+        'bytes': size,
+        'bytes_per_entry': round(size / entries, 1),
+        'lookup_us': {k: round(v, 2) for k, v in percentiles(hit_times).items()},
+        'miss_us': {k: round(v, 2) for k, v in percentiles(miss_times).items()},
+    })
+
+
+def run(backend, entries, lookups, shares_per_owner):
+    # Each backend in a fresh process, so RSS growth is its own.
+    results = multiprocessing.Queue()
+    with tempfile.TemporaryDirectory() as directory:
+        process = multiprocessing.Process(
+            target=measure, args=(backend, entries, lookups, shares_per_owner, directory,
+                                  results))
+        process.start()
+        result = results.get()
+        process.join()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Metadata index size and lookup benchmark.")
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--backends', nargs='+', default=['dict', 'memory', 'sqlite'],
+                        choices=['dict', 'memory', 'sqlite'])
+    parser.add_argument('--shares-per-owner', type=int, default=SHARES_PER_OWNER)
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    write_report({'results': [run(backend, args.entries, args.lookups, args.shares_per_owner)
+                              for backend in args.backends]}, args.output)
+
+
+if __name__ == '__main__':
+    main()
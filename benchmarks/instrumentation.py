@@ -0,0 +1,199 @@
+import argparse
+import http.client
+import os
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from benchmarks.common import (REPO, multipart, process_cpu, process_tree, start_server,
+                               stop_server, write_report)
+
+###############################################################################
+# METRICS OVERHEAD BENCHMARK
+#
+#   python -m benchmarks.instrumentation --size 65536 --downloads 2000
+#
+# Cost of the /metrics instrumentation on GET /file/<id>. Two gunicorn
+# servers run side by side, the same except that in one the app is not
+# wrapped in instrumented() and the registry does nothing. Small files
+# (--size) make the per-request cost stand out as much as it can.
+#
+# Each of --rounds rounds downloads --downloads files (shares of 100
+# downloads each, uploaded first) from --clients threads, from one server
+# and then the other, which goes first alternating, so that drift affects
+# both alike. For each server the report has the median requests/s and
+# server CPU time per request; the overhead of metrics on both is the median
+# over the rounds of the difference within a round. The exit status is 1 if
+# the CPU overhead is above --limit. A round varies by a few percent on a
+# busy machine, so use enough of them.
+#
+# The report also has the time instrumented() itself adds to a request with
+# the /file response headers, in a tight loop (so with warm caches).
+###############################################################################
+
+SHARE_DOWNLOADS = 100
+# Headers of a /file/<id> response.
+FILE_HEADERS = [
+    ('Content-Type', 'application/octet-stream'),
+    ('Content-Length', '65584'),
+    ('Content-Disposition', 'attachment; filename=encrypted_file'),
+    ('Accept-Ranges', 'bytes'),
+    ('Cache-Control', 'no-store, no-transform'),
+    ('Content-Encoding', 'identity'),
+]
+
+# Entry point code that turns metrics off.
+NO_METRICS = """
+benchmarked.registry.inc = lambda *args, **kwargs: None
+benchmarked.registry.observe = lambda *args, **kwargs: None
+benchmarked.registry.start = lambda: None
+del app.wsgi_app
+"""
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def request(base, method, path, body=None, headers=None):
+    parsed = urllib.parse.urlsplit(base)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=300)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def create_shares(base, blob, downloads):
+    content_type, body = multipart([
+        ('encrypted_filename', None, b'AQ' + b'A' * 40),
+        ('max_downloads', None, str(SHARE_DOWNLOADS).encode()),
+        ('file', 'blob', blob),
+    ])
+    shares = []
+    for _ in range(-(-downloads // SHARE_DOWNLOADS)):
+        status, page = request(base, 'POST', '/upload', body, {'Content-Type': content_type})
+        if status != 200:
+            raise BenchmarkError("upload: %d" % status)
+        shares.append(re.search(rb'/download/([0-9a-z-]+)', page).group(1).decode())
+    return [shares[n // SHARE_DOWNLOADS] for n in range(downloads)]
+
+
+def run(base, server, slots, size, clients):
+    # Download every slot; returns (requests/s, CPU seconds per request).
+    slots = list(slots)
+    lock = threading.Lock()
+    errors = []
+
+    def client():
+        while True:
+            with lock:
+                if not slots:
+                    return
+                file_id = slots.pop()
+            status, data = request(base, 'GET', '/file/' + file_id)
+            if status != 200 or len(data) != size:
+                errors.append("file: %d, %d of %d bytes" % (status, len(data), size))
+
+    pids = process_tree(server.pid)
+    cpu = process_cpu(pids)
+    count = len(slots)
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    cpu = process_cpu(pids) - cpu
+    if errors:
+        raise BenchmarkError("; ".join(errors[:5]))
+    return count / elapsed, cpu / count
+
+
+def direct_cost(iterations=300000):
+    # Microseconds instrumented() adds to a request.
+    import app
+    from werkzeug.test import EnvironBuilder
+
+    def view(environ, start_response):
+        start_response('200 OK', FILE_HEADERS)
+        return []
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    environ = EnvironBuilder(path='/file/id').get_environ()
+    environ['werkzeug.request'] = type('Request', (), {'endpoint': 'serve_file'})()
+    wrapped = app.instrumented(view)
+    timings = []
+    for func in (wrapped, view):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func(environ, start_response)
+        timings.append((time.perf_counter() - started) / iterations)
+    return (timings[0] - timings[1]) * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Overhead of metrics on /file/<id>.")
+    parser.add_argument('--size', type=int, default=64 * 1024, help="plaintext bytes per file")
+    parser.add_argument('--downloads', type=int, default=3000, help="downloads per round")
+    parser.add_argument('--rounds', type=int, default=15)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--limit', type=float, default=0.02,
+                        help="largest acceptable CPU overhead (fraction)")
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    sys.path.insert(0, REPO)
+    import container
+    blob = container.encrypt(os.urandom(32), os.urandom(args.size))
+    samples = {'metrics': [], 'no metrics': []}
+    with tempfile.TemporaryDirectory() as with_metrics, \
+            tempfile.TemporaryDirectory() as without_metrics:
+        servers = {
+            'metrics': start_server(with_metrics, args.workers, limits=False),
+            'no metrics': start_server(without_metrics, args.workers, limits=False,
+                                       patch=NO_METRICS),
+        }
+        try:
+            for n in range(args.rounds):
+                for name in sorted(servers, reverse=n % 2 == 1):
+                    server, base = servers[name]
+                    slots = create_shares(base, blob, args.downloads)
+                    samples[name].append(run(base, server, slots, len(blob), args.clients))
+        finally:
+            for server, _ in servers.values():
+                stop_server(server)
+    results = {}
+    for name, runs in samples.items():
+        results[name] = {
+            'requests_per_second': round(statistics.median(rate for rate, _ in runs), 1),
+            'cpu_us_per_request': round(statistics.median(cpu for _, cpu in runs) * 1e6, 1),
+        }
+    rounds = list(zip(samples['metrics'], samples['no metrics']))
+    cpu_overhead = statistics.median(on[1] / off[1] - 1 for on, off in rounds)
+    report = {
+        'cpus': os.cpu_count(),
+        'file_bytes': len(blob),
+        'results': results,
+        'cpu_overhead': round(cpu_overhead, 4),
+        'throughput_overhead': round(
+            statistics.median(1 - on[0] / off[0] for on, off in rounds), 4),
+        'limit': args.limit,
+        'direct_cost_us_per_request': round(direct_cost(), 2),
+    }
+    write_report(report, args.output)
+    if cpu_overhead > args.limit:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
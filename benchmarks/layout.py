@@ -0,0 +1,105 @@
+import argparse
+import array
+import os
+import random
+import tempfile
+import time
+import uuid
+
+from benchmarks.common import percentiles, write_report
+from storage import blob_path, iter_blobs
+
+###############################################################################
+# UPLOADS LAYOUT BENCHMARK
+#
+#   python -m benchmarks.layout --counts 10000 1000000 5000000
+#
+# File system cost of the uploads folder at each of --counts files, flat
+# (every <id>.enc in one directory) and sharded (UPLOAD_FANOUT 2,2,
+# uploads/ab/cd/<id>.enc). For each, in a fresh folder under --directory:
+#
+#   create      blob_path(create=True) and an empty file, as /upload does
+#   stat        os.path.exists() of --lookups random existing files, and
+#               of as many missing ones
+#   scan        one walk over every file, as the reaper's reconciliation does
+#   unlink      every file, in random order
+#
+# with p50/p99/max latency per operation in microseconds and the rate of the
+# whole phase. Files are empty, so this measures directory lookups and
+# metadata, not data. Millions of files need as many free inodes; run it on
+# the file system the uploads will live on.
+###############################################################################
+
+LAYOUTS = {'flat': (), 'sharded': (2, 2)}
+
+
+def timed(paths, operation):
+    # Run operation(path) for each path. Returns (latencies in us, seconds).
+    latencies = array.array('d')
+    started = time.perf_counter()
+    for path in paths:
+        before = time.perf_counter_ns()
+        operation(path)
+        latencies.append((time.perf_counter_ns() - before) / 1000)
+    return latencies, time.perf_counter() - started
+
+
+def summary(latencies, seconds):
+    result = {k: round(v, 1) for k, v in percentiles(latencies, (50, 99)).items()}
+    result['max'] = round(max(latencies), 1) if latencies else None
+    result['per_second'] = round(len(latencies) / seconds) if seconds else None
+    return result
+
+
+def create(path):
+    open(path, 'xb').close()
+
+
+def run(layout, count, lookups, parent):
+    fanout = LAYOUTS[layout]
+    with tempfile.TemporaryDirectory(dir=parent) as folder:
+        ids = [str(uuid.uuid4()) for _ in range(count)]
+        results = {'layout': layout, 'files': count}
+
+        latencies = array.array('d')
+        started = time.perf_counter()
+        for file_id in ids:
+            before = time.perf_counter_ns()
+            create(blob_path(folder, file_id, fanout, '.enc', create=True))
+            latencies.append((time.perf_counter_ns() - before) / 1000)
+        results['create_us'] = summary(latencies, time.perf_counter() - started)
+
+        present = [blob_path(folder, file_id, fanout, '.enc')
+                   for file_id in random.sample(ids, min(lookups, count))]
+        missing = [blob_path(folder, str(uuid.uuid4()), fanout, '.enc') for _ in present]
+        results['stat_us'] = summary(*timed(present, os.path.exists))
+        results['stat_missing_us'] = summary(*timed(missing, os.path.exists))
+
+        started = time.perf_counter()
+        scanned = sum(1 for _ in iter_blobs(folder))
+        results['scan_seconds'] = round(time.perf_counter() - started, 2)
+        results['scanned'] = scanned
+
+        random.shuffle(ids)
+        results['unlink_us'] = summary(*timed(
+            (blob_path(folder, file_id, fanout, '.enc') for file_id in ids), os.remove))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Flat versus sharded uploads folder.")
+    parser.add_argument('--counts', type=int, nargs='+', default=[10000, 1000000, 5000000])
+    parser.add_argument('--layouts', nargs='+', default=list(LAYOUTS), choices=list(LAYOUTS))
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--directory', default=None,
+                        help="where to create the folders (default: the temporary folder)")
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    random.seed(1)
+    write_report({'results': [run(layout, count, args.lookups, args.directory)
+                              for count in args.counts for layout in args.layouts]},
+                 args.output)
+
+
+if __name__ == '__main__':
+    main()
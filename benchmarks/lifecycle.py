@@ -0,0 +1,331 @@
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from benchmarks.common import (REPO, multipart, percentiles, process_stats, process_tree,
+                               start_server, stop_server, write_report)
+
+###############################################################################
+# SHARE LIFECYCLE BENCHMARK
+#
+#   python -m benchmarks.lifecycle --output results.json
+#   python -m benchmarks.lifecycle --baseline baseline.json --tolerance 0.15
+#
+# Drives the whole life of a share, as many times as --operations says:
+#
+#   POST /upload      a valid container of a size drawn from --sizes
+#   GET /download/<id>
+#   GET /file/<id>    the ciphertext, checked for length
+#   GET /file/<id>    again, without the download token: must be a 404
+#
+# once per --concurrency level, against the app in this process (Flask test
+# client, no sockets) and under gunicorn on a localhost port (--modes). Rate
+# limits and quotas are turned off. Sizes are "size:weight" pairs, e.g. the
+# default "64KB:60,1MB:30,16MB:10"; which size each operation gets comes from
+# --seed, so runs are repeatable.
+#
+# Each scenario reports operations/s, MB/s each way, p50/p95/p99
+# latency of every step and of whole operations, peak RSS and bytes read
+# from and written to disk (from /proc: the benchmark process in process,
+# which includes the client; the gunicorn master and workers otherwise).
+#
+# With --baseline, scenarios are compared with those of the same name in an
+# earlier report: throughput lower, or p95 latency or peak RSS higher, by more
+# than --tolerance counts as a regression (latency only if also more than
+# --min-delta-ms slower), and the exit status is 1. Compare only runs from
+# the same machine.
+###############################################################################
+
+STEPS = ('upload', 'page', 'file', 'refetch')
+_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    for unit in ('GB', 'MB', 'KB', 'B'):
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * _UNITS[unit])
+    return int(text)
+
+
+def parse_sizes(spec):
+    # "64KB:60,1MB:30" -> [(65536, 60.0), (1048576, 30.0)]
+    sizes = []
+    for item in spec.split(','):
+        size, _, weight = item.partition(':')
+        sizes.append((parse_size(size), float(weight or 1)))
+    return sizes
+
+
+def make_containers(sizes):
+    # One upload body per size: a valid container holding that much random
+    # plaintext, with its multipart encoding.
+    sys.path.insert(0, REPO)
+    import container
+    key = os.urandom(32)
+    bodies = {}
+    for size, _ in sizes:
+        blob = container.encrypt(key, os.urandom(size))
+        content_type, body = multipart([
+            ('encrypted_filename', None, b'AQ' + b'A' * 40),
+            ('file', 'blob', blob),
+        ])
+        bodies[size] = (content_type, body, len(blob))
+    return bodies
+
+
+class HTTPClient:
+    # A new connection per request, like independent browsers.
+
+    def __init__(self, base):
+        parsed = urllib.parse.urlsplit(base)
+        self.host = parsed.hostname
+        self.port = parsed.port
+
+    def request(self, method, path, body=None, headers=None):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=300)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+
+class InProcessClient:
+    # Flask's test client on the app imported into this process.
+
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, path, body=None, headers=None):
+        client = self.app.test_client(use_cookies=False)
+        response = client.open(path, method=method, data=body, headers=headers or {})
+        try:
+            return response.status_code, response.get_data()
+        finally:
+            response.close()
+
+
+def operation(client, content_type, body, size):
+    # Run one lifecycle; returns {step: seconds}.
+    times = {}
+    started = time.perf_counter()
+    status, page = client.request('POST', '/upload', body, {'Content-Type': content_type})
+    times['upload'] = time.perf_counter() - started
+    if status != 200:
+        raise BenchmarkError("upload: %d" % status)
+    marker = page.index(b'/download/') + len(b'/download/')
+    file_id = page[marker:marker + 64].split(b'#')[0].decode('ascii')
+
+    started = time.perf_counter()
+    status, _ = client.request('GET', '/download/' + file_id)
+    times['page'] = time.perf_counter() - started
+    if status != 200:
+        raise BenchmarkError("download page: %d" % status)
+
+    started = time.perf_counter()
+    status, data = client.request('GET', '/file/' + file_id)
+    times['file'] = time.perf_counter() - started
+    if status != 200 or len(data) != size:
+        raise BenchmarkError("file: %d, %d of %d bytes" % (status, len(data), size))
+
+    started = time.perf_counter()
+    status, _ = client.request('GET', '/file/' + file_id)
+    times['refetch'] = time.perf_counter() - started
+    if status != 404:
+        raise BenchmarkError("second fetch: %d, expected 404" % status)
+    return times
+
+
+def run_scenario(client, plan, bodies, concurrency):
+    # Run the planned operations (a list of sizes) on `concurrency` threads.
+    samples = {step: [] for step in STEPS + ('operation',)}
+    errors = []
+    uploaded = [0]
+    lock = threading.Lock()
+    queue = list(reversed(plan))
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                size = queue.pop()
+            content_type, body, blob_size = bodies[size]
+            try:
+                times = operation(client, content_type, body, blob_size)
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+                continue
+            with lock:
+                for step, seconds in times.items():
+                    samples[step].append(seconds)
+                samples['operation'].append(sum(times.values()))
+                uploaded[0] += blob_size
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    completed = len(samples['operation'])
+    return {
+        'operations': completed,
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'seconds': elapsed,
+        'ops_per_second': completed / elapsed,
+        # Ciphertext per second in each direction: every file is uploaded
+        # and downloaded once.
+        'mb_per_s': uploaded[0] / 1048576 / elapsed,
+        'latency_ms': {step: {name: value * 1000 if value is not None else None
+                              for name, value in percentiles(values).items()}
+                       for step, values in samples.items()},
+    }
+
+
+def in_process_app(directory):
+    # Import the app with `directory` as its working directory, limits off.
+    os.chdir(directory)
+    sys.path.insert(0, REPO)
+    import app as benchmarked
+    benchmarked.app.config['REQUESTS_PER_SECOND'] = 0
+    benchmarked.app.config['UPLOAD_BYTES_PER_DAY'] = 0
+    benchmarked.app.config['MAX_STORED_BYTES'] = 0
+    return benchmarked.app
+
+
+def io_delta(before, after):
+    stats = dict(after)
+    for name in ('disk_read_bytes', 'disk_write_bytes'):
+        stats[name] = after[name] - before[name]
+    return stats
+
+
+def compare(scenarios, baseline, tolerance, min_delta_ms=2.0):
+    # Regressions of `scenarios` against a baseline report, as strings.
+    # Latency changes below min_delta_ms are noise, whatever their ratio.
+    previous = {scenario['name']: scenario for scenario in baseline.get('scenarios', ())}
+    regressions = []
+    for scenario in scenarios:
+        old = previous.get(scenario['name'])
+        if old is None:
+            continue
+        if scenario['ops_per_second'] < old['ops_per_second'] * (1 - tolerance):
+            regressions.append("%s: %.1f ops/s, baseline %.1f" % (
+                scenario['name'], scenario['ops_per_second'], old['ops_per_second']))
+        for step, values in scenario['latency_ms'].items():
+            old_p95 = old['latency_ms'].get(step, {}).get('p95')
+            if (values['p95'] is not None and old_p95
+                    and values['p95'] > old_p95 * (1 + tolerance)
+                    and values['p95'] - old_p95 > min_delta_ms):
+                regressions.append("%s: %s p95 %.1f ms, baseline %.1f ms" % (
+                    scenario['name'], step, values['p95'], old_p95))
+        if scenario['peak_rss_bytes'] > old['peak_rss_bytes'] * (1 + tolerance):
+            regressions.append("%s: peak RSS %d MB, baseline %d MB" % (
+                scenario['name'], scenario['peak_rss_bytes'] >> 20, old['peak_rss_bytes'] >> 20))
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Upload/download lifecycle benchmark.")
+    parser.add_argument('--modes', nargs='+', choices=('inprocess', 'gunicorn'),
+                        default=['inprocess', 'gunicorn'])
+    parser.add_argument('--sizes', default='64KB:60,1MB:30,16MB:10',
+                        help="size:weight pairs of the uploaded files")
+    parser.add_argument('--operations', type=int, default=200, help="lifecycles per scenario")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--workers', type=int, default=4, help="gunicorn workers")
+    parser.add_argument('--worker-class', default='sync', help="gunicorn worker class")
+    parser.add_argument('--threads', type=int, default=1, help="threads per gunicorn worker")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write the report here as JSON (default: stdout)")
+    parser.add_argument('--baseline', help="earlier report to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    parser.add_argument('--min-delta-ms', type=float, default=2.0,
+                        help="ignore latency increases smaller than this")
+    args = parser.parse_args(argv)
+
+    sizes = parse_sizes(args.sizes)
+    bodies = make_containers(sizes)
+    rng = random.Random(args.seed)
+    plan = rng.choices([size for size, _ in sizes], [weight for _, weight in sizes],
+                       k=args.operations)
+
+    scenarios = []
+    cwd = os.getcwd()
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as directory:
+            if mode == 'inprocess':
+                client = InProcessClient(in_process_app(directory))
+                server = None
+            else:
+                server, base = start_server(directory, args.workers, limits=False,
+                                            worker_class=args.worker_class, threads=args.threads)
+                client = HTTPClient(base)
+            try:
+                for concurrency in args.concurrency:
+                    pids = [os.getpid()] if server is None else process_tree(server.pid)
+                    before = process_stats(pids)
+                    result = run_scenario(client, plan, bodies, concurrency)
+                    if server is not None:
+                        pids = process_tree(server.pid)
+                    result.update(io_delta(before, process_stats(pids)))
+                    result['name'] = '%s/c%d' % (mode, concurrency)
+                    result['mode'] = mode
+                    result['concurrency'] = concurrency
+                    scenarios.append(result)
+            finally:
+                os.chdir(cwd)
+                if server is not None:
+                    stop_server(server)
+
+    report = {
+        'benchmark': 'lifecycle',
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'settings': {'sizes': args.sizes, 'operations': args.operations, 'seed': args.seed,
+                     'workers': args.workers, 'worker_class': args.worker_class,
+                     'threads': args.threads},
+        'scenarios': scenarios,
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(scenarios, json.load(f), args.tolerance, args.min_delta_ms)
+        report['regressions'] = regressions
+    write_report(report, args.output)
+    if regressions:
+        for regression in regressions:
+            print("REGRESSION " + regression, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import importlib
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.common import REPO, checkout, percentiles, write_report
+
+###############################################################################
+# RATE LIMIT BENCHMARK
+#
+#   python -m benchmarks.limits --clients 200000 --decisions 200000
+#   python -m benchmarks.limits --backends sqlite --processes 4 --baseline HEAD~1
+#
+# Synthetic requests-per-second decisions (take() with the app's default
+# rate and burst) for random clients out of --clients, first with no
+# buckets (every client new), then once each client has one. Reports
+# decisions per second over all --processes (each with its own limiter; the
+# SQLite ones share one database, like gunicorn workers) and the latency of
+# a decision. --baseline also runs the limits.py of that git revision.
+###############################################################################
+
+RATE = 10
+BURST = 50
+
+
+def decide(source, backend, path, keys, decisions, start, results):
+    sys.path.insert(0, source)
+    limits = importlib.import_module('limits')
+    if backend == 'memory':
+        limiter = limits.MemoryRateLimiter(len(keys))
+    else:
+        limiter = limits.SQLiteRateLimiter(path, len(keys))
+    random.seed(os.getpid())
+    phases = {}
+    for phase, sequence in (('new', keys), ('known', random.choices(keys, k=decisions))):
+        start.wait()
+        times = []
+        refused = 0
+        started = time.perf_counter()
+        for key in sequence:
+            before = time.perf_counter_ns()
+            if limiter.take(key, 1, RATE, BURST):
+                refused += 1
+            times.append((time.perf_counter_ns() - before) / 1000)
+        phases[phase] = (len(sequence), time.perf_counter() - started, times, refused)
+    results.put(phases)
+
+
+def run(source, backend, clients, decisions, processes):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'limits.db')
+        # Each process starts with its own clients, as in front of several
+        # workers, and then draws from all of them.
+        keys = ['%024x:requests' % random.getrandbits(96) for _ in range(clients)]
+        share = -(-clients // processes)
+        start = multiprocessing.Barrier(processes)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(
+            target=decide, args=(source, backend, path, keys[n * share:(n + 1) * share],
+                                 decisions // processes, start, results))
+            for n in range(processes)]
+        for worker in workers:
+            worker.start()
+        reports = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+    result = {'backend': backend, 'processes': processes}
+    for phase in ('new', 'known'):
+        count = sum(report[phase][0] for report in reports)
+        # The processes run at once: the slowest one sets the rate.
+        seconds = max(report[phase][1] for report in reports)
+        times = [t for report in reports for t in report[phase][2]]
+        result[phase] = {
+            'decisions': count,
+            'decisions_per_second': round(count / seconds),
+            'refused': sum(report[phase][3] for report in reports),
+            'latency_us': {k: round(v, 2) for k, v in percentiles(times).items()},
+        }
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rate limit decision benchmark.")
+    parser.add_argument('--clients', type=int, default=200000)
+    parser.add_argument('--decisions', type=int, default=200000)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--backends', nargs='+', default=['memory', 'sqlite'],
+                        choices=['memory', 'sqlite'])
+    parser.add_argument('--baseline', help="git revision to compare against")
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    random.seed(1)
+    report = {'clients': args.clients, 'results': []}
+    with tempfile.TemporaryDirectory() as baseline:
+        sources = [('current', REPO)]
+        if args.baseline:
+            checkout(args.baseline, baseline)
+            sources.append((args.baseline, baseline))
+        for name, source in sources:
+            for backend in args.backends:
+                result = run(source, backend, args.clients, args.decisions, args.processes)
+                report['results'].append(dict(result, version=name))
+    write_report(report, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import argparse
+import http.client
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from benchmarks.common import (REPO, multipart, percentiles, process_stats, process_tree,
+                               start_server, stop_server, write_report)
+
+###############################################################################
+# UPLOAD OVERLOAD BENCHMARK
+#
+#   python -m benchmarks.overload --clients 32 --uploads 4 --size 16777216
+#
+# A burst of uploads against a disk with only --headroom bytes to spare:
+# --clients threads at once each upload --uploads shares of --size bytes,
+# and download (and acknowledge, which deletes it) every other one straight
+# away, so some space comes back while the burst goes on. Run twice under gunicorn
+# (gthread workers):
+#
+# - admission: the hard watermark is the disk usage at the start plus
+#   --headroom, the soft one halfway there (both as byte counts, see
+#   admission.py);
+# - unlimited: both watermarks at 1.0, so only a full disk would stop an
+#   upload.
+#
+# Disk use of the filesystem holding the uploads (and, here, the temporary
+# folder) and RSS of the server processes are sampled every 50 ms. With
+# admission, peak disk growth should stay within --headroom and the rest of
+# the burst get 503s; without it, growth is all the bytes kept plus those in
+# flight. Other processes writing to the same filesystem skew the numbers.
+###############################################################################
+
+SAMPLE_INTERVAL = 0.05
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def request(base, method, path, body=None, headers=None):
+    parsed = urllib.parse.urlsplit(base)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=300)
+    try:
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+        except (BrokenPipeError, ConnectionResetError):
+            # A rejected upload is answered, and the connection closed,
+            # before its body is read; the response is still there.
+            pass
+        response = conn.getresponse()
+        return response.status, response.headers, response.read()
+    finally:
+        conn.close()
+
+
+def disk_used(directory):
+    # As admission.py counts it: everything not free to this user.
+    usage = shutil.disk_usage(directory)
+    return usage.total - usage.free
+
+
+def current_rss(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/%d/status' % pid) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+class Sampler(threading.Thread):
+    # Peak disk growth of `directory`'s filesystem and peak summed RSS of
+    # the server's processes.
+
+    def __init__(self, directory, server_pid):
+        super().__init__(daemon=True)
+        self.directory = directory
+        self.server_pid = server_pid
+        self.baseline = disk_used(directory)
+        self.peak_disk = 0
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak_disk = max(self.peak_disk,
+                                 disk_used(self.directory) - self.baseline)
+            self.peak_rss = max(self.peak_rss, current_rss(process_tree(self.server_pid)))
+            time.sleep(SAMPLE_INTERVAL)
+
+
+def run(base, server, directory, blob, clients, uploads):
+    content_type, body = multipart([
+        ('encrypted_filename', None, b'AQ' + b'A' * 40),
+        ('file', 'blob', blob),
+    ])
+    lock = threading.Lock()
+    statuses = {}
+    upload_times = []
+    errors = []
+
+    def client():
+        for n in range(uploads):
+            started = time.perf_counter()
+            try:
+                status, _, page = request(base, 'POST', '/upload', body,
+                                          {'Content-Type': content_type})
+                with lock:
+                    statuses[status] = statuses.get(status, 0) + 1
+                    upload_times.append(time.perf_counter() - started)
+                if status != 200 or n % 2:
+                    continue
+                file_id = re.search(rb'/download/([0-9a-z-]+)', page).group(1).decode()
+                status, headers, data = request(base, 'GET', '/file/' + file_id)
+                if status != 200 or len(data) != len(blob):
+                    raise BenchmarkError("file: %d, %d of %d bytes" % (status, len(data),
+                                                                        len(blob)))
+                # Acknowledge it, as the download page does, so the file is
+                # deleted now rather than after the grace period.
+                token = re.search(r'download_token=([^;]+)', headers['Set-Cookie']).group(1)
+                status, _, _ = request(base, 'DELETE', '/file/' + file_id,
+                                       headers={'Cookie': 'download_token=' + token})
+                if status != 204:
+                    raise BenchmarkError("acknowledge: %d" % status)
+            except Exception as e:
+                errors.append(repr(e))
+
+    sampler = Sampler(directory, server.pid)
+    sampler.start()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    sampler.stopped.set()
+    sampler.join()
+    stats = process_stats(process_tree(server.pid))
+    return {
+        'uploads': dict(sorted((str(status), count) for status, count in statuses.items())),
+        'errors': errors[:5],
+        'seconds': round(elapsed, 2),
+        'upload_s': {name: round(value, 2) if value is not None else None
+                     for name, value in percentiles(upload_times).items()},
+        'peak_disk_growth_bytes': sampler.peak_disk,
+        'peak_rss_total_bytes': sampler.peak_rss,
+        'peak_rss_bytes': stats['peak_rss_bytes'],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Upload burst against a nearly full disk.")
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--uploads', type=int, default=4, help="uploads per client")
+    parser.add_argument('--size', type=int, default=16 * 1024 * 1024,
+                        help="plaintext bytes per file")
+    parser.add_argument('--headroom', type=int, default=256 * 1024 * 1024,
+                        help="bytes the disk may grow by with admission control")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--scenarios', nargs='+', default=['admission', 'unlimited'],
+                        choices=['admission', 'unlimited'])
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    sys.path.insert(0, REPO)
+    import container
+    blob = container.encrypt(os.urandom(32), os.urandom(args.size))
+    free = shutil.disk_usage(tempfile.gettempdir()).free
+    worst = args.clients * args.uploads * len(blob) * 2
+    if 'unlimited' in args.scenarios and worst > free * 0.9:
+        parser.error("the unlimited run may need %d bytes; %d are free" % (worst, free))
+    results = []
+    for scenario in args.scenarios:
+        with tempfile.TemporaryDirectory() as directory:
+            if scenario == 'admission':
+                used = disk_used(directory)
+                env = {'SECURE_SHARE_UPLOAD_SOFT_WATERMARK': str(used + args.headroom // 2),
+                       'SECURE_SHARE_UPLOAD_HARD_WATERMARK': str(used + args.headroom)}
+            else:
+                env = {'SECURE_SHARE_UPLOAD_SOFT_WATERMARK': '1.0',
+                       'SECURE_SHARE_UPLOAD_HARD_WATERMARK': '1.0'}
+            server, base = start_server(directory, args.workers, limits=False,
+                                        worker_class='gthread', threads=args.clients, env=env)
+            try:
+                result = run(base, server, directory, blob, args.clients, args.uploads)
+            finally:
+                stop_server(server)
+        result['scenario'] = scenario
+        results.append(result)
+    write_report({'clients': args.clients, 'uploads_per_client': args.uploads,
+                  'upload_bytes': len(blob), 'headroom_bytes': args.headroom,
+                  'results': results}, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from benchmarks.common import REPO, multipart, start_server, stop_server, write_report
+
+###############################################################################
+# PAGE WEIGHT BENCHMARK
+#
+#   python -m benchmarks.pages
+#   python -m benchmarks.pages --url http://127.0.0.1:5000 --browser
+#
+# Bytes on the wire and load time of the upload, help and download pages for
+# a cold visit (empty cache: the page and its same-origin stylesheet and
+# scripts) and a warm one (the page revalidated with its ETag where it has
+# one; the assets are fresh in the cache and not requested). The third-party
+# CDN files are the same in every version and left out. "First paint" is the
+# time to the page and its stylesheet, what the browser needs to paint.
+#
+# With --browser (needs playwright and chromium, see browser.py), the real
+# first-contentful-paint of a cold and a warm visit is measured as well.
+#
+# By default the app runs under gunicorn in a temporary directory; --url
+# measures a running server instead, e.g. an older version for comparison.
+###############################################################################
+
+ACCEPT_ENCODING = 'br, gzip'
+
+
+def fetch(url, headers=None):
+    # (status, headers, body bytes, header bytes)
+    request = urllib.request.Request(url, headers=headers or {})
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        response = e
+    with response:
+        body = response.read()
+        header_bytes = len(str(response.headers).encode('latin-1')) + len('HTTP/1.1 200 OK\r\n')
+        return response.status, response.headers, body, header_bytes
+
+
+def create_share(base):
+    # Upload a small, valid container to get a download page.
+    sys.path.insert(0, REPO)
+    import container
+    blob = container.encrypt(os.urandom(32), os.urandom(1000))
+    content_type, body = multipart([
+        ('encrypted_filename', None, b'AQ' + b'A' * 40),
+        ('file', 'blob', blob),
+    ])
+    request = urllib.request.Request(base + '/upload', data=body,
+                                     headers={'Content-Type': content_type})
+    with urllib.request.urlopen(request) as response:
+        page = response.read().decode()
+    return re.search(r'/download/([0-9a-z-]+)', page).group(1)
+
+
+def same_origin_resources(html):
+    # Stylesheets first: they block rendering, scripts at the end do not.
+    styles = re.findall(r'<link rel="stylesheet" href="(/[^"]+)"', html)
+    scripts = re.findall(r'<script src="(/[^"]+)"', html)
+    return styles, scripts
+
+
+def decode_body(body, headers):
+    encoding = headers.get('Content-Encoding')
+    if encoding == 'br':
+        import brotli
+        return brotli.decompress(body)
+    if encoding == 'gzip':
+        import gzip
+        return gzip.decompress(body)
+    return body
+
+
+def cold_visit(base, path):
+    headers = {'Accept-Encoding': ACCEPT_ENCODING}
+    started = time.perf_counter()
+    _, response_headers, body, wire = fetch(base + path, headers)
+    wire += len(body)
+    styles, scripts = same_origin_resources(decode_body(body, response_headers).decode('utf-8'))
+    for url in styles:
+        _, _, asset, header_bytes = fetch(base + url, headers)
+        wire += len(asset) + header_bytes
+    first_paint = time.perf_counter() - started
+    for url in scripts:
+        _, _, asset, header_bytes = fetch(base + url, headers)
+        wire += len(asset) + header_bytes
+    return {'bytes': wire, 'first_paint': first_paint, 'load': time.perf_counter() - started,
+            'etag': response_headers.get('ETag')}
+
+
+def warm_visit(base, path, etag):
+    # The assets are fresh in the cache; only the page is requested, and
+    # revalidated if it has an ETag.
+    headers = {'Accept-Encoding': ACCEPT_ENCODING}
+    if etag:
+        headers['If-None-Match'] = etag
+    started = time.perf_counter()
+    status, _, body, header_bytes = fetch(base + path, headers)
+    return {'bytes': len(body) + header_bytes, 'load': time.perf_counter() - started,
+            'status': status}
+
+
+def measure(base, paths, runs):
+    results = []
+    for name, path in paths:
+        cold = [cold_visit(base, path) for _ in range(runs)]
+        warm = [warm_visit(base, path, cold[0]['etag']) for _ in range(runs)]
+        results.append({
+            'page': name,
+            'cold_bytes': cold[0]['bytes'],
+            'cold_first_paint_ms': min(run['first_paint'] for run in cold) * 1000,
+            'cold_load_ms': min(run['load'] for run in cold) * 1000,
+            'warm_bytes': warm[0]['bytes'],
+            'warm_status': warm[0]['status'],
+            'warm_load_ms': min(run['load'] for run in warm) * 1000,
+        })
+    return results
+
+
+def browser_paint(base, paths):
+    try:
+        from playwright.sync_api import sync_playwright
+    except ImportError:
+        sys.exit("--browser needs playwright: pip install playwright && "
+                 "python -m playwright install chromium")
+    script = ("performance.getEntriesByName('first-contentful-paint').map(e => e.startTime)[0]"
+              " || null")
+    results = []
+    with sync_playwright() as playwright:
+        browser = playwright.chromium.launch()
+        for name, path in paths:
+            context = browser.new_context()
+            page = context.new_page()
+            page.goto(base + path, wait_until='load')
+            cold = page.evaluate(script)
+            page.goto(base + path, wait_until='load')
+            warm = page.evaluate(script)
+            results.append({'page': name, 'cold_fcp_ms': cold, 'warm_fcp_ms': warm})
+            context.close()
+        browser.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Page weight and first paint benchmark.")
+    parser.add_argument('--url', help="measure this running server instead of starting one")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--browser', action='store_true',
+                        help="also measure first-contentful-paint in Chromium")
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        server = None
+        base = args.url.rstrip('/') if args.url else None
+        if base is None:
+            server, base = start_server(directory, 1)
+        try:
+            # A download page is consumed by downloading the file, not by
+            # viewing it, so one share serves every run.
+            paths = [('upload', '/'), ('help', '/help'),
+                     ('download', '/download/' + create_share(base))]
+            report = {'benchmark': 'pages', 'results': measure(base, paths, args.runs)}
+            if args.browser:
+                report['browser'] = browser_paint(base, paths)
+        finally:
+            if server is not None:
+                stop_server(server)
+
+    write_report(report, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+import argparse
+import http.client
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from benchmarks.common import REPO, multipart, percentiles, start_server, stop_server, write_report
+
+###############################################################################
+# PASSWORD-PROTECTED DOWNLOAD BENCHMARK
+#
+#   python -m benchmarks.passwords --processes 1 4 8 --clients 16
+#
+# Verified downloads per second for each size of the password hashing pool
+# (SECURE_SHARE_PASSWORD_PROCESSES). One verified download is
+#
+#   POST /download/<id>   the password; 303 with an access cookie
+#   GET /file/<id>        with the cookie, checked for length
+#
+# from --clients threads at once, against one gunicorn worker with enough
+# threads for all of them, so the KDF pool is the only limit. Shares allow
+# 100 downloads and are uploaded before the clock starts. Checks rejected
+# with 503 (pool and queue full) are counted, not retried. The KDF is CPU
+# bound: more processes than cores do not help.
+###############################################################################
+
+PASSWORD = 'benchmark password'
+DOWNLOADS_PER_SHARE = 100
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def request(base, method, path, body=None, headers=None):
+    parsed = urllib.parse.urlsplit(base)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=300)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.headers, response.read()
+    finally:
+        conn.close()
+
+
+def create_shares(base, count, size):
+    sys.path.insert(0, REPO)
+    import container
+    blob = container.encrypt(os.urandom(32), os.urandom(size))
+    shares = []
+    for _ in range(count):
+        content_type, body = multipart([
+            ('encrypted_filename', None, b'AQ' + b'A' * 40),
+            ('max_downloads', None, str(DOWNLOADS_PER_SHARE).encode()),
+            ('password', None, PASSWORD.encode()),
+            ('file', 'blob', blob),
+        ])
+        status, _, page = request(base, 'POST', '/upload', body, {'Content-Type': content_type})
+        if status != 200:
+            raise BenchmarkError("upload: %d" % status)
+        shares.append(re.search(rb'/download/([0-9a-z-]+)', page).group(1).decode())
+    return shares, len(blob)
+
+
+def verified_download(base, file_id, size):
+    # Returns the seconds the password check took, or None if it got a 503.
+    started = time.perf_counter()
+    status, headers, _ = request(
+        base, 'POST', '/download/' + file_id, urllib.parse.urlencode({'password': PASSWORD}),
+        {'Content-Type': 'application/x-www-form-urlencoded'})
+    verify = time.perf_counter() - started
+    if status == 503:
+        return None
+    if status != 303:
+        raise BenchmarkError("password: %d" % status)
+    cookie = re.search(r'share_access=([^;]+)', headers['Set-Cookie']).group(1)
+    status, _, data = request(base, 'GET', '/file/' + file_id,
+                              headers={'Cookie': 'share_access=' + cookie})
+    if status != 200 or len(data) != size:
+        raise BenchmarkError("file: %d, %d of %d bytes" % (status, len(data), size))
+    return verify
+
+
+def run(base, shares, size, downloads, clients):
+    slots = [file_id for file_id in shares for _ in range(DOWNLOADS_PER_SHARE)][:downloads]
+    lock = threading.Lock()
+    verify_times = []
+    rejected = []
+    errors = []
+
+    def client():
+        while True:
+            with lock:
+                if not slots:
+                    return
+                file_id = slots.pop()
+            try:
+                verify = verified_download(base, file_id, size)
+            except Exception as e:
+                errors.append(repr(e))
+                continue
+            if verify is None:
+                rejected.append(file_id)
+            else:
+                verify_times.append(verify)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'downloads': len(verify_times),
+        'rejected_503': len(rejected),
+        'errors': errors[:5],
+        'seconds': round(elapsed, 2),
+        'downloads_per_second': round(len(verify_times) / elapsed, 1),
+        'verify_ms': {name: round(value * 1000, 1) if value is not None else None
+                      for name, value in percentiles(verify_times).items()},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Password-protected download benchmark.")
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--downloads', type=int, default=500)
+    parser.add_argument('--size', type=int, default=64 * 1024, help="plaintext bytes per file")
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    results = []
+    for processes in args.processes:
+        with tempfile.TemporaryDirectory() as directory:
+            server, base = start_server(
+                directory, 1, limits=False, worker_class='gthread', threads=args.clients,
+                env={'SECURE_SHARE_PASSWORD_PROCESSES': str(processes)})
+            try:
+                shares, size = create_shares(base, -(-args.downloads // DOWNLOADS_PER_SHARE),
+                                             args.size)
+                result = run(base, shares, size, args.downloads, args.clients)
+            finally:
+                stop_server(server)
+        result['processes'] = processes
+        results.append(result)
+    write_report({'cpus': os.cpu_count(), 'clients': args.clients, 'results': results},
+                 args.output)
+
+
+if __name__ == '__main__':
+    main()
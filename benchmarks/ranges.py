@@ -0,0 +1,155 @@
+import argparse
+import http.client
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from benchmarks.common import REPO, multipart, start_server, stop_server, write_report
+
+###############################################################################
+# PARALLEL RANGE DOWNLOAD BENCHMARK
+#
+#   python -m benchmarks.ranges --size 67108864 --parallel 1 2 4 8
+#
+# Download throughput of one share fetched as N parallel Range requests,
+# for each N in --parallel, --rounds times each. A round uploads a fresh
+# share, claims it with a one-byte Range request (which sets the download
+# token cookie), then fetches N equal slices on connections of their own
+# with that cookie, and checks the reassembled file. The clock covers the
+# claim and the slices.
+#
+# On localhost nothing limits a single connection but the CPU, so the gain
+# is small. Real paths often cap each TCP connection (window size over a
+# long round trip, per-flow shaping), which is what parallel ranges work
+# around: --connection-rate caps every connection at that many bytes/s on
+# the client side to model it.
+###############################################################################
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def request(base, method, path, body=None, headers=None, rate=0):
+    # (status, headers, body); with `rate`, the body is read no faster than
+    # that many bytes/s.
+    parsed = urllib.parse.urlsplit(base)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=300)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        if not rate:
+            return response.status, response.headers, response.read()
+        chunks = []
+        received = 0
+        started = time.perf_counter()
+        while True:
+            chunk = response.read(64 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            received += len(chunk)
+            delay = received / rate - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+        return response.status, response.headers, b''.join(chunks)
+    finally:
+        conn.close()
+
+
+def upload(base, blob):
+    content_type, body = multipart([
+        ('encrypted_filename', None, b'AQ' + b'A' * 40),
+        ('file', 'blob', blob),
+    ])
+    status, _, page = request(base, 'POST', '/upload', body, {'Content-Type': content_type})
+    if status != 200:
+        raise BenchmarkError("upload: %d" % status)
+    return re.search(rb'/download/([0-9a-z-]+)', page).group(1).decode()
+
+
+def download(base, file_id, size, parallel, rate):
+    # Claim the share, then fetch it as `parallel` slices at once.
+    path = '/file/' + file_id
+    status, headers, _ = request(base, 'GET', path, headers={'Range': 'bytes=0-0'})
+    if status != 206:
+        raise BenchmarkError("claim: %d" % status)
+    cookie = headers['Set-Cookie'].split(';')[0]
+    bounds = [size * n // parallel for n in range(parallel + 1)]
+    parts = [None] * parallel
+    errors = []
+
+    def fetch(n):
+        start, end = bounds[n], bounds[n + 1]
+        status, _, data = request(base, 'GET', path, headers={
+            'Cookie': cookie, 'Range': 'bytes=%d-%d' % (start, end - 1)}, rate=rate)
+        if status != 206 or len(data) != end - start:
+            errors.append("range %d-%d: %d, %d bytes" % (start, end, status, len(data)))
+        parts[n] = data
+
+    threads = [threading.Thread(target=fetch, args=(n,)) for n in range(parallel)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise BenchmarkError("; ".join(errors))
+    return b''.join(parts)
+
+
+def run(base, blob, parallel, rounds, rate):
+    seconds = []
+    for _ in range(rounds):
+        file_id = upload(base, blob)
+        started = time.perf_counter()
+        data = download(base, file_id, len(blob), parallel, rate)
+        seconds.append(time.perf_counter() - started)
+        if data != blob:
+            raise BenchmarkError("reassembled file differs")
+    best = min(seconds)
+    return {
+        'parallel': parallel,
+        'seconds': round(best, 3),
+        'mb_per_s': round(len(blob) / 1048576 / best, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Throughput of parallel Range downloads.")
+    parser.add_argument('--size', type=int, default=64 * 1024 * 1024,
+                        help="plaintext bytes per file")
+    parser.add_argument('--parallel', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--connection-rate', type=int, default=0,
+                        help="bytes/s each connection may receive (0: unlimited)")
+    parser.add_argument('--serve-mode', default='sendfile', choices=['sendfile', 'stream'])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    sys.path.insert(0, REPO)
+    import container
+    blob = container.encrypt(os.urandom(32), os.urandom(args.size))
+    with tempfile.TemporaryDirectory() as directory:
+        server, base = start_server(directory, args.workers, limits=False,
+                                    worker_class='gthread', threads=args.threads,
+                                    env={'SECURE_SHARE_FILE_SERVE_MODE': args.serve_mode})
+        try:
+            results = [run(base, blob, parallel, args.rounds, args.connection_rate)
+                       for parallel in args.parallel]
+        finally:
+            stop_server(server)
+    single = results[0]['seconds']
+    for result in results:
+        result['speedup'] = round(single / result['seconds'], 2)
+    write_report({'cpus': os.cpu_count(), 'file_bytes': len(blob),
+                  'serve_mode': args.serve_mode, 'connection_rate': args.connection_rate,
+                  'results': results}, args.output)
+
+
+if __name__ == '__main__':
+    main()
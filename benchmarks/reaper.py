@@ -0,0 +1,119 @@
+import argparse
+import os
+import tempfile
+import time
+import uuid
+
+from benchmarks.common import write_report
+from expiry import Reaper
+from metadata import MemoryMetadataStore, SQLiteMetadataStore
+from storage import LocalStorage
+
+###############################################################################
+# REAPER BENCHMARK
+#
+#   python -m benchmarks.reaper --records 1000000 --expired 0.5
+#
+# Fills a metadata store with --records synthetic shares, of which the
+# fraction --expired is already past its expiry and the rest expires in a
+# week. Then it times Reaper.reap():
+#
+# - the pass that removes every expired record, in batches of
+#   --batch-size, as records/s;
+# - a second pass with nothing due, which should stay cheap whatever the
+#   size of the store, since the expiry index is read from its start.
+#
+# By default the records point at files that do not exist, so each
+# deletion costs one failed unlink. With --files, every expired record gets
+# a real empty file in the fan-out tree, created before the clock starts.
+###############################################################################
+
+BATCH = 10000
+WEEK = 7 * 24 * 3600
+
+
+def records(count, expired_fraction, storage, create_files, now):
+    # Batches of (file_id, record), expired ones first.
+    expired = int(count * expired_fraction)
+    for start in range(0, count, BATCH):
+        batch = []
+        for n in range(start, min(count, start + BATCH)):
+            file_id = str(uuid.uuid4())
+            path = storage.location(file_id)
+            if n < expired:
+                expires_at = now - 1 - n % 3600
+                if create_files:
+                    open(path, 'wb').close()
+            else:
+                expires_at = now + WEEK
+            batch.append((file_id, {
+                'encrypted_filename': b'\x01' + os.urandom(52),
+                'filepath': path,
+                'downloaded': False,
+                'created_at': now - 3600,
+                'expires_at': expires_at,
+                'size': 1024 * 1024,
+                'owner': 'benchmark',
+            }))
+        yield batch
+
+
+def run(backend, count, expired_fraction, batch_size, create_files):
+    with tempfile.TemporaryDirectory() as directory:
+        folder = os.path.join(directory, 'uploads')
+        os.makedirs(folder)
+        storage = LocalStorage(folder, (2, 2))
+        if backend == 'sqlite':
+            store = SQLiteMetadataStore(os.path.join(directory, 'metadata.db'))
+        else:
+            store = MemoryMetadataStore()
+        now = time.time()
+        started = time.perf_counter()
+        for batch in records(count, expired_fraction, storage, create_files, now):
+            store.add_many(batch)
+        fill = time.perf_counter() - started
+        reaper = Reaper(store, storage, folder, os.path.join(directory, 'reaper.lock'),
+                        batch_size=batch_size)
+
+        started = time.perf_counter()
+        removed = reaper.reap(now)
+        seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        idle_removed = reaper.reap(now)
+        idle = time.perf_counter() - started
+        remaining = store.count()
+        store.close()
+    return {
+        'backend': backend,
+        'records': count,
+        'files': create_files,
+        'fill_seconds': round(fill, 2),
+        'removed': removed,
+        'remaining': remaining,
+        'reap_seconds': round(seconds, 2),
+        'records_per_second': round(removed / seconds) if seconds else None,
+        'idle_pass_ms': round(idle * 1000, 2),
+        'idle_removed': idle_removed,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reaper throughput on a large store.")
+    parser.add_argument('--records', type=int, default=1000000)
+    parser.add_argument('--expired', type=float, default=0.5,
+                        help="fraction of the records that has expired")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--files', action='store_true',
+                        help="create a real file for every expired record")
+    parser.add_argument('--backends', nargs='+', default=['sqlite', 'memory'],
+                        choices=['sqlite', 'memory'])
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    write_report({'batch_size': args.batch_size,
+                  'results': [run(backend, args.records, args.expired, args.batch_size,
+                                  args.files)
+                              for backend in args.backends]}, args.output)
+
+
+if __name__ == '__main__':
+    main()
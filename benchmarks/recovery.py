@@ -0,0 +1,118 @@
+import argparse
+import os
+import tempfile
+import time
+import uuid
+
+from benchmarks.common import write_report
+from metadata import MemoryMetadataStore
+from sidecars import Sidecars, encode_sidecar, rebuild_index, save_snapshot
+from storage import blob_path
+
+###############################################################################
+# INDEX RECOVERY BENCHMARK
+#
+#   python -m benchmarks.recovery --entries 100000 1000000
+#
+# Cold start of the memory metadata backend, which keeps its index in this
+# process only. For each --entries count, an uploads tree (the default 2,2
+# fan-out) of that many shares, each an empty blob and its sidecar, then:
+#
+#   scan      rebuild_index() from the sidecars, as after a crash
+#   save      save_snapshot() of the index, as on a clean exit
+#   snapshot  rebuild_index() from that snapshot, as on the next start
+#
+# in seconds, with records per second and the sizes on disk. With
+# --drop-caches (root only) the page cache is dropped before each step, so
+# every read goes to the disk.
+###############################################################################
+
+FANOUT = (2, 2)
+
+
+def drop_caches():
+    os.sync()
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3\n')
+
+
+def populate(folder, entries):
+    # Write `entries` shares' blobs and sidecars. Returns the sidecar bytes.
+    now = time.time()
+    written = 0
+    for _ in range(entries):
+        file_id = str(uuid.uuid4())
+        filepath = blob_path(folder, file_id, FANOUT, '.enc', create=True)
+        open(filepath, 'wb').close()
+        sidecar = encode_sidecar({
+            'encrypted_filename': os.urandom(40),
+            'filepath': filepath,
+            'downloaded': False,
+            'created_at': now,
+            'expires_at': now + 86400,
+            'size': 1048576,
+            'sha256': os.urandom(32),
+            'owner': os.urandom(16).hex(),
+            'downloads': 0,
+            'max_downloads': 1,
+        })
+        with open(blob_path(folder, file_id, FANOUT, '.meta'), 'wb') as f:
+            f.write(sidecar)
+        written += len(sidecar)
+    return written
+
+
+def timed(step, drop):
+    if drop:
+        drop_caches()
+    started = time.perf_counter()
+    result = step()
+    return result, time.perf_counter() - started
+
+
+def run(entries, workers, drop):
+    with tempfile.TemporaryDirectory() as folder:
+        sidecar_bytes = populate(folder, entries)
+        sidecars = Sidecars(folder, FANOUT, sync_blobs=False)
+        lock = os.path.join(folder, 'rebuild.lock')
+        snapshot = os.path.join(folder, 'index.snapshot')
+
+        def blob_exists(record):
+            return os.path.exists(record['filepath'])
+
+        store = MemoryMetadataStore()
+        restored, scan = timed(lambda: rebuild_index(store, sidecars, lock, workers,
+                                                     blob_exists), drop)
+        saved, save = timed(lambda: save_snapshot(store, snapshot), drop)
+        snapshot_bytes = os.path.getsize(snapshot)
+        del store
+        store = MemoryMetadataStore()
+        loaded, load = timed(lambda: rebuild_index(store, sidecars, lock, workers, blob_exists,
+                                                   snapshot=snapshot), drop)
+        if not restored == saved == loaded == entries:
+            raise RuntimeError("restored %d, saved %d, loaded %d of %d"
+                               % (restored, saved, loaded, entries))
+    return {
+        'entries': entries,
+        'sidecar_bytes': sidecar_bytes,
+        'snapshot_bytes': snapshot_bytes,
+        'seconds': {'scan': round(scan, 2), 'save': round(save, 2),
+                    'snapshot': round(load, 2)},
+        'per_second': {'scan': round(entries / scan), 'snapshot': round(entries / load)},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index recovery benchmark.")
+    parser.add_argument('--entries', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--workers', type=int, default=8, help="threads reading sidecars")
+    parser.add_argument('--drop-caches', action='store_true',
+                        help="drop the page cache before each step (needs root)")
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    write_report({'results': [run(entries, args.workers, args.drop_caches)
+                              for entries in args.entries]}, args.output)
+
+
+if __name__ == '__main__':
+    main()
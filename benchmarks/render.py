@@ -0,0 +1,132 @@
+import argparse
+import http.client
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from benchmarks.common import (REPO, checkout, multipart, percentiles, start_server, stop_server,
+                               write_report)
+
+###############################################################################
+# PAGE RENDERING BENCHMARK
+#
+#   python -m benchmarks.render --before <revision>
+#
+# Requests per second for GET /, /help and /download/<id>, each --requests
+# times from --clients threads, against one gunicorn sync worker. The
+# download page belongs to a share uploaded first; fetching the page does not
+# use the share up. Requests accept gzip, as browsers do.
+#
+# With --before, the same runs are made against that git revision of the
+# repository (extracted with git archive), e.g. one from before the pages
+# were pre-rendered, and the report has a row for each. One worker keeps the
+# comparison fair for old versions that held shares in per-process memory.
+###############################################################################
+
+PAGES = ('/', '/help', '/download/<id>')
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def request(base, method, path, body=None, headers=None):
+    parsed = urllib.parse.urlsplit(base)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=300)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def create_share(base):
+    sys.path.insert(0, REPO)
+    import container
+    blob = container.encrypt(os.urandom(32), os.urandom(1000))
+    content_type, body = multipart([
+        ('encrypted_filename', None, b'AQ' + b'A' * 40),
+        ('file', 'blob', blob),
+    ])
+    status, page = request(base, 'POST', '/upload', body, {'Content-Type': content_type})
+    if status != 200:
+        raise BenchmarkError("upload: %d" % status)
+    return re.search(rb'/download/([0-9a-z-]+)', page).group(1).decode()
+
+
+def run(base, path, requests, clients):
+    remaining = [requests]
+    lock = threading.Lock()
+    times = []
+    sizes = []
+    errors = []
+
+    def client():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            started = time.perf_counter()
+            status, body = request(base, 'GET', path, headers={'Accept-Encoding': 'gzip'})
+            seconds = time.perf_counter() - started
+            if status != 200:
+                errors.append("%s: %d" % (path, status))
+                continue
+            with lock:
+                times.append(seconds)
+                sizes.append(len(body))
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': len(times),
+        'errors': errors[:5],
+        'requests_per_second': round(len(times) / elapsed, 1),
+        'latency_ms': {name: round(value * 1000, 2) if value is not None else None
+                       for name, value in percentiles(times).items()},
+        'body_bytes': sizes[0] if sizes else None,
+    }
+
+
+def measure(source, requests, clients):
+    with tempfile.TemporaryDirectory() as directory:
+        server, base = start_server(directory, 1, limits=False, source=source)
+        try:
+            file_id = create_share(base)
+            return {page: run(base, page.replace('<id>', file_id), requests, clients)
+                    for page in PAGES}
+        finally:
+            stop_server(server)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Requests per second of the pages.")
+    parser.add_argument('--requests', type=int, default=2000, help="requests per page")
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--before', help="git revision to compare with the working tree")
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    results = []
+    if args.before:
+        with tempfile.TemporaryDirectory() as source:
+            checkout(args.before, source)
+            results.append({'version': args.before,
+                            'pages': measure(source, args.requests, args.clients)})
+    results.append({'version': 'working tree',
+                    'pages': measure(REPO, args.requests, args.clients)})
+    write_report({'clients': args.clients, 'results': results}, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+import argparse
+import http.client
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from benchmarks.common import (REPO, multipart, process_cpu, process_stats, process_tree,
+                               start_server, stop_server, write_report)
+
+###############################################################################
+# FILE SERVING BENCHMARK
+#
+#   python -m benchmarks.serving --size 67108864 --downloads 64
+#
+# Server CPU time per GB sent by GET /file/<id>, for each FILE_SERVE_MODE
+# in --modes (see serving.py). A few shares that together allow --downloads
+# downloads are uploaded first. Then --clients threads download them until
+# every download is used, each in full and checked for length. CPU is the
+# user + system time of the gunicorn master and workers over the download
+# phase only, from /proc.
+#
+# In the offload modes (x-accel-redirect, x-sendfile) the app only returns
+# headers, and a front proxy would send the file. Without one, the client
+# gets an empty body. Those rows show the app's share of the cost only, per
+# GB the proxy would have sent.
+###############################################################################
+
+SHARES = 4
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def request(base, method, path, body=None, headers=None):
+    parsed = urllib.parse.urlsplit(base)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=300)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def create_shares(base, blob, downloads):
+    content_type, body = multipart([
+        ('encrypted_filename', None, b'AQ' + b'A' * 40),
+        ('max_downloads', None, str(-(-downloads // SHARES)).encode()),
+        ('file', 'blob', blob),
+    ])
+    shares = []
+    for _ in range(SHARES):
+        status, page = request(base, 'POST', '/upload', body, {'Content-Type': content_type})
+        if status != 200:
+            raise BenchmarkError("upload: %d" % status)
+        shares.append(re.search(rb'/download/([0-9a-z-]+)', page).group(1).decode())
+    return shares
+
+
+def run(base, server, shares, size, downloads, clients, offload):
+    slots = [shares[n % len(shares)] for n in range(downloads)]
+    lock = threading.Lock()
+    # Bytes of the files fetched, and bytes the client actually received.
+    fetched = [0]
+    received = [0]
+    errors = []
+
+    def client():
+        while True:
+            with lock:
+                if not slots:
+                    return
+                file_id = slots.pop()
+            status, data = request(base, 'GET', '/file/' + file_id)
+            expected = 0 if offload else size
+            if status != 200 or len(data) != expected:
+                errors.append("file: %d, %d of %d bytes" % (status, len(data), expected))
+                continue
+            with lock:
+                fetched[0] += size
+                received[0] += len(data)
+
+    pids = process_tree(server.pid)
+    cpu = process_cpu(pids)
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    cpu = process_cpu(pids) - cpu
+    gigabytes = fetched[0] / 1024 ** 3
+    return {
+        'downloads': fetched[0] // size,
+        'errors': errors[:5],
+        'seconds': round(elapsed, 2),
+        'mb_per_s': round(received[0] / 1048576 / elapsed, 1),
+        'cpu_seconds': round(cpu, 2),
+        'cpu_seconds_per_gb': round(cpu / gigabytes, 3) if gigabytes else None,
+        'peak_rss_bytes': process_stats(pids)['peak_rss_bytes'],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Server CPU per GB for each serve mode.")
+    parser.add_argument('--modes', nargs='+', default=['sendfile', 'stream', 'x-accel-redirect'],
+                        choices=['sendfile', 'stream', 'x-accel-redirect', 'x-sendfile'])
+    parser.add_argument('--size', type=int, default=64 * 1024 * 1024,
+                        help="plaintext bytes per file")
+    parser.add_argument('--downloads', type=int, default=64)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    sys.path.insert(0, REPO)
+    import container
+    blob = container.encrypt(os.urandom(32), os.urandom(args.size))
+    results = []
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as directory:
+            server, base = start_server(directory, args.workers, limits=False,
+                                        env={'SECURE_SHARE_FILE_SERVE_MODE': mode})
+            try:
+                shares = create_shares(base, blob, args.downloads)
+                result = run(base, server, shares, len(blob), args.downloads, args.clients,
+                             mode in ('x-accel-redirect', 'x-sendfile'))
+            finally:
+                stop_server(server)
+        result['mode'] = mode
+        results.append(result)
+    write_report({'cpus': os.cpu_count(), 'file_bytes': len(blob), 'clients': args.clients,
+                  'results': results}, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+import argparse
+import asyncio
+import os
+import re
+import socket
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from benchmarks.common import (REPO, multipart, percentiles, process_cpu, process_stats,
+                               process_tree, start_asgi_server, start_server, stop_server,
+                               write_report)
+
+###############################################################################
+# SLOW CLIENTS LOAD TEST
+#
+#   python -m benchmarks.slowclients --clients 1000 --servers sync asgi
+#
+# --clients concurrent clients on slow links, against each server in
+# --servers, with --workers processes each:
+#
+#   sync    gunicorn sync workers (app:app), one request per worker at a time
+#   asgi    uvicorn running asgi.py (needs `pip install uvicorn`)
+#
+# For --kind download, every client GETs /file/<id> of a --size share (the
+# shares allow 100 downloads each) and reads it at --rate bytes/s, with a
+# small socket receive buffer so the kernel cannot absorb the file on the
+# client's behalf. For --kind upload, every client POSTs a --size file to
+# /upload, sending the body at --rate bytes/s. Meanwhile a probe GETs /help
+# every half second, as an impatient visitor would.
+#
+# The run stops after --duration seconds. Reported per server: clients that
+# finished, failed (an error status, or a connection cut short) or were
+# still waiting or transferring; the bytes moved and their rate; time to the
+# first response byte; the probe's latency and failures; peak RSS summed over
+# the server processes; and their CPU time.
+###############################################################################
+
+SHARE_DOWNLOADS = 100
+RECEIVE_BUFFER = 16 * 1024
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+async def open_connection(host, port):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, (host, port))
+    return await asyncio.open_connection(sock=sock, limit=RECEIVE_BUFFER)
+
+
+async def read_head(reader):
+    # (status, headers) of a response.
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            return status, headers
+        name, value = line.split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+
+
+async def paced(chunks, rate, started):
+    # Sleep as needed to keep `chunks` bytes since `started` at `rate` bytes/s.
+    delay = chunks / rate - (time.perf_counter() - started)
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+async def slow_client(host, port, request, body, rate, state):
+    # One client: send `request` and `body` (paced if there is a body), read
+    # the response (paced). Updates `state` as it goes.
+    reader, writer = await open_connection(host, port)
+    try:
+        started = time.perf_counter()
+        writer.write(request)
+        for offset in range(0, len(body), 16 * 1024):
+            writer.write(body[offset:offset + 16 * 1024])
+            await writer.drain()
+            state['bytes'] += min(16 * 1024, len(body) - offset)
+            await paced(offset + 16 * 1024, rate, started)
+        await writer.drain()
+        status, headers = await read_head(reader)
+        state['first_byte'] = time.perf_counter() - started
+        length = int(headers.get('content-length', 0))
+        received = 0
+        started = time.perf_counter()
+        while received < length:
+            chunk = await reader.read(min(16 * 1024, length - received))
+            if not chunk:
+                break
+            received += len(chunk)
+            if not body:
+                state['bytes'] += len(chunk)
+                await paced(received, rate, started)
+        state['result'] = 'finished' if status == 200 and received == length else 'failed'
+    except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+        state['result'] = 'failed'
+    finally:
+        writer.close()
+
+
+async def probe(host, port, latencies, failures, stop):
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(b'GET /help HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n')
+            status, _ = await asyncio.wait_for(read_head(reader), 5)
+            writer.close()
+            if status == 200:
+                latencies.append(time.perf_counter() - started)
+            else:
+                failures.append(status)
+        except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+            failures.append('timeout')
+        await asyncio.sleep(0.5)
+
+
+async def load(base, requests, rate, duration):
+    parsed = urllib.parse.urlsplit(base)
+    host, port = parsed.hostname, parsed.port
+    states = [{'result': None, 'first_byte': None, 'bytes': 0} for _ in requests]
+    latencies, failures = [], []
+    stop = asyncio.Event()
+    prober = asyncio.ensure_future(probe(host, port, latencies, failures, stop))
+    clients = [asyncio.ensure_future(slow_client(host, port, request, body, rate, state))
+               for (request, body), state in zip(requests, states)]
+    started = time.perf_counter()
+    await asyncio.wait(clients, timeout=duration)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    for client in clients:
+        client.cancel()
+    await asyncio.gather(prober, *clients, return_exceptions=True)
+    return states, latencies, failures, elapsed
+
+
+def milliseconds(samples):
+    return {name: round(value * 1000, 1) if value is not None else None
+            for name, value in percentiles(samples).items()}
+
+
+def upload(base, blob, downloads):
+    parsed = urllib.parse.urlsplit(base)
+    content_type, body = multipart([
+        ('encrypted_filename', None, b'AQ' + b'A' * 40),
+        ('max_downloads', None, str(downloads).encode()),
+        ('file', 'blob', blob),
+    ])
+    conn = socket.create_connection((parsed.hostname, parsed.port))
+    with conn, conn.makefile('rb') as f:
+        conn.sendall(upload_head(content_type, len(body)) + body)
+        page = f.read()
+    match = re.search(rb'/download/([0-9a-z-]+)', page)
+    if not match:
+        raise BenchmarkError("upload failed: %r" % page[:200])
+    return match.group(1).decode()
+
+
+def upload_head(content_type, length):
+    return ('POST /upload HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n'
+            'Content-Type: %s\r\nContent-Length: %d\r\n\r\n'
+            % (content_type, length)).encode()
+
+
+def client_requests(base, kind, blob, clients):
+    # [(request head, body)] for each client.
+    if kind == 'upload':
+        content_type, body = multipart([
+            ('encrypted_filename', None, b'AQ' + b'A' * 40),
+            ('file', 'blob', blob),
+        ])
+        return [(upload_head(content_type, len(body)), body)] * clients
+    shares = [upload(base, blob, SHARE_DOWNLOADS)
+              for _ in range(-(-clients // SHARE_DOWNLOADS))]
+    return [(('GET /file/%s HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n'
+              % shares[n // SHARE_DOWNLOADS]).encode(), b'')
+            for n in range(clients)]
+
+
+def run(server_kind, kind, blob, args):
+    with tempfile.TemporaryDirectory() as directory:
+        if server_kind == 'asgi':
+            server, base = start_asgi_server(directory, args.workers, limits=False)
+        else:
+            server, base = start_server(directory, args.workers, limits=False)
+        try:
+            requests = client_requests(base, kind, blob, args.clients)
+            cpu = process_cpu(process_tree(server.pid))
+            states, latencies, failures, elapsed = asyncio.run(
+                load(base, requests, args.rate, args.duration))
+            pids = process_tree(server.pid)
+            cpu = process_cpu(pids) - cpu
+            stats = process_stats(pids)
+        finally:
+            stop_server(server)
+    moved = sum(state['bytes'] for state in states)
+    first_bytes = [state['first_byte'] for state in states if state['first_byte'] is not None]
+    return {
+        'server': server_kind,
+        'kind': kind,
+        'finished': sum(1 for state in states if state['result'] == 'finished'),
+        'failed': sum(1 for state in states if state['result'] == 'failed'),
+        'unfinished': sum(1 for state in states if state['result'] is None),
+        'seconds': round(elapsed, 1),
+        'mb': round(moved / 1048576, 1),
+        'mb_per_s': round(moved / 1048576 / elapsed, 2),
+        'first_byte_ms': milliseconds(first_bytes),
+        'probe_ms': milliseconds(latencies),
+        'probe_failures': len(failures),
+        'peak_rss_total_bytes': stats['peak_rss_total_bytes'],
+        'cpu_seconds': round(cpu, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Many slow clients, sync workers versus ASGI.")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--servers', nargs='+', default=['sync', 'asgi'],
+                        choices=['sync', 'asgi'])
+    parser.add_argument('--kinds', nargs='+', default=['download', 'upload'],
+                        choices=['download', 'upload'])
+    parser.add_argument('--size', type=int, default=1024 * 1024, help="plaintext bytes per file")
+    parser.add_argument('--rate', type=int, default=64 * 1024,
+                        help="bytes/s each client sends or receives")
+    parser.add_argument('--duration', type=float, default=60, help="seconds")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    sys.path.insert(0, REPO)
+    import container
+    blob = container.encrypt(os.urandom(32), os.urandom(args.size))
+    write_report({'cpus': os.cpu_count(), 'clients': args.clients, 'file_bytes': len(blob),
+                  'rate': args.rate, 'workers': args.workers,
+                  'results': [run(server_kind, kind, blob, args)
+                              for kind in args.kinds for server_kind in args.servers]},
+                 args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from benchmarks.common import REPO, free_port, process_tree, write_report
+
+###############################################################################
+# STARTUP BENCHMARK
+#
+#   python -m benchmarks.startup --workers 4 --runs 5
+#
+# Cold start of a fresh instance, as a short-lived deployment sees it:
+#
+# - in process: a new interpreter imports the app, then serves GET / with
+#   the test client; time to import and to the first response, and RSS;
+# - gunicorn: time from spawning the server to the first 200 on /, for each
+#   --modes entry (see MODES); then every worker serves --requests pages and
+#   its memory is read from /proc/<pid>/smaps_rollup. RSS counts pages
+#   shared with the master; USS (private) does not, and is what each extra
+#   worker really costs. PSS splits shared pages between their users.
+#
+# Medians over --runs. Every run starts in an empty folder, so the uploads
+# folder, database and secret are created from scratch.
+###############################################################################
+
+# Name -> (gunicorn arguments, module:variable or factory call).
+MODES = {
+    'lazy': ([], 'app:app'),
+    'preload': (['--preload'], 'app:warmup()'),
+}
+
+IN_PROCESS = """
+import sys, time
+started = time.perf_counter()
+sys.path.insert(0, %r)
+import app
+imported = time.perf_counter()
+status = app.app.test_client().get('/').status_code
+served = time.perf_counter()
+with open('/proc/self/status') as f:
+    rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+print(status, imported - started, served - started, rss)
+"""
+
+
+def in_process(runs):
+    imports, firsts, rss = [], [], []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as directory:
+            output = subprocess.run([sys.executable, '-c', IN_PROCESS % REPO], cwd=directory,
+                                    capture_output=True, text=True, check=True).stdout
+        status, imported, served, resident = output.split()
+        if status != '200':
+            raise RuntimeError("GET / returned %s" % status)
+        imports.append(float(imported))
+        firsts.append(float(served))
+        rss.append(int(resident))
+    return {
+        'import_ms': round(statistics.median(imports) * 1000, 1),
+        'first_response_ms': round(statistics.median(firsts) * 1000, 1),
+        'rss_bytes': int(statistics.median(rss)),
+    }
+
+
+def memory(pid):
+    # (rss, pss, uss) of one process, in bytes.
+    values = {}
+    with open('/proc/%d/smaps_rollup' % pid) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == 'kB':
+                values[fields[0].rstrip(':')] = int(fields[1]) * 1024
+    return (values['Rss'], values['Pss'],
+            values.get('Private_Clean', 0) + values.get('Private_Dirty', 0))
+
+
+def get(url):
+    with urllib.request.urlopen(url) as response:
+        response.read()
+        return response.status
+
+
+def gunicorn(mode, workers, requests):
+    options, entry = MODES[mode]
+    port = free_port()
+    base = 'http://127.0.0.1:%d' % port
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '--pythonpath', REPO, '-w', str(workers),
+             '-b', '127.0.0.1:%d' % port] + options + [entry],
+            cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                try:
+                    if get(base + '/') == 200:
+                        break
+                except OSError:
+                    if server.poll() is not None or time.perf_counter() - started > 60:
+                        raise RuntimeError("gunicorn did not start")
+                    time.sleep(0.005)
+            first = time.perf_counter() - started
+            # Spread page loads over the workers (new connection each).
+            for n in range(requests * workers):
+                get(base + ('/', '/help')[n % 2])
+            pids = [pid for pid in process_tree(server.pid) if pid != server.pid]
+            workers_memory = [memory(pid) for pid in pids]
+            master = memory(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+    return first, master, workers_memory
+
+
+def run_gunicorn(mode, workers, requests, runs):
+    firsts, rss, pss, uss, master_rss = [], [], [], [], []
+    for _ in range(runs):
+        first, master, workers_memory = gunicorn(mode, workers, requests)
+        firsts.append(first)
+        master_rss.append(master[0])
+        rss.append(statistics.mean(m[0] for m in workers_memory))
+        pss.append(statistics.mean(m[1] for m in workers_memory))
+        uss.append(statistics.mean(m[2] for m in workers_memory))
+    return {
+        'mode': mode,
+        'first_response_ms': round(statistics.median(firsts) * 1000, 1),
+        'master_rss_bytes': int(statistics.median(master_rss)),
+        'worker_rss_bytes': int(statistics.median(rss)),
+        'worker_pss_bytes': int(statistics.median(pss)),
+        'worker_uss_bytes': int(statistics.median(uss)),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cold start time and per-worker memory.")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=20, help="page loads per worker")
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    write_report({
+        'workers': args.workers,
+        'in_process': in_process(args.runs),
+        'gunicorn': [run_gunicorn(mode, args.workers, args.requests, args.runs)
+                     for mode in args.modes],
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+import argparse
+import http.client
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from benchmarks.common import (REPO, multipart, percentiles, process_stats, process_tree,
+                               start_server, stop_server, write_report)
+
+###############################################################################
+# UPLOAD PATH BENCHMARK
+#
+#   python -m benchmarks.uploads --sizes 16777216 134217728 --uploads 8
+#
+# The same ciphertext uploaded two ways, for each of --sizes:
+#
+#   form      one POST /upload (multipart/form-data)
+#   chunked   POST /upload/start, PUT /upload/<id>/chunk/<n> for every
+#             chunk (up to --chunk-concurrency at once, as the upload page
+#             sends them), POST /upload/<id>/finish
+#
+# --uploads files per scenario, from --clients threads at once. Every
+# scenario gets a fresh gunicorn (--workers sync workers), so the peak RSS
+# read from /proc afterwards (largest worker, and the sum over the master
+# and workers) is that scenario's own. Reports MB/s of ciphertext and
+# p50/p95/p99 time per upload.
+###############################################################################
+
+METHODS = ('form', 'chunked')
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def request(base, method, path, body=None, headers=None):
+    parsed = urllib.parse.urlsplit(base)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=300)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def form_upload(base, blob):
+    content_type, body = multipart([
+        ('encrypted_filename', None, b'AQ' + b'A' * 40),
+        ('size', None, str(len(blob)).encode()),
+        ('file', 'blob', blob),
+    ])
+    status, _ = request(base, 'POST', '/upload', body, {'Content-Type': content_type})
+    if status != 200:
+        raise BenchmarkError("upload: %d" % status)
+
+
+def chunked_upload(base, blob, concurrency):
+    body = urllib.parse.urlencode({'encrypted_filename': 'AQ' + 'A' * 40, 'size': len(blob)})
+    status, data = request(base, 'POST', '/upload/start', body,
+                           {'Content-Type': 'application/x-www-form-urlencoded'})
+    if status != 200:
+        raise BenchmarkError("start: %d" % status)
+    session = json.loads(data)
+    chunks = list(range(session['chunks']))
+    lock = threading.Lock()
+    errors = []
+
+    def sender():
+        while True:
+            with lock:
+                if not chunks:
+                    return
+                n = chunks.pop(0)
+            start = n * session['chunk_size']
+            chunk = memoryview(blob)[start:start + session['chunk_size']]
+            status, _ = request(base, 'PUT', '/upload/%s/chunk/%d' % (session['upload_id'], n),
+                                chunk, {'Content-Type': 'application/octet-stream'})
+            if status != 204:
+                errors.append("chunk %d: %d" % (n, status))
+
+    threads = [threading.Thread(target=sender) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise BenchmarkError(errors[0])
+    status, page = request(base, 'POST', '/upload/%s/finish' % session['upload_id'])
+    if status != 200 or not re.search(rb'/download/', page):
+        raise BenchmarkError("finish: %d" % status)
+
+
+def run(base, server, method, blob, uploads, clients, chunk_concurrency):
+    remaining = [uploads]
+    lock = threading.Lock()
+    times = []
+    errors = []
+
+    def client():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            started = time.perf_counter()
+            try:
+                if method == 'form':
+                    form_upload(base, blob)
+                else:
+                    chunked_upload(base, blob, chunk_concurrency)
+            except Exception as e:
+                errors.append(repr(e))
+                continue
+            with lock:
+                times.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stats = process_stats(process_tree(server.pid))
+    return {
+        'uploads': len(times),
+        'errors': errors[:5],
+        'seconds': round(elapsed, 2),
+        'mb_per_s': round(len(times) * len(blob) / 1048576 / elapsed, 1),
+        'upload_ms': {name: round(value * 1000, 1) if value is not None else None
+                      for name, value in percentiles(times).items()},
+        'peak_rss_bytes': stats['peak_rss_bytes'],
+        'peak_rss_total_bytes': stats['peak_rss_total_bytes'],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chunked upload versus POST /upload.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16 * 1024 * 1024],
+                        help="plaintext bytes per file")
+    parser.add_argument('--uploads', type=int, default=8, help="uploads per scenario")
+    parser.add_argument('--clients', type=int, default=2)
+    parser.add_argument('--chunk-concurrency', type=int, default=3,
+                        help="chunk PUTs in flight per chunked upload")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--methods', nargs='+', default=list(METHODS), choices=METHODS)
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    sys.path.insert(0, REPO)
+    import container
+    results = []
+    for size in args.sizes:
+        blob = container.encrypt(os.urandom(32), os.urandom(size))
+        for method in args.methods:
+            with tempfile.TemporaryDirectory() as directory:
+                server, base = start_server(directory, args.workers, limits=False)
+                try:
+                    result = run(base, server, method, blob, args.uploads, args.clients,
+                                 args.chunk_concurrency)
+                finally:
+                    stop_server(server)
+            result.update(method=method, upload_bytes=len(blob))
+            results.append(result)
+    write_report({'clients': args.clients, 'workers': args.workers, 'results': results},
+                 args.output)
+
+
+if __name__ == '__main__':
+    main()
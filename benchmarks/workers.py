@@ -0,0 +1,154 @@
+import argparse
+import http.client
+import os
+import re
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import container
+from benchmarks.common import multipart, percentiles, start_server, stop_server, write_report
+
+###############################################################################
+# METADATA STORE UNDER SEVERAL WORKERS
+#
+#   python -m benchmarks.workers --workers 1 4 16 --shares 200
+#
+# For each --workers count, a fresh gunicorn (sync workers) with the SQLite
+# metadata store, which every worker shares, and --clients threads, each on
+# connections of its own:
+#
+#   upload    POST /upload of --shares shares of --size bytes
+#   lookup    GET /download/<id> of random shares, --lookups in all: one
+#             metadata lookup and the download page
+#   download  GET /file/<id> of every share, claiming it
+#
+# Any request may land on any worker, so a share uploaded by one worker must
+# be found by the others: every lookup must be a 200 and every download the
+# whole file. Reports uploads and downloads per second and MB/s, and
+# p50/p95/p99 latency of each request in milliseconds.
+###############################################################################
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def request(base, method, path, body=None, headers=None):
+    parsed = urllib.parse.urlsplit(base)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=300)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def upload(base, blob):
+    content_type, body = multipart([
+        ('encrypted_filename', None, b'AQ' + b'A' * 40),
+        ('file', 'blob', blob),
+    ])
+    status, page = request(base, 'POST', '/upload', body, {'Content-Type': content_type})
+    if status != 200:
+        raise BenchmarkError("upload: %d" % status)
+    return re.search(rb'/download/([0-9a-z-]+)', page).group(1).decode()
+
+
+def lookup(base, file_id):
+    status, _ = request(base, 'GET', '/download/' + file_id)
+    if status != 200:
+        raise BenchmarkError("lookup: %d" % status)
+
+
+def download(base, file_id, size):
+    status, data = request(base, 'GET', '/file/' + file_id)
+    if status != 200 or len(data) != size:
+        raise BenchmarkError("download: %d, %d bytes" % (status, len(data)))
+
+
+def in_parallel(clients, tasks):
+    # Run the callables in `tasks` from `clients` threads. Returns the
+    # results, the seconds each took and the wall-clock seconds in all.
+    tasks = list(enumerate(tasks))
+    results = [None] * len(tasks)
+    times = []
+    errors = []
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if not tasks:
+                    return
+                n, task = tasks.pop()
+            started = time.perf_counter()
+            try:
+                results[n] = task()
+            except Exception as e:
+                errors.append(repr(e))
+                continue
+            with lock:
+                times.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise BenchmarkError(errors[0])
+    return results, times, time.perf_counter() - started
+
+
+def summary(count, size, times, seconds):
+    result = {
+        'requests': count,
+        'per_second': round(count / seconds, 1),
+        'ms': {name: round(value * 1000, 2) for name, value in percentiles(times).items()},
+    }
+    if size:
+        result['mb_per_s'] = round(count * size / 1048576 / seconds, 1)
+    return result
+
+
+def run(workers, shares, size, lookups, clients):
+    blob = container.encrypt(os.urandom(32), os.urandom(size))
+    with tempfile.TemporaryDirectory() as directory:
+        server, base = start_server(directory, workers, limits=False)
+        try:
+            file_ids, times, seconds = in_parallel(
+                clients, [lambda: upload(base, blob)] * shares)
+            result = {'workers': workers, 'upload': summary(shares, len(blob), times, seconds)}
+            _, times, seconds = in_parallel(
+                clients, [lambda file_id=file_ids[n % shares]: lookup(base, file_id)
+                          for n in range(lookups)])
+            result['lookup'] = summary(lookups, 0, times, seconds)
+            _, times, seconds = in_parallel(
+                clients, [lambda file_id=file_id: download(base, file_id, len(blob))
+                          for file_id in file_ids])
+            result['download'] = summary(shares, len(blob), times, seconds)
+        finally:
+            stop_server(server)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Metadata store benchmark across workers.")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--shares', type=int, default=200)
+    parser.add_argument('--size', type=int, default=1024 * 1024,
+                        help="plaintext bytes per share")
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--output', help="write the results here as JSON (default: stdout)")
+    args = parser.parse_args(argv)
+    write_report({'results': [run(workers, args.shares, args.size, args.lookups, args.clients)
+                              for workers in args.workers]}, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+import hmac
+import http.client
+import queue
+import re
+import time
+import urllib.parse
+import uuid
+
+from storage import BlobStream
+
+###############################################################################
+# MULTIPLE NODES
+#
+# Several app hosts can sit behind one load balancer, each with its own
+# uploads folder and metadata store. A share lives on the node that received
+# its upload, and its id says which one: in a cluster, ids end in the name
+# of the node that created them,
+#
+#   3085d8bf-799a-4013-a092-386aca250471-n2
+#
+# so finding the owner needs no lookup and keeps working when nodes are
+# added. Ids without a node name (single-node installs, shares created
+# before clustering) belong to whichever node has them.
+#
+# A request for another node's share is handed off to the owner. Download
+# pages and files are either redirected to the owner's public URL or proxied
+# to its internal URL (HANDOFF_MODE). Chunked upload calls are always
+# proxied, as a browser does not follow a redirected PUT to another origin.
+#
+# Proxied requests carry the cluster secret in a header. The owner trusts
+# such a request as forwarded: it serves it itself (never hands it on, so a
+# misconfigured node cannot loop) and does not rate-limit it again.
+#
+# Proxied fetches reuse keep-alive connections from a per-node pool, and
+# request and response bodies are streamed in fixed-size pieces. Sync
+# gunicorn workers close every connection; run the nodes with
+# --worker-class gthread (or uvicorn) for the pool to help.
+###############################################################################
+
+FORWARDED_HEADER = 'X-Secure-Share-Forwarded'
+HANDOFF_MODES = ('proxy', 'redirect')
+_NODE_NAME = re.compile(r'[a-z][a-z0-9]{0,15}$')
+
+# Request headers passed to the owner; everything else (Host, hop-by-hop
+# headers, the client's own forwarding headers) stays behind.
+_REQUEST_HEADERS = ('Accept-Encoding', 'Content-Length', 'Content-Type', 'Cookie',
+                    'If-None-Match', 'If-Range', 'Range', 'User-Agent')
+_HOP_BY_HOP = frozenset(('connection', 'keep-alive', 'proxy-authenticate',
+                         'proxy-authorization', 'te', 'trailer', 'transfer-encoding',
+                         'upgrade'))
+
+
+class ProxyError(Exception):
+    pass
+
+
+def parse_nodes(value):
+    # "n1=http://10.0.0.1:8000,n2=http://10.0.0.2:8000" -> {'n1': ..., 'n2': ...}
+    nodes = {}
+    for item in filter(None, (part.strip() for part in (value or '').split(','))):
+        name, sep, url = item.partition('=')
+        if not sep or not _NODE_NAME.match(name):
+            raise ValueError("Invalid node %r: expected name=url, name [a-z][a-z0-9]*" % (item,))
+        nodes[name] = url.rstrip('/')
+    return nodes
+
+
+def node_of(file_id):
+    # Name of the node in a share id, or None for a plain UUID.
+    parts = file_id.split('-')
+    return parts[5] if len(parts) == 6 else None
+
+
+class ConnectionPool:
+    # Keep-alive HTTP connections to one node. A connection is taken for one
+    # request and returned once its response has been read to the end.
+    # Connections idle for more than max_idle seconds are dropped rather
+    # than reused, as the node may be closing them (gunicorn's keep-alive
+    # timeout is 2 seconds); a request with a body cannot be retried.
+
+    def __init__(self, url, size=16, timeout=30, buffer_size=64 * 1024, max_idle=1.0):
+        parsed = urllib.parse.urlsplit(url)
+        self.https = parsed.scheme == 'https'
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.prefix = parsed.path.rstrip('/')
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        self.max_idle = max_idle
+        self._idle = queue.LifoQueue(size)
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout, blocksize=self.buffer_size)
+
+    def get(self):
+        # (connection, whether it was used before)
+        while True:
+            try:
+                conn, since = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect(), False
+            if time.monotonic() - since <= self.max_idle:
+                return conn, True
+            conn.close()
+
+    def put(self, conn):
+        try:
+            self._idle.put_nowait((conn, time.monotonic()))
+        except queue.Full:
+            conn.close()
+
+    def request(self, method, path, headers, body=None):
+        # Send a request and return (connection, response). A reused
+        # connection the node has meanwhile closed is replaced, as long as
+        # there is no body that was already read from the client.
+        while True:
+            conn, reused = self.get()
+            try:
+                conn.request(method, self.prefix + path, body=body, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                if not reused or body is not None:
+                    raise ProxyError(str(e))
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise ProxyError(str(e))
+
+    def stream(self, conn, response):
+        # BlobStream over the response body. The connection goes back to the
+        # pool only if the body was read in full.
+        def chunks():
+            while True:
+                data = response.read(self.buffer_size)
+                if not data:
+                    break
+                yield data
+            state['done'] = True
+
+        def close():
+            body.close()
+            if state['done'] and not response.will_close:
+                self.put(conn)
+            else:
+                conn.close()
+
+        state = {'done': False}
+        body = chunks()
+        return BlobStream(body, response.length, close=close)
+
+
+class Cluster:
+    def __init__(self, name, nodes, public_urls=None, secret=b'', pool_size=16, timeout=30,
+                 buffer_size=64 * 1024):
+        if nodes and name not in nodes:
+            raise ValueError("This node (%r) is not in the node list" % (name,))
+        if nodes and not secret:
+            raise ValueError("A cluster needs a shared secret")
+        self.name = name if nodes else None
+        self.nodes = nodes
+        self.public_urls = public_urls or nodes
+        self.secret = secret
+        self.pools = {node: ConnectionPool(url, pool_size, timeout, buffer_size)
+                      for node, url in nodes.items() if node != name}
+
+    def new_id(self):
+        file_id = str(uuid.uuid4())
+        return file_id + '-' + self.name if self.name else file_id
+
+    def owner(self, file_id):
+        # The other node that owns this share, or None if it is ours (or its
+        # node is no longer configured).
+        node = node_of(file_id)
+        return node if node in self.pools else None
+
+    def is_forwarded(self, headers):
+        value = headers.get(FORWARDED_HEADER)
+        return bool(self.secret and value
+                    and hmac.compare_digest(value.encode('latin-1'), self.secret))
+
+    def public_url(self, node, path, query=''):
+        return self.public_urls[node] + path + ('?' + query if query else '')
+
+    def forward(self, node, method, path, headers, body=None, client=None):
+        # Proxy a request to `node`. Returns (status, headers, BlobStream);
+        # raises ProxyError if the node cannot be reached.
+        forwarded = {name: headers[name] for name in _REQUEST_HEADERS if name in headers}
+        forwarded[FORWARDED_HEADER] = self.secret.decode('latin-1')
+        if client:
+            forwarded['X-Forwarded-For'] = client
+        if body is not None and 'Content-Length' not in forwarded:
+            raise ProxyError("Request bodies must have a Content-Length")
+        pool = self.pools[node]
+        conn, response = pool.request(method, path, forwarded, body)
+        response_headers = [(name, value) for name, value in response.getheaders()
+                            if name.lower() not in _HOP_BY_HOP]
+        return response.status, response_headers, pool.stream(conn, response)
@@ -0,0 +1,171 @@
+import io
+import os
+import struct
+
+###############################################################################
+# SEGMENTED AES-GCM CONTAINER (version 1)
+#
+# Reference implementation of the format produced by the browser client. The
+# server only needs parse_header()/validate_container(); the encoder and
+# decoder exist so the format can be tested and benchmarked without a browser
+# and need the optional `cryptography` package.
+#
+# Layout:
+#
+#   header (32 bytes, big-endian)
+#     0   4  magic "SSEC"
+#     4   1  version (1)
+#     5   3  reserved, zero
+#     8   4  segment size (plaintext bytes per segment)
+#     12  8  plaintext size
+#     20  7  random nonce prefix
+#     27  5  reserved, zero
+#   segments
+#     ceil(plaintext size / segment size) segments (at least one), each the
+#     AES-GCM encryption of one plaintext segment followed by its 16-byte tag.
+#
+# Segment i is encrypted with nonce = prefix || uint32(i) || last-flag, where
+# last-flag is 1 only for the final segment, and with the whole header as
+# additional authenticated data. Segments therefore cannot be reordered,
+# dropped, or truncated, and the header cannot be altered, without failing
+# authentication.
+###############################################################################
+
+MAGIC = b'SSEC'
+VERSION = 1
+HEADER_SIZE = 32
+TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+DEFAULT_SEGMENT_SIZE = 1024 * 1024  # 1 MiB
+MIN_SEGMENT_SIZE = 4 * 1024  # 4 KiB
+MAX_SEGMENT_SIZE = 16 * 1024 * 1024  # 16 MiB
+
+_HEADER = struct.Struct('>4sB3sIQ7s5s')
+
+
+class ContainerError(ValueError):
+    pass
+
+
+def segment_count(plaintext_size, segment_size):
+    return max(1, -(-plaintext_size // segment_size))
+
+
+def ciphertext_size(plaintext_size, segment_size):
+    return HEADER_SIZE + plaintext_size + TAG_SIZE * segment_count(plaintext_size, segment_size)
+
+
+def build_header(plaintext_size, segment_size=DEFAULT_SEGMENT_SIZE, nonce_prefix=None):
+    if nonce_prefix is None:
+        nonce_prefix = os.urandom(NONCE_PREFIX_SIZE)
+    return _HEADER.pack(MAGIC, VERSION, bytes(3), segment_size, plaintext_size,
+                        nonce_prefix, bytes(5))
+
+
+def parse_header(data):
+    # Return the header fields as a dict, or raise ContainerError.
+    if len(data) < HEADER_SIZE:
+        raise ContainerError("Truncated container header")
+    magic, version, reserved1, segment_size, plaintext_size, nonce_prefix, reserved2 = \
+        _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ContainerError("Not an encrypted container")
+    if version != VERSION:
+        raise ContainerError("Unsupported container version %d" % version)
+    if any(reserved1) or any(reserved2):
+        raise ContainerError("Reserved header bytes must be zero")
+    if not MIN_SEGMENT_SIZE <= segment_size <= MAX_SEGMENT_SIZE:
+        raise ContainerError("Invalid segment size %d" % segment_size)
+    return {
+        'version': version,
+        'segment_size': segment_size,
+        'plaintext_size': plaintext_size,
+        'nonce_prefix': nonce_prefix,
+    }
+
+
+def validate_container(header_bytes, total_size):
+    # Check a header against the number of bytes actually uploaded.
+    header = parse_header(header_bytes)
+    expected = ciphertext_size(header['plaintext_size'], header['segment_size'])
+    if expected != total_size:
+        raise ContainerError("Container should be %d bytes, got %d" % (expected, total_size))
+    return header
+
+
+def segment_nonce(nonce_prefix, index, last):
+    return nonce_prefix + struct.pack('>IB', index, 1 if last else 0)
+
+
+def _aesgcm(key):
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        raise RuntimeError("The container encoder/decoder requires the 'cryptography' package")
+    return AESGCM(key)
+
+
+def _read_exact(src, size):
+    data = src.read(size)
+    while len(data) < size:
+        more = src.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def encrypt_stream(key, src, dest, plaintext_size, segment_size=DEFAULT_SEGMENT_SIZE):
+    # Encrypt `plaintext_size` bytes from file-like `src` into `dest`, holding
+    # at most one segment in memory.
+    aesgcm = _aesgcm(key)
+    header = build_header(plaintext_size, segment_size)
+    nonce_prefix = header[20:20 + NONCE_PREFIX_SIZE]
+    dest.write(header)
+    count = segment_count(plaintext_size, segment_size)
+    remaining = plaintext_size
+    for index in range(count):
+        length = min(segment_size, remaining)
+        plaintext = _read_exact(src, length)
+        if len(plaintext) != length:
+            raise ContainerError("Plaintext ended early")
+        remaining -= length
+        nonce = segment_nonce(nonce_prefix, index, index == count - 1)
+        dest.write(aesgcm.encrypt(nonce, plaintext, header))
+    return HEADER_SIZE + plaintext_size + TAG_SIZE * count
+
+
+def decrypt_stream(key, src, dest):
+    # Decrypt a container from `src` into `dest`, one segment at a time.
+    aesgcm = _aesgcm(key)
+    header_bytes = _read_exact(src, HEADER_SIZE)
+    header = parse_header(header_bytes)
+    segment_size = header['segment_size']
+    count = segment_count(header['plaintext_size'], segment_size)
+    remaining = header['plaintext_size']
+    for index in range(count):
+        length = min(segment_size, remaining)
+        ciphertext = _read_exact(src, length + TAG_SIZE)
+        if len(ciphertext) != length + TAG_SIZE:
+            raise ContainerError("Container is truncated")
+        remaining -= length
+        nonce = segment_nonce(header['nonce_prefix'], index, index == count - 1)
+        try:
+            dest.write(aesgcm.decrypt(nonce, ciphertext, header_bytes))
+        except Exception:
+            raise ContainerError("Segment %d failed authentication" % index)
+    if src.read(1):
+        raise ContainerError("Trailing data after final segment")
+    return header['plaintext_size']
+
+
+def encrypt(key, plaintext, segment_size=DEFAULT_SEGMENT_SIZE):
+    out = io.BytesIO()
+    encrypt_stream(key, io.BytesIO(plaintext), out, len(plaintext), segment_size)
+    return out.getvalue()
+
+
+def decrypt(key, data):
+    out = io.BytesIO()
+    decrypt_stream(key, io.BytesIO(data), out)
+    return out.getvalue()
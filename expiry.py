@@ -0,0 +1,196 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from metrics import EXPIRED, registry
+from sidecars import SIDECAR_SUFFIX
+from storage import iter_blobs
+
+logger = logging.getLogger(__name__)
+
+###############################################################################
+# EXPIRY REAPER
+#
+# Shares that are never downloaded, and chunked uploads that are never
+# finished, expire after their TTL. A background thread deletes them in
+# batches, reading the store's expiry index so each pass only touches entries
+# that are actually due.
+#
+# Every gunicorn worker starts a Reaper, but only the one holding an
+# exclusive flock on the lock file does any work; the others keep retrying
+# the lock so a new reaper takes over if that worker dies.
+#
+# When a worker becomes the reaper it first reconciles blob storage and the
+# staging folder with the store: files without metadata (e.g. from a crash,
+# or from before metadata was persisted) and metadata without files are
+# removed, as are sidecars (see sidecars.py) without a record. Anything
+# younger than `grace` seconds is left alone, since another worker may be
+# between writing a file and recording it.
+###############################################################################
+
+
+class Reaper:
+    def __init__(self, store, storage, staging_folder, lock_path, interval=60.0,
+                 batch_size=500, grace=600.0, claimed_suffix='.claimed', part_suffix='.part',
+                 sidecars=None):
+        self.store = store
+        self.storage = storage
+        self.staging_folder = staging_folder
+        self.lock_path = lock_path
+        self.interval = interval
+        self.batch_size = batch_size
+        self.grace = grace
+        self.claimed_suffix = claimed_suffix
+        self.part_suffix = part_suffix
+        self.sidecars = sidecars
+        self._lock_file = None
+        self._reconciled = False
+        self._pid = None
+        self._stop = threading.Event()
+
+    def start(self):
+        # Safe to call from every worker; starts at most one thread each.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._lock_file = None
+        self._reconciled = False
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, name='reaper', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _acquire(self):
+        if self._lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self._acquire():
+                    if not self._reconciled:
+                        self.reconcile()
+                        self._reconciled = True
+                    self.reap()
+            except Exception:
+                logger.exception("Reaper pass failed")
+            self._stop.wait(self.interval)
+
+    def _remove_staged(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def reap(self, now=None):
+        # Delete everything that has expired by `now`. Returns the number of
+        # files and upload sessions removed.
+        now = time.time() if now is None else now
+        removed = 0
+        while True:
+            batch = self.store.expired(now, self.batch_size)
+            if not batch:
+                break
+            for file_id, record in batch:
+                self.storage.delete(record['filepath'])
+                if self.storage.is_local:
+                    self.storage.delete(record['filepath'] + self.claimed_suffix)
+            self.store.delete_many([file_id for file_id, _ in batch])
+            registry.inc(EXPIRED, len(batch), kind='file')
+            removed += len(batch)
+        while True:
+            batch = self.store.expired_uploads(now, self.batch_size)
+            if not batch:
+                break
+            for upload_id, session in batch:
+                self._remove_staged(session['filepath'])
+                self.store.delete_upload(upload_id)
+            registry.inc(EXPIRED, len(batch), kind='upload')
+            removed += len(batch)
+        return removed
+
+    def _blobs(self):
+        # (name, location, mtime, is_staged) for everything to reconcile:
+        # stored blobs plus staged chunked uploads and sidecars. With local
+        # storage they all live under the same folder.
+        for name, location, mtime in self.storage.iter_blobs():
+            yield name, location, mtime, name.endswith(self.part_suffix)
+        if not self.storage.is_local:
+            for entry in iter_blobs(self.staging_folder):
+                if entry.name.endswith(self.part_suffix) or self._is_sidecar(entry.name):
+                    try:
+                        mtime = entry.stat().st_mtime
+                    except FileNotFoundError:
+                        continue
+                    yield entry.name, entry.path, mtime, True
+
+    def _is_sidecar(self, name):
+        return self.sidecars is not None and (name.endswith(SIDECAR_SUFFIX)
+                                              or name.endswith(SIDECAR_SUFFIX + '.tmp'))
+
+    def _reconcile_sidecar(self, name, location):
+        # Remove a leftover temporary file, or a sidecar without a record. A
+        # sidecar outside its current place (the fan-out changed) is moved.
+        file_id = name[:name.index(SIDECAR_SUFFIX)]
+        record = None if name.endswith('.tmp') else self.store.get(file_id)
+        if record is None:
+            self._remove_staged(location)
+            return 1
+        if location != self.sidecars.path(file_id):
+            self.sidecars.write(file_id, record)
+            self._remove_staged(location)
+        return 0
+
+    def reconcile(self, now=None):
+        # Make storage and the store agree. Returns the number of orphaned
+        # blobs and records removed.
+        now = time.time() if now is None else now
+        removed = 0
+        for name, location, mtime, is_staged in self._blobs():
+            if mtime > now - self.grace:
+                continue
+            if self._is_sidecar(name):
+                removed += self._reconcile_sidecar(name, location)
+                continue
+            if is_staged:
+                if self.store.get_upload(name[:-len(self.part_suffix)]) is None:
+                    self._remove_staged(location)
+                    removed += 1
+                continue
+            if name.endswith('.enc'):
+                file_id = name[:-len('.enc')]
+            elif name.endswith('.enc' + self.claimed_suffix):
+                file_id = name[:-len('.enc' + self.claimed_suffix)]
+            else:
+                continue
+            # A claimed file keeps its record until the download is complete
+            # or its grace period runs out; without one it was left behind.
+            if self.store.get(file_id) is None:
+                self.storage.delete(location)
+                removed += 1
+        if not self.storage.is_local:
+            # Checking every record against remote storage would cost a request
+            # each; such records simply expire.
+            return removed
+        missing = []
+        for file_id, record in self.store.iter_files():
+            if record['created_at'] > now - self.grace:
+                continue
+            if not self.storage.exists(record['filepath']) and \
+                    not self.storage.exists(record['filepath'] + self.claimed_suffix):
+                missing.append(file_id)
+        if missing:
+            self.store.delete_many(missing)
+            removed += len(missing)
+        return removed
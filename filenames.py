@@ -0,0 +1,60 @@
+import base64
+import binascii
+
+###############################################################################
+# ENCRYPTED FILENAME ENCODING
+#
+# The browser encrypts the original filename with the file's key (AES-GCM, a
+# random 12-byte IV) and sends it as the 'encrypted_filename' form field:
+#
+#   format 1    base64url(0x01 || iv || ciphertext), unpadded
+#   legacy      hex(iv) ":" hex(ciphertext)
+#
+# Both are parsed into the raw format-1 bytes, which is what the metadata
+# store keeps; download pages always get format 1. Records written before
+# this change still hold the legacy string and are converted when read.
+# Keys in download links follow the same scheme: 43 base64url characters,
+# or 64 hex characters in older links.
+###############################################################################
+
+FILENAME_VERSION = 1
+IV_SIZE = 12
+TAG_SIZE = 16
+# Generous bound on the encrypted form of a (max 255 byte) filename.
+MAX_FILENAME_SIZE = 1 + IV_SIZE + 1024 + TAG_SIZE
+
+
+class FilenameError(ValueError):
+    pass
+
+
+def _b64decode(text):
+    return base64.b64decode((text + '=' * (-len(text) % 4)).encode('ascii'),
+                            altchars=b'-_', validate=True)
+
+
+def parse_encrypted_filename(text):
+    # Form field (either format) -> raw format-1 bytes. Raises FilenameError.
+    legacy = ':' in text
+    try:
+        if legacy:
+            iv, ciphertext = text.split(':', 1)
+            raw = bytes([FILENAME_VERSION]) + bytes.fromhex(iv) + bytes.fromhex(ciphertext)
+        else:
+            raw = _b64decode(text)
+    except (ValueError, binascii.Error):
+        raise FilenameError("Invalid encrypted filename encoding")
+    if legacy and len(iv) != 2 * IV_SIZE:
+        raise FilenameError("Invalid IV")
+    if not raw or raw[0] != FILENAME_VERSION:
+        raise FilenameError("Unsupported encrypted filename version")
+    if not 1 + IV_SIZE + TAG_SIZE <= len(raw) <= MAX_FILENAME_SIZE:
+        raise FilenameError("Invalid encrypted filename length")
+    return raw
+
+
+def format_encrypted_filename(raw):
+    # Stored value -> format 1 text for the download page.
+    if isinstance(raw, str):
+        raw = parse_encrypted_filename(raw)
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
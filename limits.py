@@ -0,0 +1,186 @@
+import collections
+import hashlib
+import os
+import threading
+import time
+
+from metadata import SQLiteDatabase
+
+###############################################################################
+# RATE LIMITS AND QUOTAS
+#
+# Every limit is a token bucket keyed by client: it holds up to `capacity`
+# tokens, refills at `rate` tokens per second, and a request is allowed if it
+# can take `amount` tokens. A bucket is two numbers (tokens, last update), so
+# a decision is O(1) whatever the traffic. The app uses buckets for
+#
+#   requests per second     amount 1, capacity = burst
+#   upload bytes per day    amount = upload size, rate = capacity / 86400
+#
+# Outstanding stored bytes are not a bucket; they come from the metadata store
+# (stored_bytes()), so deleting a file frees its quota without extra
+# bookkeeping.
+#
+# take() returns 0 if the tokens were taken, otherwise the number of seconds
+# until they would be available (None if `amount` exceeds the capacity).
+#
+# A bucket that has not been touched long enough to refill completely is the
+# same as a missing one, so evicting idle buckets loses nothing:
+#
+#   MemoryRateLimiter   per-process; an LRU dict capped at max_entries.
+#   SQLiteRateLimiter   shared by every worker on the host; a decision is one
+#                       UPDATE (its own write transaction) and the least
+#                       recently used rows beyond max_entries are swept once
+#                       a minute.
+#
+# Clients are identified by a keyed hash of their address (client_key()), so
+# neither the limiter nor the metadata store keeps IP addresses.
+###############################################################################
+
+
+class RateLimiter:
+    def take(self, key, amount, rate, capacity, now=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def refill(tokens, updated, rate, capacity, now):
+    return min(capacity, tokens + (now - updated) * rate)
+
+
+def decide(tokens, amount, rate, capacity):
+    # (tokens left, seconds to wait) for a bucket holding `tokens`.
+    if amount > capacity:
+        return tokens, None
+    if tokens >= amount:
+        return tokens - amount, 0
+    return tokens, (amount - tokens) / rate
+
+
+class MemoryRateLimiter(RateLimiter):
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, amount, rate, capacity, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = capacity
+            else:
+                tokens = refill(bucket[0], bucket[1], rate, capacity, now)
+                self._buckets.move_to_end(key)
+            tokens, wait = decide(tokens, amount, rate, capacity)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+class SQLiteRateLimiter(SQLiteDatabase, RateLimiter):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS buckets (
+            key     TEXT PRIMARY KEY,
+            tokens  REAL NOT NULL,
+            updated REAL NOT NULL
+        ) WITHOUT ROWID;
+        DROP INDEX IF EXISTS buckets_updated;
+    """
+
+    # No index on `updated`: keeping one current on every decision more than
+    # doubled the pages each commit writes. The sweep sorts the table instead,
+    # so it runs on a timer rather than every so many decisions.
+    def __init__(self, path, max_entries=1000000, sweep_interval=60.0, timeout=30.0):
+        super().__init__(path, timeout)
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self._next_sweep = time.monotonic() + sweep_interval
+        conn = self._connect()
+        try:
+            conn.executescript(self.SCHEMA)
+        finally:
+            conn.close()
+
+    # Take the tokens if the refilled bucket holds enough: one statement, so
+    # SQLite runs it as its own write transaction. The arithmetic is refill()
+    # and decide().
+    TAKE = ("UPDATE buckets SET tokens = MIN(:capacity, tokens + (:now - updated) * :rate) "
+            "- :amount, updated = :now WHERE key = :key "
+            "AND MIN(:capacity, tokens + (:now - updated) * :rate) >= :amount")
+    CREATE = "INSERT OR IGNORE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)"
+
+    def take(self, key, amount, rate, capacity, now=None):
+        # Wall-clock time, since buckets are shared between processes.
+        now = time.time() if now is None else now
+        if amount > capacity:
+            return None
+        # The common case, a known client within its limit, is one UPDATE.
+        # A refused request leaves the bucket as it is: storing the refilled
+        # tokens would not change what later requests see.
+        conn = self._conn()
+        params = {'key': key, 'amount': amount, 'rate': rate, 'capacity': capacity, 'now': now}
+        while True:
+            if conn.execute(self.TAKE, params).rowcount == 1:
+                wait = 0
+                break
+            row = conn.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                # Refused: other workers can only have drained the bucket
+                # since.
+                wait = decide(refill(row[0], row[1], rate, capacity, now),
+                              amount, rate, capacity)[1]
+                break
+            if conn.execute(self.CREATE, (key, capacity - amount, now)).rowcount == 1:
+                wait = 0
+                break
+            # Another worker created the bucket first.
+        if time.monotonic() >= self._next_sweep:
+            self._next_sweep = time.monotonic() + self.sweep_interval
+            self.sweep()
+        return wait
+
+    def sweep(self):
+        # Drop the least recently used buckets beyond max_entries.
+        def sweep(conn):
+            excess = conn.execute("SELECT COUNT(*) FROM buckets").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute("DELETE FROM buckets WHERE key IN "
+                             "(SELECT key FROM buckets ORDER BY updated LIMIT ?)", (excess,))
+        self._transaction(sweep)
+
+
+def create_rate_limiter(backend, path=None, max_entries=100000):
+    if backend == 'memory':
+        return MemoryRateLimiter(max_entries)
+    if backend == 'sqlite':
+        return SQLiteRateLimiter(path, max_entries)
+    raise ValueError("Unknown rate limit backend: %r" % (backend,))
+
+
+def load_secret(path, size=32):
+    # Read the secret at `path`, creating it on first use. O_EXCL makes
+    # workers racing to create it agree on one value.
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, 'rb') as f:
+            secret = f.read()
+        if len(secret) == size:
+            return secret
+        # Another worker is still writing it.
+        time.sleep(0.1)
+        with open(path, 'rb') as f:
+            return f.read()
+    with os.fdopen(fd, 'wb') as f:
+        secret = os.urandom(size)
+        f.write(secret)
+    return secret
+
+
+def client_key(address, secret):
+    return hashlib.blake2b(address.encode(), key=secret, digest_size=12).hexdigest()
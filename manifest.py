@@ -0,0 +1,71 @@
+import struct
+
+###############################################################################
+# BATCH MANIFESTS
+#
+# A batch share stores several encrypted files under one share id: their
+# containers are concatenated into a single blob, in upload order, and the
+# record's 'manifest' lists each file's encrypted name and ciphertext size:
+#
+#   version (1 byte) || count (uint32)
+#   || count * [name length (uint16) || encrypted name || size (uint64)]
+#
+# Names are raw encrypted filenames (see filenames.py); all files of a batch
+# are encrypted with the share's one key. Offsets are not stored, since file
+# i starts at the sum of the sizes before it. The browser fetches each file
+# with a Range request for its slice of the blob.
+###############################################################################
+
+MANIFEST_VERSION = 1
+_HEADER = struct.Struct('>BI')
+_NAME_LENGTH = struct.Struct('>H')
+_SIZE = struct.Struct('>Q')
+
+
+class ManifestError(ValueError):
+    pass
+
+
+def encode_manifest(entries):
+    # [(raw encrypted name, size), ...] -> bytes
+    parts = [_HEADER.pack(MANIFEST_VERSION, len(entries))]
+    for name, size in entries:
+        parts.append(_NAME_LENGTH.pack(len(name)))
+        parts.append(name)
+        parts.append(_SIZE.pack(size))
+    return b''.join(parts)
+
+
+def decode_manifest(data):
+    # bytes -> [(raw encrypted name, size), ...]. Raises ManifestError.
+    try:
+        version, count = _HEADER.unpack_from(data, 0)
+        if version != MANIFEST_VERSION:
+            raise ManifestError("Unsupported manifest version %d" % version)
+        offset = _HEADER.size
+        entries = []
+        for _ in range(count):
+            (length,) = _NAME_LENGTH.unpack_from(data, offset)
+            offset += _NAME_LENGTH.size
+            name = bytes(data[offset:offset + length])
+            if len(name) != length:
+                raise ManifestError("Truncated manifest")
+            offset += length
+            (size,) = _SIZE.unpack_from(data, offset)
+            offset += _SIZE.size
+            entries.append((name, size))
+    except struct.error:
+        raise ManifestError("Truncated manifest")
+    if offset != len(data):
+        raise ManifestError("Trailing bytes after manifest")
+    return entries
+
+
+def file_ranges(entries):
+    # [(name, start, end), ...] of each file's bytes in the share's blob.
+    ranges = []
+    start = 0
+    for name, size in entries:
+        ranges.append((name, start, start + size))
+        start += size
+    return ranges
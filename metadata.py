@@ -0,0 +1,897 @@
+import array
+import heapq
+import marshal
+import os
+import re
+import sqlite3
+import struct
+import threading
+import time
+import uuid
+
+###############################################################################
+# METADATA STORES
+#
+# Every store keeps one record per pending upload, keyed by file_id. Records
+# are plain dicts so route handlers never care which backend is configured:
+#
+#   {'encrypted_filename': bytes, 'filepath': str, 'downloaded': bool,
+#    'created_at': float, 'expires_at': float, 'download_token': str,
+#    'delivered': [(start, end), ...], 'size': int, 'sha256': bytes,
+#    'sha256_chunk_size': int, 'owner': str, 'manifest': bytes,
+#    'downloads': int, 'max_downloads': int, 'password_hash': str}
+#
+# 'encrypted_filename' is the raw encrypted name (see filenames.py); records
+# from older versions may still hold the legacy hex string. Batch shares have
+# an empty 'encrypted_filename' and list their files in 'manifest' (see
+# manifest.py); it is None for single-file shares. 'size' and
+# 'sha256' describe the stored ciphertext and are None for files uploaded
+# before they were recorded. 'sha256' is the SHA-256 of the file, or, if
+# 'sha256_chunk_size' is set (chunked uploads), the SHA-256 of the SHA-256
+# digests of its consecutive chunks of that many bytes. 'owner' is the
+# pseudonymous key of the client that uploaded the file (see limits.py);
+# stored_bytes() sums the size of an owner's files and pending chunked
+# uploads for the storage quota.
+# claim() is the only way to count a download. It must be atomic across
+# threads *and* processes, so that exactly 'max_downloads' requests (1 unless
+# the uploader allowed more) win a given file. 'downloads' counts the claims
+# so far; the last one flips 'downloaded'. Each winner gets a download token
+# that lets it (and only it) come back for the rest of the file with Range
+# requests until the share expires (see access.py); records claimed by
+# older versions keep the token in 'download_token'.
+# 'password_hash' is the scrypt hash of the share's password, or None.
+# 'delivered' holds the merged byte ranges that have been sent in full;
+# record_delivery() reports when they cover the whole file. The app records
+# claim n's ranges shifted by (n - 1) * size and passes max_downloads * size,
+# so that they cover it once every claim has been delivered.
+#
+# Stores also track in-progress chunked uploads ("upload sessions"):
+#
+#   {'encrypted_filename': bytes, 'filepath': str, 'size': int,
+#    'chunk_size': int, 'ttl': float, 'created_at': float,
+#    'expires_at': float, 'owner': str, 'max_downloads': int,
+#    'password_hash': str, 'received': [int, ...], 'digests': [bytes, ...]}
+#
+# where 'received' lists the chunk numbers already written to disk, so an
+# interrupted upload can be resumed by sending only the missing chunks,
+# 'digests' their SHA-256 digests (taken while writing them), and
+# 'ttl', 'max_downloads' and 'password_hash' are for the finished file.
+#
+# Both kinds of entry carry 'expires_at', and every store keeps an index on
+# it so expired() can return the oldest entries without scanning the rest.
+###############################################################################
+
+
+class MetadataStore:
+    def add(self, file_id, record):
+        raise NotImplementedError
+
+    def add_many(self, items):
+        # [(file_id, record), ...] in one go, e.g. when rebuilding the index.
+        raise NotImplementedError
+
+    def get(self, file_id):
+        raise NotImplementedError
+
+    def claim(self, file_id, download_token=None, expires_at=None):
+        # Count a download and return the record, with 'downloads' holding
+        # this claim's number, or return None if it does not exist or every
+        # download has been claimed. The last claim marks the record as
+        # downloaded and stores the token; expires_at (if given) can only
+        # bring the record's expiry forward, and only on the last claim.
+        raise NotImplementedError
+
+    def record_delivery(self, file_id, start, end, size):
+        # Add [start, end) to the delivered ranges. Returns True once they
+        # cover [0, size).
+        raise NotImplementedError
+
+    def delete(self, file_id):
+        raise NotImplementedError
+
+    def update_path(self, file_id, filepath):
+        raise NotImplementedError
+
+    def stored_bytes(self, owner):
+        raise NotImplementedError
+
+    def delete_many(self, file_ids):
+        for file_id in file_ids:
+            self.delete(file_id)
+
+    def count(self):
+        raise NotImplementedError
+
+    def total_size(self):
+        # Bytes of ciphertext held for all records (where recorded).
+        raise NotImplementedError
+
+    def expired(self, now, limit):
+        # Up to `limit` (file_id, record) pairs with expires_at <= now,
+        # oldest first.
+        raise NotImplementedError
+
+    def iter_files(self, batch_size=1000):
+        # Yield every (file_id, record); used for reconciliation.
+        raise NotImplementedError
+
+    def create_upload(self, upload_id, session):
+        raise NotImplementedError
+
+    def get_upload(self, upload_id):
+        raise NotImplementedError
+
+    def mark_chunk(self, upload_id, chunk, sha256=None):
+        raise NotImplementedError
+
+    def delete_upload(self, upload_id):
+        raise NotImplementedError
+
+    def expired_uploads(self, now, limit):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# MemoryMetadataStore's fixed-width records: the share id as its 16-byte uuid
+# and the index of its node suffix (see cluster.py), flags, the download
+# counters, created_at, expires_at, size (-1: None), the index of the owner
+# (0: None), and the offset and length of the record's other fields
+# (_BLOB_FIELDS, marshalled) in the store's blob.
+_RECORD = struct.Struct('<17sBIIddqIQI')
+_KEY_SIZE = 17
+_FLAGS = 17
+_LIVE = 1
+_DOWNLOADED = 2
+_EXPIRES = 4
+# 'filepath' is None when it is the share's default location.
+_BLOB_FIELDS = ('encrypted_filename', 'filepath', 'download_token', 'delivered', 'sha256',
+                'manifest', 'password_hash', 'sha256_chunk_size')
+_BLOB_INDEX = {name: i for i, name in enumerate(_BLOB_FIELDS)}
+_SHARE_ID = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
+                       r'(?:-([a-z][a-z0-9]{0,15}))?\Z')
+# Lookup table entries that hold no slot.
+_EMPTY = -1
+_DELETED = -2
+
+
+def _micros(timestamp):
+    return round(timestamp * 1000000)
+
+
+class MemoryMetadataStore(MetadataStore):
+    # Process-local store. Only safe with a single worker; kept for tests and
+    # for running the app with `python app.py`.
+    #
+    # Records are _RECORD slots in one bytearray, and a deleted record's slot
+    # is reused. Their variable-length fields go to the end of a second
+    # bytearray, the blob; changing them appends a new copy, and the blob is
+    # compacted once most of it is stale. An open-addressing table of slot
+    # numbers finds a record by its id. Expiry uses a min-heap of ints
+    # packing (expires_at in microseconds, slot); entries whose record was
+    # deleted or replaced are skipped lazily when they reach the top.
+    #
+    # Values shared by records or implied by their id are not stored with
+    # each record: owners are numbered, with their count of records and
+    # bytes (so stored_bytes() is a lookup), and a file path that
+    # location(file_id) returns is left out.
+
+    def __init__(self, location=None):
+        self._location = location
+        self._slots = bytearray()
+        self._free = []
+        self._blob = bytearray()
+        self._stale = 0
+        self._table = array.array('q', [_EMPTY]) * 8
+        self._used = 0
+        self._count = 0
+        self._size = 0
+        self._nodes = ['']
+        self._node_index = {'': 0}
+        # Owner index -> owner, and the number and bytes of its records;
+        # indexes of owners left without records are reused.
+        self._owners = [None]
+        self._owner_index = {None: 0}
+        self._owner_records = array.array('q', [0])
+        self._owner_bytes = array.array('q', [0])
+        self._free_owners = []
+        self._uploads = {}
+        self._expiry = []
+        self._upload_expiry = []
+        self._lock = threading.Lock()
+
+    def _key(self, file_id, add=False):
+        # The 17-byte key of a share id, or None if no record can have it.
+        match = _SHARE_ID.match(file_id)
+        if match is None:
+            return None
+        node = match.group(1) or ''
+        index = self._node_index.get(node)
+        if index is None:
+            if not add:
+                return None
+            if len(self._nodes) > 255:
+                raise ValueError("Too many node names")
+            index = self._node_index[node] = len(self._nodes)
+            self._nodes.append(node)
+        return bytes.fromhex(file_id[:36].replace('-', '')) + bytes((index,))
+
+    def _file_id(self, key):
+        node = self._nodes[key[16]]
+        file_id = str(uuid.UUID(bytes=key[:16]))
+        return file_id + '-' + node if node else file_id
+
+    def _add_owner(self, owner, size):
+        # The index of `owner`, counting a record of `size` bytes.
+        index = self._owner_index.get(owner)
+        if index is None:
+            if self._free_owners:
+                index = self._free_owners.pop()
+                self._owners[index] = owner
+            else:
+                index = len(self._owners)
+                self._owners.append(owner)
+                self._owner_records.append(0)
+                self._owner_bytes.append(0)
+            self._owner_index[owner] = index
+        self._owner_records[index] += 1
+        self._owner_bytes[index] += size
+        return index
+
+    def _remove_owner(self, index, size):
+        # Uncount a record of `size` bytes from owner `index`.
+        self._owner_records[index] -= 1
+        self._owner_bytes[index] -= size
+        if not self._owner_records[index] and index:
+            del self._owner_index[self._owners[index]]
+            self._owners[index] = None
+            self._free_owners.append(index)
+
+    def _find(self, key):
+        # (table position, slot) of the record with `key`, or (the position
+        # to insert it at, None).
+        table = self._table
+        mask = len(table) - 1
+        position = hash(key) & mask
+        insert = None
+        while True:
+            slot = table[position]
+            if slot == _EMPTY:
+                return (position if insert is None else insert), None
+            if slot == _DELETED:
+                if insert is None:
+                    insert = position
+            else:
+                offset = slot * _RECORD.size
+                if self._slots[offset:offset + _KEY_SIZE] == key:
+                    return position, slot
+            position = (position + 1) & mask
+
+    def _resize(self):
+        # Rebuild the table with room for twice the records, dropping
+        # deleted entries.
+        capacity = 8
+        while capacity < self._count * 4:
+            capacity *= 2
+        table = array.array('q', [_EMPTY]) * capacity
+        mask = capacity - 1
+        for slot, fields in self._live():
+            position = hash(fields[0]) & mask
+            while table[position] != _EMPTY:
+                position = (position + 1) & mask
+            table[position] = slot
+        self._table = table
+        self._used = self._count
+
+    def _live(self, start=0, end=None):
+        # (slot, fields) of the records in slots [start, end).
+        count = len(self._slots) // _RECORD.size
+        for slot in range(start, count if end is None else min(end, count)):
+            fields = _RECORD.unpack_from(self._slots, slot * _RECORD.size)
+            if fields[1] & _LIVE:
+                yield slot, fields
+
+    def _fields(self, file_id):
+        # (slot, fields) of the record, or (None, None).
+        key = self._key(file_id)
+        if key is None:
+            return None, None
+        _, slot = self._find(key)
+        if slot is None:
+            return None, None
+        return slot, _RECORD.unpack_from(self._slots, slot * _RECORD.size)
+
+    def _values(self, fields):
+        return marshal.loads(self._blob[fields[8]:fields[8] + fields[9]])
+
+    def _record(self, fields, file_id=None):
+        record = dict(zip(_BLOB_FIELDS, self._values(fields)))
+        record['delivered'] = list(record['delivered'] or ())
+        if record['filepath'] is None and self._location is not None:
+            record['filepath'] = self._location(file_id or self._file_id(fields[0]))
+        record.update(downloaded=bool(fields[1] & _DOWNLOADED),
+                      downloads=fields[2],
+                      max_downloads=fields[3],
+                      created_at=fields[4],
+                      expires_at=fields[5] if fields[1] & _EXPIRES else None,
+                      size=fields[6] if fields[6] >= 0 else None,
+                      owner=self._owners[fields[7]])
+        return record
+
+    def _item(self, fields):
+        # (file_id, record) of a record's fields.
+        file_id = self._file_id(fields[0])
+        return file_id, self._record(fields, file_id)
+
+    def _stored_path(self, file_id, filepath):
+        # The 'filepath' blob field: None for the default location.
+        if self._location is not None and filepath == self._location(file_id):
+            return None
+        return filepath
+
+    def _write(self, slot, fields, values=None, expires=False):
+        # Store `fields` in `slot`, with `values` as a new copy of the blob
+        # fields if given. `expires`: queue the record's expiry.
+        if values is not None:
+            data = marshal.dumps(tuple(values))
+            fields = fields[:8] + (len(self._blob), len(data))
+            self._blob += data
+        _RECORD.pack_into(self._slots, slot * _RECORD.size, *fields)
+        if expires and fields[1] & _EXPIRES:
+            heapq.heappush(self._expiry, (_micros(fields[5]) << 32) | slot)
+
+    def _compact(self):
+        if self._stale < 65536 or self._stale * 2 < len(self._blob):
+            return
+        blob = bytearray()
+        for slot, fields in list(self._live()):
+            offset = fields[8]
+            _RECORD.pack_into(self._slots, slot * _RECORD.size,
+                              *fields[:8], len(blob), fields[9])
+            blob += self._blob[offset:offset + fields[9]]
+        self._blob = blob
+        self._stale = 0
+
+    def add(self, file_id, record):
+        key = self._key(file_id, add=True)
+        if key is None:
+            raise ValueError("Not a share id: %r" % (file_id,))
+        expires_at = record.get('expires_at')
+        created_at = record.get('created_at')
+        size = record.get('size')
+        flags = (_LIVE | (_DOWNLOADED if record.get('downloaded') else 0)
+                 | (_EXPIRES if expires_at is not None else 0))
+        values = [record.get(name) for name in _BLOB_FIELDS]
+        values[_BLOB_INDEX['filepath']] = self._stored_path(file_id, record.get('filepath'))
+        values[_BLOB_INDEX['delivered']] = tuple(map(tuple, values[_BLOB_INDEX['delivered']]
+                                                     or ())) or None
+        with self._lock:
+            position, slot = self._find(key)
+            if slot is None:
+                if self._free:
+                    slot = self._free.pop()
+                else:
+                    slot = len(self._slots) // _RECORD.size
+                    self._slots += bytes(_RECORD.size)
+                if self._table[position] == _EMPTY:
+                    self._used += 1
+                self._table[position] = slot
+                self._count += 1
+            else:
+                old = _RECORD.unpack_from(self._slots, slot * _RECORD.size)
+                self._stale += old[9]
+                self._size -= max(old[6], 0)
+                self._remove_owner(old[7], max(old[6], 0))
+            self._size += size or 0
+            fields = (key, flags, record.get('downloads') or 0, record.get('max_downloads') or 1,
+                      time.time() if created_at is None else created_at,
+                      expires_at or 0.0, -1 if size is None else size,
+                      self._add_owner(record.get('owner'), size or 0), 0, 0)
+            self._write(slot, fields, values, expires=True)
+            if self._used * 3 > len(self._table) * 2:
+                self._resize()
+            self._compact()
+
+    def add_many(self, items):
+        for file_id, record in items:
+            self.add(file_id, record)
+
+    def get(self, file_id):
+        with self._lock:
+            slot, fields = self._fields(file_id)
+            return self._record(fields, file_id) if slot is not None else None
+
+    def claim(self, file_id, download_token=None, expires_at=None):
+        with self._lock:
+            slot, fields = self._fields(file_id)
+            if slot is None or fields[1] & _DOWNLOADED:
+                return None
+            downloads = fields[2] + 1
+            fields = fields[:2] + (downloads,) + fields[3:]
+            if downloads < fields[3]:
+                # The counter is all that changes.
+                _RECORD.pack_into(self._slots, slot * _RECORD.size, *fields)
+                return self._record(fields, file_id)
+            flags = fields[1] | _DOWNLOADED
+            expires = expires_at is not None and (not fields[1] & _EXPIRES
+                                                  or expires_at < fields[5])
+            if expires:
+                flags |= _EXPIRES
+            else:
+                expires_at = fields[5]
+            fields = (fields[0], flags) + fields[2:5] + (expires_at,) + fields[6:]
+            values = list(self._values(fields))
+            values[_BLOB_INDEX['download_token']] = download_token
+            self._stale += fields[9]
+            self._write(slot, fields, values, expires)
+            self._compact()
+            return self._record(_RECORD.unpack_from(self._slots, slot * _RECORD.size), file_id)
+
+    def record_delivery(self, file_id, start, end, size):
+        with self._lock:
+            slot, fields = self._fields(file_id)
+            if slot is None:
+                return False
+            values = list(self._values(fields))
+            index = _BLOB_INDEX['delivered']
+            delivered = merge_range(values[index] or (), start, end)
+            values[index] = tuple(delivered) or None
+            self._stale += fields[9]
+            self._write(slot, fields, values)
+            self._compact()
+        return covers(delivered, size)
+
+    def delete(self, file_id):
+        with self._lock:
+            key = self._key(file_id)
+            if key is None:
+                return
+            position, slot = self._find(key)
+            if slot is None:
+                return
+            fields = _RECORD.unpack_from(self._slots, slot * _RECORD.size)
+            self._table[position] = _DELETED
+            self._slots[slot * _RECORD.size + _FLAGS] = 0
+            self._free.append(slot)
+            self._count -= 1
+            self._size -= max(fields[6], 0)
+            self._remove_owner(fields[7], max(fields[6], 0))
+            self._stale += fields[9]
+            self._compact()
+
+    def update_path(self, file_id, filepath):
+        with self._lock:
+            slot, fields = self._fields(file_id)
+            if slot is not None:
+                values = list(self._values(fields))
+                values[_BLOB_INDEX['filepath']] = self._stored_path(file_id, filepath)
+                self._stale += fields[9]
+                self._write(slot, fields, values)
+                self._compact()
+
+    def stored_bytes(self, owner):
+        with self._lock:
+            index = self._owner_index.get(owner)
+            return ((self._owner_bytes[index] if index is not None else 0)
+                    + sum(session['size'] for session in self._uploads.values()
+                          if session.get('owner') == owner))
+
+    def count(self):
+        with self._lock:
+            return self._count
+
+    def total_size(self):
+        with self._lock:
+            return self._size
+
+    def _pop_expired(self, heap, entries, now, limit, expires_at_of):
+        result = []
+        while heap and heap[0][0] <= now and len(result) < limit:
+            expires_at, key = heapq.heappop(heap)
+            entry = entries.get(key)
+            if entry is not None and expires_at_of(entry) == expires_at:
+                result.append((key, entry))
+        # Callers delete what they get back; anything they skip is re-queued.
+        for key, entry in result:
+            heapq.heappush(heap, (expires_at_of(entry), key))
+        return result
+
+    def expired(self, now, limit):
+        with self._lock:
+            heap = self._expiry
+            bound = (_micros(now) + 1) << 32
+            found = {}
+            while heap and heap[0] < bound and len(found) < limit:
+                entry = heapq.heappop(heap)
+                slot = entry & 0xffffffff
+                fields = _RECORD.unpack_from(self._slots, slot * _RECORD.size)
+                if (fields[1] & _LIVE and fields[1] & _EXPIRES
+                        and _micros(fields[5]) == entry >> 32):
+                    found.setdefault(slot, (entry, fields))
+            # As in _pop_expired(), what callers skip is re-queued.
+            for entry, _ in found.values():
+                heapq.heappush(heap, entry)
+            return [self._item(fields) for _, fields in found.values()]
+
+    def iter_files(self, batch_size=1000):
+        start = 0
+        while start < len(self._slots) // _RECORD.size:
+            with self._lock:
+                batch = [self._item(fields)
+                         for _, fields in self._live(start, start + batch_size)]
+            yield from batch
+            start += batch_size
+
+    def create_upload(self, upload_id, session):
+        session = dict(session)
+        session.setdefault('created_at', time.time())
+        session.setdefault('expires_at', None)
+        session.setdefault('max_downloads', 1)
+        session.setdefault('password_hash', None)
+        # chunk -> its digest
+        session['received'] = {}
+        with self._lock:
+            self._uploads[upload_id] = session
+            if session['expires_at'] is not None:
+                heapq.heappush(self._upload_expiry, (session['expires_at'], upload_id))
+
+    def get_upload(self, upload_id):
+        with self._lock:
+            session = self._uploads.get(upload_id)
+            if session is None:
+                return None
+            digests = session['received']
+            session = dict(session, received=sorted(digests))
+            session['digests'] = [digests[chunk] for chunk in session['received']]
+            return session
+
+    def mark_chunk(self, upload_id, chunk, sha256=None):
+        with self._lock:
+            session = self._uploads.get(upload_id)
+            if session is not None:
+                session['received'][chunk] = sha256
+
+    def delete_upload(self, upload_id):
+        with self._lock:
+            self._uploads.pop(upload_id, None)
+
+    def expired_uploads(self, now, limit):
+        with self._lock:
+            expired = [(upload_id, dict(session)) for upload_id, session in self._pop_expired(
+                self._upload_expiry, self._uploads, now, limit,
+                lambda session: session['expires_at'])]
+        for _, session in expired:
+            session['received'] = sorted(session['received'])
+        return expired
+
+
+class SQLiteDatabase:
+    # Connection handling shared by the SQLite-backed stores. With mmap_size,
+    # reads go through a memory map of the database file instead of copies in
+    # each connection's page cache, so the workers on a host share one copy
+    # of the index in the OS page cache. Writes still go through the WAL,
+    # one writer at a time.
+
+    def __init__(self, path, timeout=30.0, mmap_size=0):
+        self.path = path
+        self.timeout = timeout
+        self.mmap_size = mmap_size
+        self._local = threading.local()
+
+    def _connect(self):
+        # isolation_level=None: we issue BEGIN/COMMIT ourselves where needed.
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=%d" % int(self.timeout * 1000))
+        if self.mmap_size:
+            conn.execute("PRAGMA mmap_size=%d" % self.mmap_size)
+        return conn
+
+    def _conn(self):
+        # One connection per thread, re-opened after fork so gunicorn workers
+        # never share a handle inherited from the master.
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.conn = self._connect()
+            self._local.pid = pid
+        return self._local.conn
+
+    def _transaction(self, func, *args):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(conn, *args)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def close(self):
+        # Close this thread's connection (e.g. the master's, before forking
+        # workers); the next call opens a new one.
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local = threading.local()
+
+
+class SQLiteMetadataStore(SQLiteDatabase, MetadataStore):
+    # Durable store shared by every worker on the host. WAL mode lets readers
+    # proceed while a writer commits, and the file_id primary key gives an
+    # indexed point lookup for every request. The expires_at indexes are the
+    # expiry index: the reaper reads them in order and stops at `now`.
+
+    # (name, type) per column. Columns added after the first release must be
+    # nullable or have a default, so _migrate() can add them to old databases.
+    FILE_COLUMNS = (
+        ('file_id', 'TEXT PRIMARY KEY'),
+        ('encrypted_filename', 'BLOB NOT NULL'),
+        ('filepath', 'TEXT NOT NULL'),
+        ('downloaded', 'INTEGER NOT NULL DEFAULT 0'),
+        ('created_at', 'REAL NOT NULL'),
+        ('expires_at', 'REAL'),
+        ('download_token', 'TEXT'),
+        ('delivered', 'TEXT'),
+        ('size', 'INTEGER'),
+        ('sha256', 'BLOB'),
+        ('owner', 'TEXT'),
+        ('manifest', 'BLOB'),
+        ('downloads', 'INTEGER NOT NULL DEFAULT 0'),
+        ('max_downloads', 'INTEGER NOT NULL DEFAULT 1'),
+        ('password_hash', 'TEXT'),
+        ('sha256_chunk_size', 'INTEGER'),
+    )
+    UPLOAD_COLUMNS = (
+        ('upload_id', 'TEXT PRIMARY KEY'),
+        ('encrypted_filename', 'BLOB NOT NULL'),
+        ('filepath', 'TEXT NOT NULL'),
+        ('size', 'INTEGER NOT NULL'),
+        ('chunk_size', 'INTEGER NOT NULL'),
+        ('created_at', 'REAL NOT NULL'),
+        ('ttl', 'REAL'),
+        ('expires_at', 'REAL'),
+        ('owner', 'TEXT'),
+        ('max_downloads', 'INTEGER NOT NULL DEFAULT 1'),
+        ('password_hash', 'TEXT'),
+    )
+    INDEXES = """
+        CREATE TABLE IF NOT EXISTS upload_chunks (
+            upload_id TEXT NOT NULL,
+            chunk     INTEGER NOT NULL,
+            sha256    BLOB,
+            PRIMARY KEY (upload_id, chunk)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS files_expires_at ON files (expires_at);
+        CREATE INDEX IF NOT EXISTS uploads_expires_at ON uploads (expires_at);
+        CREATE INDEX IF NOT EXISTS files_owner ON files (owner);
+        CREATE INDEX IF NOT EXISTS uploads_owner ON uploads (owner);
+    """
+
+    def __init__(self, path, timeout=30.0, mmap_size=0):
+        super().__init__(path, timeout, mmap_size)
+        self._file_names = tuple(name for name, _ in self.FILE_COLUMNS)
+        self._upload_names = tuple(name for name, _ in self.UPLOAD_COLUMNS)
+        conn = self._connect()
+        try:
+            self._migrate(conn, 'files', self.FILE_COLUMNS)
+            self._migrate(conn, 'uploads', self.UPLOAD_COLUMNS)
+            conn.executescript(self.INDEXES)
+            # Chunk digests were added after the first release.
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(upload_chunks)")}
+            if 'sha256' not in columns:
+                conn.execute("ALTER TABLE upload_chunks ADD COLUMN sha256 BLOB")
+        finally:
+            conn.close()
+
+    def _migrate(self, conn, table, columns):
+        conn.execute("CREATE TABLE IF NOT EXISTS %s (%s) WITHOUT ROWID" % (
+            table, ", ".join("%s %s" % column for column in columns)))
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(%s)" % table)}
+        for name, sql_type in columns:
+            if name not in existing:
+                conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, name, sql_type))
+
+    def _to_record(self, row):
+        if row is None:
+            return None
+        record = dict(zip(self._file_names, row))
+        del record['file_id']
+        record['downloaded'] = bool(record['downloaded'])
+        record['delivered'] = parse_ranges(record['delivered'])
+        return record
+
+    def _select_files(self, where):
+        return "SELECT %s FROM files %s" % (", ".join(self._file_names), where)
+
+    def _file_row(self, file_id, record):
+        record = dict(record, file_id=file_id)
+        record['downloaded'] = int(record.get('downloaded', False))
+        record['delivered'] = format_ranges(record.get('delivered') or [])
+        record['downloads'] = record.get('downloads') or 0
+        record['max_downloads'] = record.get('max_downloads') or 1
+        record.setdefault('created_at', time.time())
+        return [record.get(name) for name in self._file_names]
+
+    def _insert_files(self):
+        return "INSERT OR REPLACE INTO files (%s) VALUES (%s)" % (
+            ", ".join(self._file_names), ", ".join("?" * len(self._file_names)))
+
+    def add(self, file_id, record):
+        self._conn().execute(self._insert_files(), self._file_row(file_id, record))
+
+    def add_many(self, items):
+        rows = [self._file_row(file_id, record) for file_id, record in items]
+        self._transaction(lambda conn: conn.executemany(self._insert_files(), rows))
+
+    def get(self, file_id):
+        row = self._conn().execute(
+            self._select_files("WHERE file_id = ?"), (file_id,)).fetchone()
+        return self._to_record(row)
+
+    def claim(self, file_id, download_token=None, expires_at=None):
+        # Compare-and-swap: only an UPDATE that sees downloaded = 0 changes a
+        # row, and SQLite serialises writers, so exactly max_downloads callers
+        # win. The right-hand sides see the row as it was before the UPDATE.
+        def claim(conn):
+            cur = conn.execute(
+                "UPDATE files SET downloads = downloads + 1, "
+                "downloaded = (downloads + 1 >= max_downloads), "
+                "download_token = CASE WHEN downloads + 1 >= max_downloads "
+                "THEN ? ELSE download_token END, "
+                "expires_at = CASE WHEN downloads + 1 >= max_downloads AND ? IS NOT NULL "
+                "AND (expires_at IS NULL OR ? < expires_at) THEN ? ELSE expires_at END "
+                "WHERE file_id = ? AND downloaded = 0",
+                (download_token, expires_at, expires_at, expires_at, file_id),
+            )
+            if cur.rowcount != 1:
+                return None
+            return self._to_record(conn.execute(
+                self._select_files("WHERE file_id = ?"), (file_id,)).fetchone())
+        return self._transaction(claim)
+
+    def record_delivery(self, file_id, start, end, size):
+        def record(conn):
+            row = conn.execute(
+                "SELECT delivered FROM files WHERE file_id = ?", (file_id,)).fetchone()
+            if row is None:
+                return False
+            delivered = merge_range(parse_ranges(row[0]), start, end)
+            conn.execute("UPDATE files SET delivered = ? WHERE file_id = ?",
+                         (format_ranges(delivered), file_id))
+            return covers(delivered, size)
+        return self._transaction(record)
+
+    def delete(self, file_id):
+        self._conn().execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+
+    def update_path(self, file_id, filepath):
+        self._conn().execute(
+            "UPDATE files SET filepath = ? WHERE file_id = ?", (filepath, file_id))
+
+    def stored_bytes(self, owner):
+        conn = self._conn()
+        files = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM files WHERE owner = ?", (owner,)).fetchone()[0]
+        uploads = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM uploads WHERE owner = ?", (owner,)).fetchone()[0]
+        return files + uploads
+
+    def delete_many(self, file_ids):
+        self._transaction(lambda conn: conn.executemany(
+            "DELETE FROM files WHERE file_id = ?", [(file_id,) for file_id in file_ids]))
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def total_size(self):
+        return self._conn().execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+
+    def expired(self, now, limit):
+        rows = self._conn().execute(
+            self._select_files("WHERE expires_at <= ? ORDER BY expires_at LIMIT ?"),
+            (now, limit),
+        ).fetchall()
+        return [(row[0], self._to_record(row)) for row in rows]
+
+    def iter_files(self, batch_size=1000):
+        # Keyset pagination, so no long-lived read transaction is held open.
+        last = ''
+        while True:
+            rows = self._conn().execute(
+                self._select_files("WHERE file_id > ? ORDER BY file_id LIMIT ?"),
+                (last, batch_size),
+            ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row[0], self._to_record(row)
+            last = rows[-1][0]
+
+    def _to_session(self, conn, row):
+        session = dict(zip(self._upload_names, row))
+        upload_id = session.pop('upload_id')
+        chunks = conn.execute("SELECT chunk, sha256 FROM upload_chunks WHERE upload_id = ? "
+                              "ORDER BY chunk", (upload_id,)).fetchall()
+        session['received'] = [chunk for chunk, _ in chunks]
+        session['digests'] = [sha256 for _, sha256 in chunks]
+        return session
+
+    def create_upload(self, upload_id, session):
+        session = dict(session, upload_id=upload_id)
+        session.setdefault('created_at', time.time())
+        session['max_downloads'] = session.get('max_downloads') or 1
+        self._conn().execute(
+            "INSERT INTO uploads (%s) VALUES (%s)" % (
+                ", ".join(self._upload_names), ", ".join("?" * len(self._upload_names))),
+            [session.get(name) for name in self._upload_names],
+        )
+
+    def get_upload(self, upload_id):
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT %s FROM uploads WHERE upload_id = ?" % ", ".join(self._upload_names),
+            (upload_id,),
+        ).fetchone()
+        return self._to_session(conn, row) if row is not None else None
+
+    def mark_chunk(self, upload_id, chunk, sha256=None):
+        # A retried chunk replaces the data, and so the digest.
+        self._conn().execute(
+            "INSERT OR REPLACE INTO upload_chunks (upload_id, chunk, sha256) VALUES (?, ?, ?)",
+            (upload_id, chunk, sha256),
+        )
+
+    def delete_upload(self, upload_id):
+        def delete(conn):
+            conn.execute("DELETE FROM upload_chunks WHERE upload_id = ?", (upload_id,))
+            conn.execute("DELETE FROM uploads WHERE upload_id = ?", (upload_id,))
+        self._transaction(delete)
+
+    def expired_uploads(self, now, limit):
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT %s FROM uploads WHERE expires_at <= ? ORDER BY expires_at LIMIT ?" % (
+                ", ".join(self._upload_names)),
+            (now, limit),
+        ).fetchall()
+        return [(row[0], self._to_session(conn, row)) for row in rows]
+
+
+def merge_range(ranges, start, end):
+    # Insert [start, end) into a sorted list of disjoint ranges.
+    if start >= end:
+        return list(ranges)
+    merged = []
+    for a, b in sorted(list(ranges) + [(start, end)]):
+        if merged and a <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], b))
+        else:
+            merged.append((a, b))
+    return merged
+
+
+def covers(ranges, size):
+    return size == 0 or (len(ranges) == 1 and ranges[0][0] == 0 and ranges[0][1] >= size)
+
+
+def format_ranges(ranges):
+    return ",".join("%d-%d" % r for r in ranges)
+
+
+def parse_ranges(text):
+    if not text:
+        return []
+    return [tuple(int(n) for n in part.split('-')) for part in text.split(',')]
+
+
+def create_metadata_store(backend, path=None, mmap_size=0, location=None):
+    # location(file_id): the default file path of a share, which the memory
+    # backend then need not store.
+    if backend == 'memory':
+        return MemoryMetadataStore(location)
+    if backend == 'sqlite':
+        return SQLiteMetadataStore(path, mmap_size=mmap_size)
+    raise ValueError("Unknown metadata backend: %r" % (backend,))
@@ -0,0 +1,305 @@
+import bisect
+import fcntl
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+###############################################################################
+# METRICS
+#
+# Counters and histograms rendered in the Prometheus text format at /metrics.
+#
+# Recording takes no lock: every thread updates its own dict of values, and
+# collection sums the dicts of all threads. Each worker process also writes
+# its totals to <directory>/<pid>-<token>.json every flush_interval seconds,
+# and /metrics adds up the files of all workers, so any worker can answer a
+# scrape. The random token keeps a later process that is given the same pid
+# from overwriting an exited worker's totals. Collection folds the files of
+# exited workers into exited.json and deletes them, so counters stay
+# monotonic while the directory stays as small as the number of workers;
+# delete the directory when the app is stopped to reset them.
+#
+# Gauges (pending files, disk usage) are not recorded here; the app computes
+# them at scrape time and passes them to render().
+###############################################################################
+
+# Seconds; suits both millisecond requests and multi-minute transfers.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Totals of exited workers, and the names of the files folded into them.
+EXITED_FILE = 'exited.json'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._local = threading.local()
+        self.directory = None
+        self.flush_interval = 5.0
+        self._pid = None
+        self._file_pid = None
+        self._file = None
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # A forked worker starts from zero; its parent reports its own values.
+        self._lock = threading.Lock()
+        self._threads = []
+        self._local = threading.local()
+
+    def counter(self, name, help):
+        self._metrics[name] = ('counter', help, None)
+        return name
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        self._metrics[name] = ('histogram', help, tuple(buckets))
+        return name
+
+    def _values(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                self._threads.append(values)
+            return values
+
+    def inc(self, name, amount=1, **labels):
+        try:
+            values = self._local.values
+        except AttributeError:
+            values = self._values()
+        key = (name, tuple(labels.items()))
+        values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        # Histogram values are [count per bucket..., count above the last
+        # bucket, sum].
+        try:
+            values = self._local.values
+        except AttributeError:
+            values = self._values()
+        key = (name, tuple(labels.items()))
+        counts = values.get(key)
+        buckets = self._metrics[name][2]
+        if counts is None:
+            counts = values[key] = [0] * (len(buckets) + 2)
+        counts[bisect.bisect_left(buckets, value)] += 1
+        counts[-1] += value
+
+    def snapshot(self):
+        # {(name, labels): value} summed over this process's threads.
+        with self._lock:
+            threads = list(self._threads)
+        totals = {}
+        for values in threads:
+            for key, value in list(values.items()):
+                _add(totals, key, list(value) if isinstance(value, list) else value)
+        return totals
+
+    def configure(self, directory, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        # Start this process's flush thread; safe to call on every request.
+        if self.directory is None or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name='metrics-flush', daemon=True).start()
+
+    def _run(self):
+        stop = threading.Event()
+        while not stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Writing metrics failed")
+
+    def _own_file(self):
+        # Name of this process's file, new in every process.
+        if self._file_pid != os.getpid():
+            self._file_pid = os.getpid()
+            self._file = '%d-%s.json' % (self._file_pid, os.urandom(4).hex())
+        return self._file
+
+    def flush(self):
+        path = os.path.join(self.directory, self._own_file())
+        _write(path, [[name, list(labels), value]
+                      for (name, labels), value in self.snapshot().items()])
+
+    def collect(self):
+        # Totals over every worker: this process live, the others from their
+        # last flush, and the exited ones from exited.json.
+        totals = self.snapshot()
+        if self.directory is None:
+            return totals
+        own = self._own_file()
+        with open(os.path.join(self.directory, 'fold.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            exited = self._fold_exited(own)
+            _add_all(totals, exited['values'])
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json') or name in (own, EXITED_FILE) \
+                        or name in exited['files']:
+                    continue
+                _add_all(totals, _read(os.path.join(self.directory, name)) or [])
+        return totals
+
+    def _fold_exited(self, own):
+        # Add the files of workers that have exited to exited.json, then
+        # delete them. Returns its contents. Takes the caller's fold lock. The
+        # folded names are recorded before the files are deleted, so a crash
+        # in between cannot count them twice.
+        path = os.path.join(self.directory, EXITED_FILE)
+        exited = _read(path) or {'files': [], 'values': []}
+        names = [name for name in os.listdir(self.directory)
+                 if name.endswith('.json') and name not in (own, EXITED_FILE)]
+        dead = [name for name in names
+                if name not in exited['files'] and not _alive(_file_pid(name))]
+        if dead:
+            totals = {}
+            _add_all(totals, exited['values'])
+            for name in dead:
+                _add_all(totals, _read(os.path.join(self.directory, name)) or [])
+            exited = {
+                'files': [name for name in exited['files'] if name in names] + dead,
+                'values': [[name, list(labels), value]
+                           for (name, labels), value in totals.items()],
+            }
+            _write(path, exited)
+        for name in exited['files']:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+        return exited
+
+    def render(self, gauges=()):
+        # Prometheus text format. `gauges` is a list of (name, help, value).
+        by_name = {}
+        for (name, labels), value in self.collect().items():
+            by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for name, (kind, help, buckets) in sorted(self._metrics.items()):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in sorted(by_name.get(name, ())):
+                if kind == 'counter':
+                    lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), value):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else _number(bound)
+                    lines.append('%s_bucket%s %d' % (name, _labels(labels + (('le', le),)),
+                                                     cumulative))
+                lines.append('%s_sum%s %s' % (name, _labels(labels), _number(value[-1])))
+                lines.append('%s_count%s %d' % (name, _labels(labels), cumulative))
+        for name, help, value in gauges:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %s' % (name, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _read(path):
+    # A metrics file's contents, or None if it is missing or half-written.
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+def _file_pid(name):
+    # The pid in a worker's file name; older versions wrote <pid>.json.
+    try:
+        return int(name[:-len('.json')].split('-')[0])
+    except ValueError:
+        return None
+
+
+def _alive(pid):
+    # Unknown names are left alone.
+    if pid is None:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _add_all(totals, data):
+    for metric, labels, value in data:
+        _add(totals, (metric, tuple(tuple(label) for label in labels)), value)
+
+
+def _add(totals, key, value):
+    current = totals.get(key)
+    if current is None:
+        totals[key] = value
+    elif isinstance(current, list):
+        for i, v in enumerate(value):
+            current[i] += v
+    else:
+        totals[key] = current + value
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in labels)
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+
+REQUEST_DURATION = registry.histogram(
+    'secure_share_request_duration_seconds',
+    'Time to produce the response headers, per route.')
+REQUESTS = registry.counter(
+    'secure_share_requests_total', 'Requests per route and status code.')
+RECEIVED_BYTES = registry.counter(
+    'secure_share_received_bytes_total', 'Request body bytes, per route.')
+SENT_BYTES = registry.counter(
+    'secure_share_sent_bytes_total', 'Response body bytes (Content-Length), per route.')
+STORAGE_WRITE_DURATION = registry.histogram(
+    'secure_share_storage_write_seconds', 'Time to store an uploaded file.')
+RENDER_DURATION = registry.histogram(
+    'secure_share_template_render_seconds', 'Time to render the download page.')
+CLAIM_CONFLICTS = registry.counter(
+    'secure_share_claim_conflicts_total',
+    'Requests for a file that another client had already claimed.')
+HANDOFFS = registry.counter(
+    'secure_share_handoffs_total',
+    'Requests for shares on another node, redirected or proxied there.')
+EXPIRED = registry.counter(
+    'secure_share_expired_total', 'Expired shares and upload sessions removed by the reaper.')
+PASSWORD_CHECKS = registry.counter(
+    'secure_share_password_checks_total',
+    'Share password checks, by result (ok, wrong, busy: rejected with 503).')
+UPLOAD_ADMISSIONS = registry.counter(
+    'secure_share_upload_admissions_total',
+    'Upload admission decisions (admitted, queued: made to wait, rejected: 503); see '
+    'admission.py.')
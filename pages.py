@@ -0,0 +1,114 @@
+import gzip
+import hashlib
+import os
+
+try:
+    import brotli
+except ImportError:  # Optional: only gzip variants are produced without it.
+    brotli = None
+
+###############################################################################
+# PRE-RENDERED PAGES
+#
+# Pages that are the same for every visitor are rendered once, encoded to
+# bytes and compressed once per encoding. Serving one is then a dict lookup
+# plus an ETag check; nothing is parsed, rendered or compressed per request.
+#
+# The pages' stylesheet and scripts are StaticAssets: the same, served under
+# a name containing a hash of their content (site.3f2a9c01b4d7.css). A new
+# version gets a new URL, so browsers may cache them for a year without
+# asking again. write_assets() stores the variants as files, for a front
+# proxy that serves precompressed files itself (nginx gzip_static).
+###############################################################################
+
+# A year; the most that caches are expected to honour.
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+_ETAG_SUFFIXES = {'identity': '', 'gzip': '-gz', 'br': '-br'}
+
+
+# Smallest first: br, then gzip, then identity.
+ENCODINGS = ('br', 'gzip', 'identity') if brotli is not None else ('gzip', 'identity')
+
+
+def _compress(body, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(body, 9, mtime=0)
+    return brotli.compress(body, quality=11)
+
+
+class StaticPage:
+    # Compressed variants are made the first time one is asked for (or all
+    # at once by compress()), not when the page is created.
+
+    def __init__(self, html, cache_control='public, max-age=300', mimetype='text/html'):
+        body = html.encode('utf-8')
+        self.digest = hashlib.sha256(body).hexdigest()[:32]
+        self.cache_control = cache_control
+        self.mimetype = mimetype
+        # encoding -> (body, etag). Each encoding needs its own strong ETag.
+        self._variants = {'identity': (body, self.digest)}
+
+    def variant(self, encoding):
+        # Made at most a few times over if threads race; they are identical.
+        variant = self._variants.get(encoding)
+        if variant is None:
+            body = _compress(self._variants['identity'][0], encoding)
+            variant = self._variants[encoding] = (body, self.digest + _ETAG_SUFFIXES[encoding])
+        return variant
+
+    def compress(self):
+        for encoding in ENCODINGS:
+            self.variant(encoding)
+
+    @property
+    def variants(self):
+        self.compress()
+        return self._variants
+
+    def encoding_for(self, request):
+        return request.accept_encodings.best_match(ENCODINGS) or 'identity'
+
+    def response(self, request, response_class):
+        encoding = self.encoding_for(request)
+        body, etag = self.variant(encoding)
+        response = response_class(body, mimetype=self.mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = self.cache_control
+        response.set_etag(etag)
+        return response.make_conditional(request)
+
+
+def html_response(request, response_class, html):
+    # A page rendered per request; gzipped (at a fast level, it is a few KB)
+    # when the client accepts it.
+    body = html.encode('utf-8')
+    response = response_class(mimetype='text/html')
+    if request.accept_encodings.best_match(('gzip', 'identity')) == 'gzip':
+        body = gzip.compress(body, 6, mtime=0)
+        response.headers['Content-Encoding'] = 'gzip'
+    response.set_data(body)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+class StaticAsset(StaticPage):
+    def __init__(self, name, text, mimetype):
+        super().__init__(text, IMMUTABLE, mimetype)
+        stem, ext = os.path.splitext(name)
+        self.source = name
+        self.name = '%s.%s%s' % (stem, self.digest[:12], ext)
+
+
+_SUFFIXES = {'identity': '', 'gzip': '.gz', 'br': '.br'}
+
+
+def write_assets(assets, folder):
+    # Write each asset as <name>, <name>.gz and (with brotli) <name>.br.
+    os.makedirs(folder, exist_ok=True)
+    for asset in assets:
+        for encoding, (body, _) in asset.variants.items():
+            with open(os.path.join(folder, asset.name + _SUFFIXES[encoding]), 'wb') as f:
+                f.write(body)
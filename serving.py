@@ -0,0 +1,121 @@
+import io
+
+###############################################################################
+# FILE SERVING HELPERS
+#
+# How /file/<file_id> hands ciphertext to the client is configurable
+# (FILE_SERVE_MODE):
+#
+#   'sendfile'          Give the open file to the server's wsgi.file_wrapper.
+#                       gunicorn serves it with os.sendfile(), so the body
+#                       never passes through Python. Default.
+#   'stream'            Plain Python read/write loop. Works with any WSGI
+#                       server; mostly useful as a baseline.
+#   'x-accel-redirect'  Return an empty response with X-Accel-Redirect and
+#                       let nginx stream the file from an internal location.
+#   'x-sendfile'        Same with X-Sendfile (Apache mod_xsendfile, lighttpd).
+#
+# A download is one-time, but not one-request: the request that claims a
+# share gets a download token (a cookie) and may come back with it for Range
+# requests, to resume a dropped transfer or fetch ranges in parallel. A
+# share may allow several downloads; each claim gets its own token, and
+# until the last claim the file stays where it is. The share is deleted once
+# every claim is done, i.e. responses covering every byte have been sent in
+# full to its client or the client acknowledged it (DELETE
+# /file/<file_id>), or once a grace period after the last claim has passed,
+# whichever comes first.
+#
+# Local files count a delivery once the server has taken the whole range
+# (RangeFile), whether it read the file (stream mode, ASGI) or passed it to
+# sendfile(); remote storage bodies are counted by DeliveryTracker. In the
+# offload modes the proxy does the sending (and the Range handling), so there
+# only the acknowledgement and the grace period apply. A response cut off
+# halfway never counts: bytes accepted by the socket may still be lost.
+###############################################################################
+
+SERVE_MODES = ('sendfile', 'stream', 'x-accel-redirect', 'x-sendfile')
+OFFLOAD_MODES = ('x-accel-redirect', 'x-sendfile')
+
+
+class RangeFile(io.FileIO):
+    # Bytes [start, end) of a file. Still a real file object, so
+    # wsgi.file_wrapper/sendfile remain usable; the server is told the length
+    # through Content-Length.
+    #
+    # on_complete(start, end), if given, is called on close once the server
+    # has taken the whole range: a server that iterates the body reads past
+    # the end only after writing the last chunk, and socket.sendfile() (which
+    # gunicorn uses) seeks the file to the end of what it sent, whether it
+    # finished or failed, before gunicorn rewinds it with os.lseek().
+
+    def __init__(self, path, start, end, on_complete=None):
+        super().__init__(path, 'rb')
+        self.start = start
+        self.end = end
+        self.complete = False
+        self._on_complete = on_complete
+        self.seek(start)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        position = super().seek(offset, whence)
+        if position >= self.end:
+            self.complete = True
+        return position
+
+    def close(self):
+        on_complete, self._on_complete = self._on_complete, None
+        super().close()
+        if on_complete is not None and self.complete:
+            on_complete(self.start, self.end)
+
+    def _limit(self, size):
+        remaining = max(0, self.end - self.tell())
+        if size is None or size < 0 or size > remaining:
+            return remaining
+        return size
+
+    def read(self, size=-1):
+        size = self._limit(size)
+        if not size:
+            self.complete = self.complete or self.tell() >= self.end
+            return b''
+        return super().read(size)
+
+    def readinto(self, b):
+        size = self._limit(len(b))
+        if not size:
+            self.complete = self.complete or self.tell() >= self.end
+            return 0
+        return super().readinto(memoryview(b)[:size])
+
+
+class DeliveryTracker:
+    # Wraps a response body (an iterable of chunks, optionally with close())
+    # for bytes [start, end) and calls on_complete(start, end) on close if the
+    # server wrote all of it.
+
+    def __init__(self, body, start, end, on_complete):
+        self._body = body
+        self.start = start
+        self.end = end
+        self.complete = False
+        self._on_complete = on_complete
+        self.closed = False
+
+    def __iter__(self):
+        sent = 0
+        for chunk in self._body:
+            yield chunk
+            # The server only asks for more once this chunk was written.
+            sent += len(chunk)
+        self.complete = sent == self.end - self.start
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        close = getattr(self._body, 'close', None)
+        if close is not None:
+            close()
+        if self.complete:
+            self._on_complete(self.start, self.end)
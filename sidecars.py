@@ -0,0 +1,296 @@
+import base64
+import concurrent.futures
+import fcntl
+import json
+import logging
+import marshal
+import os
+
+from filenames import parse_encrypted_filename
+from storage import blob_path, iter_blobs
+
+logger = logging.getLogger(__name__)
+
+###############################################################################
+# SIDECAR RECORDS AND INDEX RECOVERY
+#
+# Next to the metadata store, every share has a small sidecar file in the
+# uploads tree (same fan-out as the blobs, see storage.py):
+#
+#   uploads/30/85/3085d8bf-799a-4013-a092-386aca250471.meta
+#
+# holding the record as JSON, with bytes fields base64-encoded. It is
+# written when the share is created and when it is claimed, and removed
+# with the record. A sidecar is written to a temporary file, fsynced,
+# renamed into place and its directory fsynced; with local storage the blob
+# is fsynced first, so a sidecar never points at data that a crash could
+# lose.
+#
+# The metadata store is the index. SQLite already persists it (its WAL is
+# the journal, checkpoints compact it into the database file), so normally
+# nothing is rebuilt. Sidecars are for when the index is gone: the database
+# was lost or corrupted and recreated empty, or the memory backend is in
+# use. rebuild_index() then scans the sidecars with a thread pool, one task
+# per top-level directory of the tree, and bulk-inserts the records.
+#
+# A rescan opens every sidecar, most of a minute at a million shares. So
+# an index that lives only in memory is saved when the process exits
+# cleanly, as one snapshot file of the same records (save_snapshot()), and
+# the next start loads that instead of scanning. Loading removes the
+# snapshot: writes after it go only to the sidecars, and a process that
+# dies without saving leaves no snapshot, so a stale one is never read and
+# the slow path remains the recovery path. Snapshots are marshalled, which
+# also decodes faster than the JSON sidecars.
+#
+# Sidecars of claimed shares record the claims, so a rebuilt index never
+# offers a downloaded file again. Download tokens are signed rather than
+# stored (see access.py), so downloads in progress can still be resumed;
+# only tokens of claims made by older versions are lost.
+###############################################################################
+
+SIDECAR_SUFFIX = '.meta'
+SIDECAR_VERSION = 1
+SNAPSHOT_MAGIC = b'secure-share index snapshot 1\n'
+# Record fields kept in sidecars; bytes fields are base64-encoded.
+_FIELDS = ('filepath', 'downloaded', 'created_at', 'expires_at', 'size', 'owner',
+           'downloads', 'max_downloads', 'password_hash', 'sha256_chunk_size')
+_BYTES_FIELDS = ('encrypted_filename', 'sha256', 'manifest')
+
+
+def _fsync_path(path, flags=os.O_RDONLY):
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def encode_sidecar(record):
+    data = {'version': SIDECAR_VERSION}
+    for name in _FIELDS:
+        data[name] = record.get(name)
+    for name in _BYTES_FIELDS:
+        value = record.get(name)
+        if isinstance(value, str):
+            # Legacy hex filename (see filenames.py).
+            value = parse_encrypted_filename(value)
+        data[name] = base64.b64encode(value).decode('ascii') if value is not None else None
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def decode_sidecar(raw):
+    data = json.loads(raw)
+    if data.get('version') != SIDECAR_VERSION:
+        raise ValueError("Unsupported sidecar version %r" % (data.get('version'),))
+    record = {name: data.get(name) for name in _FIELDS}
+    record['downloaded'] = bool(record['downloaded'])
+    # Sidecars written before shares allowed several downloads.
+    record['max_downloads'] = record['max_downloads'] or 1
+    if record['downloads'] is None:
+        record['downloads'] = 1 if record['downloaded'] else 0
+    for name in _BYTES_FIELDS:
+        value = data.get(name)
+        record[name] = base64.b64decode(value) if value is not None else None
+    return record
+
+
+class Sidecars:
+    def __init__(self, folder, fanout=(), sync_blobs=True):
+        self.folder = folder
+        self.fanout = fanout
+        # fsync the blob (a local file) before its sidecar is written.
+        self.sync_blobs = sync_blobs
+
+    def path(self, file_id, create=False):
+        return blob_path(self.folder, file_id, self.fanout, SIDECAR_SUFFIX, create=create)
+
+    def write(self, file_id, record):
+        path = self.path(file_id, create=True)
+        if self.sync_blobs:
+            try:
+                _fsync_path(record['filepath'])
+            except FileNotFoundError:
+                pass
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(encode_sidecar(record))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        _fsync_path(os.path.dirname(path) or '.')
+
+    def rewrite(self, file_id, load):
+        # Write the record returned by load() (if not None) while holding a
+        # lock on the sidecar's directory. Concurrent updates of one share
+        # (several claims at once) then take turns, and each writes the
+        # record as it is after every earlier update.
+        fd = os.open(os.path.dirname(self.path(file_id, create=True)) or '.', os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            record = load()
+            if record is not None:
+                self.write(file_id, record)
+        finally:
+            os.close(fd)
+
+    def delete(self, file_id):
+        try:
+            os.remove(self.path(file_id))
+        except FileNotFoundError:
+            pass
+
+    def _load_tree(self, top, recursive, blob_exists):
+        # [(file_id, record)] for the sidecars under `top`; stale ones (their
+        # blob is gone) are removed.
+        if recursive:
+            entries = iter_blobs(top)
+        else:
+            with os.scandir(top) as scan:
+                entries = [entry for entry in scan if entry.is_file()]
+        records = []
+        for entry in entries:
+            if not entry.name.endswith(SIDECAR_SUFFIX):
+                continue
+            file_id = entry.name[:-len(SIDECAR_SUFFIX)]
+            try:
+                with open(entry.path, 'rb') as f:
+                    record = decode_sidecar(f.read())
+            except FileNotFoundError:
+                continue
+            except ValueError:
+                logger.warning("Skipping unreadable sidecar %s", entry.path)
+                continue
+            if blob_exists is not None and not blob_exists(record):
+                self.delete(file_id)
+                continue
+            records.append((file_id, record))
+        return records
+
+    def scan(self, workers=8, blob_exists=None):
+        # Yield lists of (file_id, record) for every sidecar, reading the
+        # top-level directories in parallel. blob_exists(record), if given,
+        # filters out (and deletes) sidecars whose blob is gone.
+        with os.scandir(self.folder) as scan:
+            tops = [entry.path for entry in scan if entry.is_dir(follow_symlinks=False)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self._load_tree, self.folder, False, blob_exists)]
+            futures += [pool.submit(self._load_tree, top, True, blob_exists) for top in tops]
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+
+
+class SidecarMetadataStore:
+    # A metadata store that keeps sidecars in step with the records: add()
+    # and claim() write one, delete() and delete_many() remove it. Every
+    # other call goes straight to the wrapped store.
+
+    def __init__(self, store, sidecars):
+        self.store = store
+        self.sidecars = sidecars
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def add(self, file_id, record):
+        self.sidecars.write(file_id, record)
+        self.store.add(file_id, record)
+
+    def claim(self, file_id, download_token=None, expires_at=None):
+        record = self.store.claim(file_id, download_token, expires_at)
+        if record is not None:
+            self.sidecars.rewrite(file_id, lambda: self.store.get(file_id))
+        return record
+
+    def update_path(self, file_id, filepath):
+        self.store.update_path(file_id, filepath)
+        self.sidecars.rewrite(file_id, lambda: self.store.get(file_id))
+
+    def delete(self, file_id):
+        self.store.delete(file_id)
+        self.sidecars.delete(file_id)
+
+    def delete_many(self, file_ids):
+        self.store.delete_many(file_ids)
+        for file_id in file_ids:
+            self.sidecars.delete(file_id)
+
+
+def save_snapshot(store, path, batch_size=1000):
+    # Write every record of `store` to `path`, as the fields a sidecar holds:
+    # a header line, then marshalled lists of up to `batch_size` (file_id,
+    # record) pairs, then None. Returns the number saved.
+    tmp = path + '.tmp'
+    saved = 0
+    with open(tmp, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        batch = []
+        for file_id, record in store.iter_files():
+            record = {name: record.get(name) for name in _FIELDS + _BYTES_FIELDS}
+            if isinstance(record['encrypted_filename'], str):
+                record['encrypted_filename'] = parse_encrypted_filename(
+                    record['encrypted_filename'])
+            batch.append((file_id, record))
+            if len(batch) == batch_size:
+                marshal.dump(batch, f)
+                saved += len(batch)
+                batch = []
+        marshal.dump(batch, f)
+        marshal.dump(None, f)
+        saved += len(batch)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_path(os.path.dirname(path) or '.')
+    return saved
+
+
+def load_snapshot(path):
+    # The (file_id, record) pairs of the snapshot at `path`, which is
+    # removed, or None if there is none (or it is unreadable). Unlike scan(),
+    # blobs are not checked: one deleted while the app was stopped leaves a
+    # record for the reaper's reconciliation to remove.
+    records = []
+    try:
+        with open(path, 'rb') as f:
+            os.remove(path)
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise ValueError("not a snapshot")
+            while True:
+                batch = marshal.load(f)
+                if batch is None:
+                    return records
+                records += batch
+    except FileNotFoundError:
+        return None
+    except (EOFError, ValueError, TypeError):
+        logger.warning("Ignoring unreadable index snapshot %s", path)
+        return None
+
+
+def rebuild_index(store, sidecars, lock_path, workers=8, blob_exists=None, force=False,
+                  snapshot=None):
+    # Restore the records of `store` from sidecars if it is empty (or, with
+    # force, add any that are missing), from the snapshot file at `snapshot`
+    # if there is one (see save_snapshot()). Workers starting together take
+    # turns on the lock, so only the first one does the work. Returns the
+    # number of records restored.
+    with open(lock_path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not force and store.count():
+            return 0
+        if not force and snapshot is not None:
+            records = load_snapshot(snapshot)
+            if records is not None:
+                store.add_many(records)
+                logger.info("Restored %d records from %s", len(records), snapshot)
+                return len(records)
+        restored = 0
+        for records in sidecars.scan(workers, blob_exists):
+            if force:
+                records = [(file_id, record) for file_id, record in records
+                           if store.get(file_id) is None]
+            store.add_many(records)
+            restored += len(records)
+        if restored:
+            logger.info("Restored %d records from sidecars", restored)
+        return restored
@@ -0,0 +1,416 @@
+import hashlib
+import os
+
+###############################################################################
+# BLOB STORAGE
+#
+# Ciphertext is kept in a BlobStorage backend. Every blob has a *location*,
+# an opaque string produced by location() and stored as the metadata
+# record's 'filepath': a filesystem path for LocalStorage, an object key for
+# S3Storage. Backends stream in both directions; nothing buffers a whole file.
+#
+#   put(location, stream, size)   store `size` bytes read from `stream`
+#   put_file(location, path)      move a staged local file into storage
+#   get(location, start, end)     BlobStream over bytes [start, end)
+#   delete(location)              remove (missing blobs are ignored)
+#   exists(location)
+#   size(location)                length in bytes (FileNotFoundError if missing)
+#   iter_blobs()                  (name, location, mtime) for reconciliation
+#
+# LocalStorage additionally exposes real paths (is_local), which lets the
+# download path claim files by rename and serve them with sendfile or a
+# proxy offload header.
+###############################################################################
+
+
+class BlobStream:
+    # Iterable of byte chunks with a known length. on_close runs once, when
+    # the WSGI server closes the response body (or the caller closes it).
+
+    def __init__(self, chunks, length, close=None):
+        self._chunks = chunks
+        self.length = length
+        self._close = close
+        self._on_close = []
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def call_on_close(self, func):
+        self._on_close.append(func)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._close is not None:
+            self._close()
+        for func in self._on_close:
+            func()
+
+
+class BlobStorage:
+    is_local = False
+
+    def location(self, file_id, create=True):
+        # Where the blob of `file_id` is stored; with create, ready to be
+        # written.
+        raise NotImplementedError
+
+    def put(self, location, stream, size):
+        raise NotImplementedError
+
+    def put_file(self, location, path):
+        raise NotImplementedError
+
+    def get(self, location, start=0, end=None):
+        raise NotImplementedError
+
+    def delete(self, location):
+        raise NotImplementedError
+
+    def exists(self, location):
+        raise NotImplementedError
+
+    def size(self, location):
+        raise NotImplementedError
+
+    def iter_blobs(self):
+        raise NotImplementedError
+
+
+def read_exact(stream, size):
+    # Read `size` bytes, or fewer only if the stream ends first.
+    data = stream.read(size)
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def copy_stream(stream, dest, length, buffer_size=64 * 1024):
+    # Copy up to `length` bytes from `stream` into an open file using one
+    # fixed-size buffer, so memory use does not depend on the body size.
+    # Returns the number of bytes copied.
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    readinto = getattr(stream, 'readinto', None)
+    remaining = length
+    while remaining:
+        want = min(buffer_size, remaining)
+        if readinto is not None:
+            n = readinto(view[:want])
+            data = view[:n] if n else None
+        else:
+            data = stream.read(want)
+            n = len(data)
+        if not n:
+            break
+        dest.write(data)
+        remaining -= n
+    return length - remaining
+
+
+class DigestReader:
+    # Wraps a stream and hashes (SHA-256) and counts every byte read through
+    # it, so a body can be stored and accounted for in a single pass.
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._hash = hashlib.sha256()
+        self.bytes_read = 0
+
+    def read(self, n=-1):
+        data = self._stream.read(n)
+        self._hash.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, b):
+        readinto = getattr(self._stream, 'readinto', None)
+        if readinto is None:
+            data = self._stream.read(len(b))
+            n = len(data)
+            b[:n] = data
+        else:
+            n = readinto(b) or 0
+        self._hash.update(memoryview(b)[:n])
+        self.bytes_read += n
+        return n
+
+    def digest(self):
+        return self._hash.digest()
+
+
+class ConcatReader:
+    # Reads several streams one after another as a single stream.
+
+    def __init__(self, streams):
+        self._streams = list(streams)
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            data = b''.join(stream.read() for stream in self._streams)
+            self._streams = []
+            return data
+        while self._streams:
+            data = self._streams[0].read(n)
+            if data:
+                return data
+            self._streams.pop(0)
+        return b''
+
+
+def _read_chunks(f, start, length, buffer_size):
+    try:
+        f.seek(start)
+        remaining = length
+        while remaining:
+            data = f.read(min(buffer_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+class LocalStorage(BlobStorage):
+    is_local = True
+
+    def __init__(self, folder, fanout=(), buffer_size=64 * 1024):
+        self.folder = folder
+        self.fanout = fanout
+        self.buffer_size = buffer_size
+
+    def location(self, file_id, create=True):
+        return blob_path(self.folder, file_id, self.fanout, '.enc', create=create)
+
+    def put(self, location, stream, size):
+        with open(location, 'wb') as f:
+            return copy_stream(stream, f, size, self.buffer_size)
+
+    def put_file(self, location, path):
+        os.replace(path, location)
+
+    def get(self, location, start=0, end=None):
+        f = open(location, 'rb')
+        if end is None:
+            end = os.fstat(f.fileno()).st_size
+        length = max(0, end - start)
+        chunks = _read_chunks(f, start, length, self.buffer_size)
+        return BlobStream(chunks, length, close=lambda: (chunks.close(), f.close()))
+
+    def delete(self, location):
+        try:
+            os.remove(location)
+        except FileNotFoundError:
+            pass
+
+    def exists(self, location):
+        return os.path.exists(location)
+
+    def size(self, location):
+        return os.path.getsize(location)
+
+    def iter_blobs(self):
+        for entry in iter_blobs(self.folder):
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            yield entry.name, entry.path, mtime
+
+
+class S3Storage(BlobStorage):
+    # Any S3-compatible object store (AWS, MinIO, Ceph, ...). Needs the
+    # optional boto3 package, unless given a client with the same interface
+    # (e.g. a stub in tests). Uploads at or above multipart_threshold are sent
+    # as a multipart upload with up to max_concurrency parts in flight;
+    # downloads stream the object body in buffer_size pieces.
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, multipart_threshold=16 * 1024 * 1024,
+                 part_size=8 * 1024 * 1024, max_concurrency=8, buffer_size=64 * 1024,
+                 client=None):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError:
+            if client is None:
+                raise RuntimeError("The S3 storage backend requires the 'boto3' package")
+            boto3 = None
+        self.bucket = bucket
+        self.prefix = prefix
+        self.buffer_size = buffer_size
+        self.client = client or boto3.client('s3', endpoint_url=endpoint_url)
+        # None: the client's own defaults.
+        self.transfer_config = None
+        if boto3 is not None:
+            self.transfer_config = TransferConfig(
+                multipart_threshold=multipart_threshold,
+                multipart_chunksize=part_size,
+                max_concurrency=max_concurrency,
+            )
+
+    def location(self, file_id, create=True):
+        return self.prefix + file_id + '.enc'
+
+    def put(self, location, stream, size):
+        self.client.upload_fileobj(_LimitedReader(stream, size), self.bucket, location,
+                                   Config=self.transfer_config)
+        return size
+
+    def put_file(self, location, path):
+        self.client.upload_file(path, self.bucket, location, Config=self.transfer_config)
+        os.remove(path)
+
+    def get(self, location, start=0, end=None):
+        kwargs = {}
+        if start or end is not None:
+            kwargs['Range'] = 'bytes=%d-%s' % (start, '' if end is None else end - 1)
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=location, **kwargs)
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(location)
+        body = response['Body']
+        return BlobStream(body.iter_chunks(self.buffer_size), response['ContentLength'],
+                          close=body.close)
+
+    def delete(self, location):
+        self.client.delete_object(Bucket=self.bucket, Key=location)
+
+    def _head(self, location):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=location)
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                raise FileNotFoundError(location)
+            raise
+
+    def exists(self, location):
+        try:
+            self._head(location)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def size(self, location):
+        return self._head(location)['ContentLength']
+
+    def iter_blobs(self):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get('Contents', ()):
+                key = obj['Key']
+                yield key.rsplit('/', 1)[-1], key, obj['LastModified'].timestamp()
+
+
+class _LimitedReader:
+    # Read at most `size` bytes from a stream, so a request body is never
+    # read past its declared length.
+
+    def __init__(self, stream, size):
+        self._stream = stream
+        self._remaining = size
+
+    def read(self, n=-1):
+        if n is None or n < 0 or n > self._remaining:
+            n = self._remaining
+        data = self._stream.read(n) if n else b''
+        self._remaining -= len(data)
+        return data
+
+
+def create_storage(backend, **options):
+    if backend == 'local':
+        return LocalStorage(options['folder'], options.get('fanout', ()),
+                            options.get('buffer_size', 64 * 1024))
+    if backend == 's3':
+        return S3Storage(
+            options['bucket'],
+            prefix=options.get('prefix', ''),
+            endpoint_url=options.get('endpoint_url'),
+            multipart_threshold=options.get('multipart_threshold', 16 * 1024 * 1024),
+            part_size=options.get('part_size', 8 * 1024 * 1024),
+            max_concurrency=options.get('max_concurrency', 8),
+            buffer_size=options.get('buffer_size', 64 * 1024),
+        )
+    raise ValueError("Unknown storage backend: %r" % (backend,))
+
+
+###############################################################################
+# ON-DISK LAYOUT
+#
+# Ciphertext files live under the uploads folder in a fan-out tree derived
+# from the file id, e.g. with fanout (2, 2):
+#
+#   uploads/30/85/3085d8bf-799a-4013-a092-386aca250471.enc
+#
+# so no single directory grows to millions of entries. An empty fanout keeps
+# the original flat layout. Metadata records store the full path, so files
+# written under an older layout stay reachable after the setting changes;
+# migrate_flat_layout() moves them into the tree.
+###############################################################################
+
+
+def parse_fanout(value):
+    # "2,2" -> (2, 2); "" -> () (flat).
+    if not value:
+        return ()
+    fanout = tuple(int(part) for part in value.split(','))
+    if any(width <= 0 for width in fanout):
+        raise ValueError("Invalid upload fanout: %r" % (value,))
+    return fanout
+
+
+def shard_dir(folder, file_id, fanout):
+    key = file_id.replace('-', '')
+    parts = [folder]
+    start = 0
+    for width in fanout:
+        parts.append(key[start:start + width])
+        start += width
+    return os.path.join(*parts)
+
+
+def blob_path(folder, file_id, fanout, suffix, create=False):
+    directory = shard_dir(folder, file_id, fanout)
+    if create and fanout:
+        os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, file_id + suffix)
+
+
+def iter_blobs(folder):
+    # Yield a DirEntry for every file below `folder`, at any depth.
+    stack = [folder]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    yield entry
+
+
+def migrate_flat_layout(store, folder, fanout, suffix='.enc'):
+    # Move flat `<id><suffix>` files into the fan-out tree and point their
+    # metadata at the new location. Run it while the app is stopped. Returns
+    # the number of files moved.
+    moved = 0
+    with os.scandir(folder) as entries:
+        names = [entry.name for entry in entries
+                 if entry.is_file() and entry.name.endswith(suffix)]
+    for name in names:
+        file_id = name[:-len(suffix)]
+        new_path = blob_path(folder, file_id, fanout, suffix, create=True)
+        old_path = os.path.join(folder, name)
+        if new_path == old_path:
+            continue
+        os.rename(old_path, new_path)
+        if store.get(file_id) is not None:
+            store.update_path(file_id, new_path)
+        moved += 1
+    return moved
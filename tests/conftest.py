@@ -0,0 +1,37 @@
+import io
+import re
+
+import pytest
+
+import app as secure_share
+
+
+@pytest.fixture
+def client(tmp_path):
+    flask_app = secure_share.create_app({
+        # The databases and metrics go in the uploads folder too.
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        # Only bodies that pass through Python count deliveries.
+        'FILE_SERVE_MODE': 'stream',
+        'COPY_BUFFER_SIZE': 4096,
+        # Hash share passwords in the test's own thread.
+        'PASSWORD_PROCESSES': 0,
+    })
+    return flask_app.test_client()
+
+
+@pytest.fixture
+def upload(client):
+    # Upload `blob` as a share and return its id.
+    def upload(blob, max_downloads=1, password=None):
+        data = {
+            'encrypted_filename': 'AQ' + 'A' * 40,
+            'max_downloads': str(max_downloads),
+            'file': (io.BytesIO(blob), 'blob'),
+        }
+        if password is not None:
+            data['password'] = password
+        response = client.post('/upload', data=data)
+        assert response.status_code == 200
+        return re.search(r'/download/([0-9a-z-]+)', response.get_data(as_text=True)).group(1)
+    return upload
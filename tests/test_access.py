@@ -0,0 +1,69 @@
+import os
+import time
+
+import pytest
+
+import container
+from access import (PasswordHasher, PasswordHasherBusy, access_token, check_access_token,
+                    download_claim, download_token)
+
+SECRET = b'0' * 32
+FILE_ID = '3085d8bf-799a-4013-a092-386aca250471'
+MALFORMED = ['', '.', '1.', '.abc', '1.\xe9', '\xe9.abc', '\xb2.abc', '1.a.b', '1.a b', '-1.abc',
+             '1.abc\n']
+
+
+@pytest.mark.parametrize('token', MALFORMED)
+def test_malformed_tokens_are_rejected(token):
+    assert download_claim(SECRET, FILE_ID, token) is None
+    assert not check_access_token(SECRET, FILE_ID, token)
+
+
+def test_tokens_round_trip():
+    assert download_claim(SECRET, FILE_ID, download_token(SECRET, FILE_ID, 3)) == 3
+    assert download_claim(SECRET, FILE_ID[::-1], download_token(SECRET, FILE_ID, 3)) is None
+    assert check_access_token(SECRET, FILE_ID, access_token(SECRET, FILE_ID, 60))
+    assert not check_access_token(SECRET, FILE_ID, access_token(SECRET, FILE_ID, -1))
+
+
+@pytest.mark.parametrize('token', ['1.\xe9', '\xb2.abc', '1.a.b'])
+def test_malformed_download_cookie(client, upload, token):
+    file_id = upload(container.encrypt(os.urandom(32), os.urandom(64 * 1024)))
+    # Another client claims the only download and is still receiving it.
+    response = client.application.test_client().get('/file/' + file_id, buffered=False)
+    assert response.status_code == 200
+    response.close()
+    # A made-up token does not get the file.
+    client.set_cookie('download_token', token)
+    assert client.get('/file/' + file_id).status_code == 404
+    assert client.delete('/file/' + file_id).status_code == 404
+
+
+@pytest.mark.parametrize('token', ['99999999999.\xe9', '\xb2.abc', '99999999999.a.b'])
+def test_malformed_access_cookie(client, upload, token):
+    file_id = upload(container.encrypt(os.urandom(32), os.urandom(1024)), password='secret')
+    client.set_cookie('share_access', token)
+    assert client.get('/file/' + file_id).status_code == 403
+
+
+def test_password_hasher_holds_slot_until_kdf_finishes():
+    hasher = PasswordHasher(processes=1, queue=0, timeout=0.01, n=2 ** 15)
+    try:
+        # The caller gives up, but the KDF keeps its process busy...
+        with pytest.raises(PasswordHasherBusy):
+            hasher.hash('first')
+        # ...so another one is not let in behind it, however long it would wait.
+        hasher.timeout = 60
+        with pytest.raises(PasswordHasherBusy):
+            hasher.hash('second')
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                encoded = hasher.hash('third')
+                break
+            except PasswordHasherBusy:
+                assert time.monotonic() < deadline
+                time.sleep(0.05)
+        assert hasher.verify('third', encoded)
+    finally:
+        hasher.close()
@@ -0,0 +1,121 @@
+import collections
+import io
+
+import pytest
+
+import admission
+import app as secure_share
+from admission import AdmissionController, MemoryLedger, Rejected, SQLiteLedger
+
+MB = 1024 * 1024
+TOTAL = 1000 * MB
+USED = 500 * MB
+SOFT = USED + 50 * MB
+HARD = USED + 200 * MB
+
+DiskUsage = collections.namedtuple('DiskUsage', 'total used free')
+
+
+@pytest.fixture(autouse=True)
+def disk(monkeypatch):
+    # Every folder is on a disk of TOTAL bytes with USED in use.
+    monkeypatch.setattr(admission.shutil, 'disk_usage',
+                        lambda folder: DiskUsage(TOTAL, USED, TOTAL - USED))
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def ledger(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryLedger()
+    return SQLiteLedger(str(tmp_path / 'admission.db'))
+
+
+@pytest.fixture
+def uploads(ledger, tmp_path):
+    # One upload at a time above the soft watermark.
+    return AdmissionController(ledger, str(tmp_path), SOFT, HARD, overload_concurrency=1,
+                               retry_after=17, temp_folder=str(tmp_path))
+
+
+def test_below_soft_watermark_is_admitted(uploads, ledger):
+    first = uploads.admit('a', 20 * MB)
+    second = uploads.admit('a', 20 * MB)
+    assert uploads.in_flight() == (2, 40 * MB)
+    first.release()
+    second.release()
+    second.release()
+    assert ledger.totals() == (0, 0, 0)
+
+
+def test_over_hard_watermark_is_rejected(uploads, ledger):
+    held = uploads.admit('a', 20 * MB)
+    with pytest.raises(Rejected, match="full") as rejected:
+        uploads.attempt('b', 190 * MB).poll()
+    assert rejected.value.retry_after == 17
+    held.release()
+    assert ledger.totals() == (0, 0, 0)
+
+
+def test_clients_take_turns_above_soft_watermark(uploads, ledger):
+    held = uploads.admit('blocker', 20 * MB)
+    # a queues three uploads before b and c queue one each.
+    attempts = [uploads.attempt(client, 60 * MB) for client in 'aaabc']
+    assert [attempt.poll() for attempt in attempts] == [None] * 5
+    held.release()
+    order = []
+    while attempts:
+        admitted = [(attempt, result) for attempt in attempts
+                    for result in [attempt.poll()] if result is not None]
+        assert len(admitted) == 1
+        attempt, result = admitted[0]
+        assert uploads.in_flight() == (1, 60 * MB)
+        order.append(attempt.client)
+        attempts.remove(attempt)
+        result.release()
+    assert order == ['a', 'b', 'c', 'a', 'a']
+    assert ledger.totals() == (0, 0, 0)
+
+
+def test_full_queue_is_rejected(uploads, ledger):
+    uploads.queue_size = 3
+    held = uploads.admit('blocker', 20 * MB)
+    attempts = [uploads.attempt(client, 60 * MB) for client in 'abc']
+    assert [attempt.poll() for attempt in attempts] == [None] * 3
+    with pytest.raises(Rejected, match="Too many uploads waiting") as rejected:
+        uploads.attempt('d', 60 * MB).poll()
+    assert rejected.value.retry_after == 17
+    for attempt in attempts:
+        attempt.cancel()
+    held.release()
+    assert ledger.totals() == (0, 0, 0)
+    # Cancelled attempts gave their places up.
+    uploads.admit('d', 60 * MB).release()
+    assert ledger.totals() == (0, 0, 0)
+
+
+def test_queue_timeout_is_rejected(uploads, ledger):
+    uploads.queue_timeout = 0
+    held = uploads.admit('blocker', 20 * MB)
+    with pytest.raises(Rejected, match="busy") as rejected:
+        uploads.admit('a', 60 * MB)
+    assert rejected.value.retry_after == 17
+    held.release()
+    assert ledger.totals() == (0, 0, 0)
+
+
+def test_upload_over_hard_watermark_gets_503(tmp_path):
+    flask_app = secure_share.create_app({
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        # Full already: any upload is over the hard watermark.
+        'UPLOAD_SOFT_WATERMARK': USED - MB,
+        'UPLOAD_HARD_WATERMARK': USED,
+        'ADMISSION_RETRY_AFTER': 17,
+        'PASSWORD_PROCESSES': 0,
+    })
+    response = flask_app.test_client().post('/upload', data={
+        'encrypted_filename': 'AQ' + 'A' * 40,
+        'file': (io.BytesIO(b'x' * 1024), 'blob'),
+    })
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '17'
+    assert secure_share.upload_admission.ledger.totals() == (0, 0, 0)
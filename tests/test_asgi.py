@@ -0,0 +1,72 @@
+import asyncio
+import os
+
+import pytest
+
+import app as secure_share
+import container
+from asgi import ASGIApplication
+
+
+@pytest.fixture
+def client(tmp_path):
+    # The default serve mode: under ASGI it falls back to a read loop.
+    flask_app = secure_share.create_app({
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'FILE_SERVE_MODE': 'sendfile',
+        'COPY_BUFFER_SIZE': 4096,
+        'PASSWORD_PROCESSES': 0,
+    })
+    return flask_app.test_client()
+
+
+def download(flask_app, file_id, disconnect_after=None):
+    # GET /file/<file_id> through the ASGI application. The client goes
+    # away after `disconnect_after` body messages, if given. Returns the
+    # status and the body received.
+    application = ASGIApplication(flask_app)
+    scope = {'type': 'http', 'method': 'GET', 'path': '/file/' + file_id,
+             'query_string': b'', 'headers': [(b'host', b'localhost')],
+             'client': ('127.0.0.1', 1234)}
+    messages = []
+
+    async def run():
+        gone = asyncio.Event()
+        requested = []
+
+        async def receive():
+            if not requested:
+                requested.append(True)
+                return {'type': 'http.request', 'body': b''}
+            await gone.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+            bodies = [m for m in messages if m['type'] == 'http.response.body']
+            if disconnect_after is not None and len(bodies) >= disconnect_after:
+                gone.set()
+
+        await application(scope, receive, send)
+
+    asyncio.run(run())
+    status = messages[0]['status']
+    return status, b''.join(m.get('body', b'') for m in messages[1:])
+
+
+def test_sendfile_mode_download_is_delivered(client, upload):
+    blob = container.encrypt(os.urandom(32), os.urandom(256 * 1024))
+    file_id = upload(blob)
+    assert download(client.application, file_id) == (200, blob)
+    assert secure_share.metadata_store.get(file_id) is None
+
+
+def test_disconnect_is_not_delivered(client, upload):
+    blob = container.encrypt(os.urandom(32), os.urandom(256 * 1024))
+    file_id = upload(blob)
+    status, received = download(client.application, file_id, disconnect_after=1)
+    assert status == 200
+    assert 0 < len(received) < len(blob)
+    # Claimed, but kept for the claimant to resume.
+    file_info = secure_share.metadata_store.get(file_id)
+    assert file_info is not None and file_info['downloaded']
@@ -0,0 +1,92 @@
+import multiprocessing
+import os
+import threading
+
+import app as secure_share
+import container
+from metadata import MemoryMetadataStore, SQLiteMetadataStore
+
+CLIENTS = 8
+
+
+def test_concurrent_downloads_claim_each_download_once(client, upload):
+    blob = container.encrypt(os.urandom(32), os.urandom(256 * 1024))
+    file_id = upload(blob, max_downloads=3)
+    clients = [client.application.test_client() for _ in range(CLIENTS)]
+    start = threading.Barrier(CLIENTS)
+    results = [None] * CLIENTS
+
+    def download(i):
+        start.wait()
+        with clients[i].get('/file/' + file_id) as response:
+            results[i] = (response.status_code, response.data)
+
+    threads = [threading.Thread(target=download, args=(i,)) for i in range(CLIENTS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    statuses = sorted(status for status, _ in results)
+    assert statuses == [200] * 3 + [404] * (CLIENTS - 3)
+    assert all(data == blob for status, data in results if status == 200)
+    # Each winner had the whole file, so the share is gone.
+    assert secure_share.metadata_store.get(file_id) is None
+
+
+def add_share(store, file_id, max_downloads):
+    store.add(file_id, {
+        'encrypted_filename': b'name',
+        'filepath': '/nonexistent/' + file_id,
+        'size': 10,
+        'max_downloads': max_downloads,
+    })
+
+
+def claim_in_process(path, file_id, start, results):
+    store = SQLiteMetadataStore(path)
+    start.wait()
+    record = store.claim(file_id, expires_at=1.0)
+    results.put(None if record is None else record['downloads'])
+
+
+def test_sqlite_claims_across_processes(tmp_path):
+    # Every gunicorn worker opens the database itself.
+    path = str(tmp_path / 'metadata.db')
+    add_share(SQLiteMetadataStore(path), 'share', 3)
+    context = multiprocessing.get_context('fork')
+    start = context.Barrier(CLIENTS)
+    results = context.Queue()
+    processes = [context.Process(target=claim_in_process, args=(path, 'share', start, results))
+                 for _ in range(CLIENTS)]
+    for process in processes:
+        process.start()
+    claims = [results.get(timeout=30) for _ in processes]
+    for process in processes:
+        process.join()
+
+    assert sorted(claim for claim in claims if claim is not None) == [1, 2, 3]
+    record = SQLiteMetadataStore(path).get('share')
+    assert record['downloaded'] and record['downloads'] == 3
+    assert record['expires_at'] == 1.0
+
+
+def test_memory_claims_across_threads():
+    store = MemoryMetadataStore()
+    file_id = '00000000-0000-4000-8000-000000000000'
+    add_share(store, file_id, 3)
+    start = threading.Barrier(CLIENTS)
+    claims = []
+
+    def claim():
+        start.wait()
+        record = store.claim(file_id)
+        if record is not None:
+            claims.append(record['downloads'])
+
+    threads = [threading.Thread(target=claim) for _ in range(CLIENTS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claims) == [1, 2, 3]
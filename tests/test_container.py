@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+import container
+from container import HEADER_SIZE, MIN_SEGMENT_SIZE, TAG_SIZE, ContainerError
+
+SEGMENT = MIN_SEGMENT_SIZE + TAG_SIZE
+
+
+@pytest.fixture
+def key():
+    return os.urandom(32)
+
+
+@pytest.fixture
+def plaintext():
+    # Three full segments and a short last one.
+    return os.urandom(3 * MIN_SEGMENT_SIZE + 100)
+
+
+def encrypt(key, plaintext):
+    return container.encrypt(key, plaintext, MIN_SEGMENT_SIZE)
+
+
+def segments(data):
+    return [data[start:start + SEGMENT] for start in range(HEADER_SIZE, len(data), SEGMENT)]
+
+
+@pytest.mark.parametrize('size', [0, 1, MIN_SEGMENT_SIZE, 3 * MIN_SEGMENT_SIZE + 100])
+def test_round_trip(key, size):
+    plaintext = os.urandom(size)
+    data = encrypt(key, plaintext)
+    assert len(data) == container.ciphertext_size(size, MIN_SEGMENT_SIZE)
+    container.validate_container(data[:HEADER_SIZE], len(data))
+    assert container.decrypt(key, data) == plaintext
+
+
+@pytest.mark.parametrize('offset', [8, HEADER_SIZE - 6, HEADER_SIZE, HEADER_SIZE + SEGMENT + 7,
+                                    -1])
+def test_flipped_byte_fails(key, plaintext, offset):
+    data = bytearray(encrypt(key, plaintext))
+    data[offset] ^= 1
+    with pytest.raises(ContainerError):
+        container.decrypt(key, bytes(data))
+
+
+def test_truncated_segment_fails(key, plaintext):
+    data = encrypt(key, plaintext)
+    with pytest.raises(ContainerError, match="truncated"):
+        container.decrypt(key, data[:-1])
+    without_last = data[:-(100 + TAG_SIZE)]
+    with pytest.raises(ContainerError, match="truncated"):
+        container.decrypt(key, without_last)
+    # A header rewritten for the shorter plaintext does not help: it is
+    # authenticated, and the segment now last is not marked as the last.
+    header = bytearray(data[:HEADER_SIZE])
+    header[12:20] = (3 * MIN_SEGMENT_SIZE).to_bytes(8, 'big')
+    with pytest.raises(ContainerError, match="authentication"):
+        container.decrypt(key, bytes(header) + without_last[HEADER_SIZE:])
+
+
+def test_reordered_segments_fail(key, plaintext):
+    data = encrypt(key, plaintext)
+    first, second, *rest = segments(data)
+    with pytest.raises(ContainerError, match="Segment 0 failed authentication"):
+        container.decrypt(key, data[:HEADER_SIZE] + second + first + b''.join(rest))
+
+
+def test_trailing_data_fails(key, plaintext):
+    with pytest.raises(ContainerError, match="Trailing data"):
+        container.decrypt(key, encrypt(key, plaintext) + b'\0')
+
+
+def test_wrong_key_fails(key, plaintext):
+    data = encrypt(key, plaintext)
+    with pytest.raises(ContainerError, match="Segment 0 failed authentication"):
+        container.decrypt(os.urandom(32), data)
+
+
+@pytest.mark.parametrize('change, message', [
+    (lambda header: b'NOPE' + header[4:], "Not an encrypted container"),
+    (lambda header: header[:4] + b'\x02' + header[5:], "Unsupported container version"),
+    (lambda header: header[:5] + b'\x01' + header[6:], "Reserved header bytes"),
+    (lambda header: header[:8] + (1024).to_bytes(4, 'big') + header[12:], "Invalid segment size"),
+])
+def test_invalid_header_is_rejected(key, plaintext, change, message):
+    header = encrypt(key, plaintext)[:HEADER_SIZE]
+    with pytest.raises(ContainerError, match=message):
+        container.parse_header(change(header))
+
+
+def test_size_must_match_header(key, plaintext):
+    data = encrypt(key, plaintext)
+    with pytest.raises(ContainerError, match="should be"):
+        container.validate_container(data[:HEADER_SIZE], len(data) - 1)
+    with pytest.raises(ContainerError, match="Truncated"):
+        container.validate_container(data[:HEADER_SIZE - 1], len(data))
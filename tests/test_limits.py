@@ -0,0 +1,53 @@
+import random
+
+import pytest
+
+import app as secure_share
+from limits import MemoryRateLimiter, SQLiteRateLimiter
+
+
+def test_sqlite_decides_like_memory(tmp_path):
+    memory = MemoryRateLimiter()
+    sqlite = SQLiteRateLimiter(str(tmp_path / 'limits.db'))
+    random.seed(1)
+    now = 1000.0
+    for _ in range(2000):
+        now += random.choice((0, 0.01, 0.1, 1, 30))
+        key = random.choice('abc')
+        amount = random.choice((1, 1, 1, 5, 60))
+        assert sqlite.take(key, amount, 2, 50, now) == \
+            pytest.approx(memory.take(key, amount, 2, 50, now))
+
+
+def test_sweep_drops_least_recently_used(tmp_path):
+    limiter = SQLiteRateLimiter(str(tmp_path / 'limits.db'), max_entries=2)
+    for n, key in enumerate('abc'):
+        limiter.take(key, 1, 0.001, 1, 1000.0 + n)
+    limiter.sweep()
+    # 'a' is forgotten, so it has a full bucket again.
+    assert limiter.take('a', 1, 0.001, 1, 1003.0) == 0
+    assert limiter.take('c', 1, 0.001, 1, 1003.0) > 0
+
+
+@pytest.fixture
+def limited(tmp_path):
+    flask_app = secure_share.create_app({
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'REQUESTS_PER_SECOND': 1,
+        'REQUEST_BURST': 2,
+        'PASSWORD_PROCESSES': 0,
+    })
+    return flask_app.test_client()
+
+
+@pytest.mark.parametrize('method, path', [
+    ('GET', '/upload/missing'),
+    ('PUT', '/upload/missing/chunk/0'),
+    ('POST', '/upload/missing/finish'),
+    ('DELETE', '/file/missing'),
+])
+def test_upload_and_acknowledge_are_rate_limited(limited, method, path):
+    statuses = [limited.open(path, method=method).status_code for _ in range(3)]
+    assert statuses == [404, 404, 429]
+    response = limited.open(path, method=method)
+    assert response.status_code == 429 and int(response.headers['Retry-After']) >= 1
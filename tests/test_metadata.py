@@ -0,0 +1,71 @@
+import uuid
+
+import pytest
+
+from metadata import MemoryMetadataStore, SQLiteMetadataStore
+
+
+def location(file_id):
+    return '/uploads/%s/%s.enc' % (file_id[:2], file_id)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryMetadataStore(location)
+    return SQLiteMetadataStore(str(tmp_path / 'metadata.db'))
+
+
+def add(store, owner, size, filepath=None):
+    file_id = str(uuid.uuid4())
+    store.add(file_id, {
+        'encrypted_filename': b'\x01name',
+        'filepath': filepath or location(file_id),
+        'downloaded': False,
+        'created_at': 1000.0,
+        'expires_at': 2000.0,
+        'size': size,
+        'owner': owner,
+        'max_downloads': 1,
+    })
+    return file_id
+
+
+def test_file_paths(store):
+    file_id = add(store, 'alice', 10)
+    assert store.get(file_id)['filepath'] == location(file_id)
+    moved = add(store, 'alice', 10, filepath='/old/flat.enc')
+    assert store.get(moved)['filepath'] == '/old/flat.enc'
+    store.update_path(moved, location(moved))
+    store.update_path(file_id, '/elsewhere.enc')
+    assert store.get(moved)['filepath'] == location(moved)
+    assert store.get(file_id)['filepath'] == '/elsewhere.enc'
+    assert dict(store.iter_files())[file_id]['filepath'] == '/elsewhere.enc'
+
+
+def test_owners_and_stored_bytes(store):
+    first = add(store, 'alice', 10)
+    second = add(store, 'alice', 20)
+    other = add(store, 'bob', 5)
+    anonymous = add(store, None, 7)
+    assert store.stored_bytes('alice') == 30 and store.stored_bytes('bob') == 5
+    assert store.get(first)['owner'] == 'alice' and store.get(anonymous)['owner'] is None
+    store.delete(first)
+    assert store.stored_bytes('alice') == 20
+    # Replacing a record moves its bytes to the new owner.
+    store.add(second, dict(store.get(second), owner='carol', size=25))
+    assert store.stored_bytes('alice') == 0 and store.stored_bytes('carol') == 25
+    store.delete_many([second, other])
+    assert store.stored_bytes('bob') == 0 and store.stored_bytes('carol') == 0
+    # An owner left without records gives its number up to the next one.
+    dave = add(store, 'dave', 3)
+    assert store.get(dave)['owner'] == 'dave' and store.stored_bytes('dave') == 3
+    assert store.count() == 2
+
+
+def test_claimed_record_keeps_its_fields(store):
+    file_id = add(store, 'alice', 10)
+    record = store.claim(file_id, download_token='token')
+    assert record['downloaded'] and record['owner'] == 'alice'
+    assert record['filepath'] == location(file_id)
+    assert store.stored_bytes('alice') == 10
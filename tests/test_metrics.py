@@ -0,0 +1,6 @@
+def test_non_ascii_digit_content_length_is_not_counted(client):
+    # '²' passes str.isdigit() but not int().
+    response = client.get('/help', environ_overrides={'CONTENT_LENGTH': '²'})
+    assert response.status_code == 200
+    metrics = client.get('/metrics').get_data(as_text=True)
+    assert 'secure_share_received_bytes_total{endpoint="help"' not in metrics
@@ -0,0 +1,60 @@
+import os
+
+import app as secure_share
+import container
+
+
+def test_dropped_download_resumes_with_range(client, upload):
+    blob = container.encrypt(os.urandom(32), os.urandom(256 * 1024))
+    file_id = upload(blob)
+
+    # The connection drops after the first chunks.
+    response = client.get('/file/' + file_id, buffered=False)
+    assert response.status_code == 200
+    body = iter(response.response)
+    received = next(body) + next(body)
+    response.close()
+    assert 0 < len(received) < len(blob)
+
+    # The share is not used up: the claimant resumes with its download token.
+    response = client.get('/file/' + file_id, headers={'Range': 'bytes=%d-' % len(received)})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes %d-%d/%d' % (
+        len(received), len(blob) - 1, len(blob))
+    assert received + response.data == blob
+
+    # A cut-off response never counts as delivered, so the file stays until
+    # the client acknowledges the download (or the grace period ends).
+    assert secure_share.metadata_store.get(file_id) is not None
+    assert client.delete('/file/' + file_id).status_code == 204
+    assert secure_share.metadata_store.get(file_id) is None
+    assert client.get('/file/' + file_id).status_code == 404
+
+
+def test_earlier_download_resumes_after_the_last(client, upload):
+    blob = container.encrypt(os.urandom(32), os.urandom(256 * 1024))
+    file_id = upload(blob, max_downloads=3)
+    first, *others = [client.application.test_client() for _ in range(3)]
+
+    # The first download drops; the other two finish in the meantime.
+    response = first.get('/file/' + file_id, buffered=False)
+    body = iter(response.response)
+    received = next(body) + next(body)
+    response.close()
+    for other in others:
+        with other.get('/file/' + file_id) as response:
+            assert response.status_code == 200
+            assert response.data == blob
+
+    # The first claimant can still resume, and fetch the part it lost.
+    with first.get('/file/' + file_id,
+                   headers={'Range': 'bytes=%d-' % len(received)}) as response:
+        assert response.status_code == 206
+        assert received + response.data == blob
+    assert secure_share.metadata_store.get(file_id) is not None
+    with first.get('/file/' + file_id,
+                   headers={'Range': 'bytes=0-%d' % (len(received) - 1)}) as response:
+        assert response.data == received
+
+    # Every download has now had the whole file.
+    assert secure_share.metadata_store.get(file_id) is None
@@ -0,0 +1,86 @@
+import os
+import socket
+import threading
+
+import pytest
+
+from serving import RangeFile
+
+SIZE = 4 * 1024 * 1024
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = tmp_path / 'blob'
+    path.write_bytes(os.urandom(SIZE))
+    return str(path)
+
+
+def open_range(path, start, end, delivered):
+    return RangeFile(path, start, end, lambda start, end: delivered.append((start, end)))
+
+
+def test_read_to_the_end_is_delivered(path):
+    delivered = []
+    range_file = open_range(path, 100, 5000, delivered)
+    while range_file.read(1024):
+        pass
+    range_file.close()
+    assert delivered == [(100, 5000)]
+
+
+def test_last_chunk_read_but_not_asked_past_is_not_delivered(path):
+    # A server reads past the end only after writing the last chunk.
+    delivered = []
+    range_file = open_range(path, 0, 2048, delivered)
+    assert len(range_file.read(1024) + range_file.read(1024)) == 2048
+    range_file.close()
+    assert delivered == []
+
+
+def sendfile_like_gunicorn(range_file, sock):
+    # gunicorn's Response.sendfile(): send from the current offset, then
+    # rewind with os.lseek().
+    offset = os.lseek(range_file.fileno(), 0, os.SEEK_CUR)
+    sock.sendfile(range_file, offset=offset, count=range_file.end - offset)
+    os.lseek(range_file.fileno(), offset, os.SEEK_SET)
+
+
+def test_sendfile_is_delivered(path):
+    delivered = []
+    range_file = open_range(path, 10, SIZE, delivered)
+    sender, receiver = socket.socketpair()
+    received = []
+    reader = threading.Thread(target=lambda: received.append(receiver.makefile('rb').read()))
+    reader.start()
+    with sender:
+        sendfile_like_gunicorn(range_file, sender)
+    reader.join()
+    receiver.close()
+    range_file.close()
+    assert len(received[0]) == SIZE - 10
+    assert delivered == [(10, SIZE)]
+
+
+def test_sendfile_cut_off_is_not_delivered(path):
+    # The client goes away after part of the file.
+    delivered = []
+    range_file = open_range(path, 0, SIZE, delivered)
+    sender, receiver = socket.socketpair()
+    sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16384)
+    sender.settimeout(10)
+
+    def read_some():
+        received = 0
+        while received < 65536:
+            received += len(receiver.recv(65536))
+        receiver.close()
+
+    reader = threading.Thread(target=read_some)
+    reader.start()
+    with pytest.raises(OSError):
+        sendfile_like_gunicorn(range_file, sender)
+    reader.join()
+    sender.close()
+    range_file.close()
+    assert delivered == []
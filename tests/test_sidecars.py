@@ -0,0 +1,65 @@
+import io
+import os
+import time
+
+import app as secure_share
+import container
+from sidecars import save_snapshot
+
+
+def memory_app(folder):
+    return secure_share.create_app({
+        'UPLOAD_FOLDER': folder,
+        'METADATA_BACKEND': 'memory',
+        'PASSWORD_PROCESSES': 0,
+    })
+
+
+def test_memory_index_is_rebuilt_from_sidecars(tmp_path, upload):
+    blob = container.encrypt(os.urandom(32), os.urandom(1000))
+    file_ids = [upload(blob) for _ in range(3)]
+    memory_app(str(tmp_path / 'uploads'))
+    assert secure_share.metadata_store.count() == 3
+    assert secure_share.metadata_store.get(file_ids[0])['size'] == len(blob)
+
+
+def test_memory_index_starts_from_its_snapshot(tmp_path):
+    folder = str(tmp_path / 'uploads')
+    client = memory_app(folder).test_client()
+    blob = container.encrypt(os.urandom(32), os.urandom(1000))
+    for _ in range(3):
+        response = client.post('/upload', data={'encrypted_filename': 'AQ' + 'A' * 40,
+                                                'file': (io.BytesIO(blob), 'blob')})
+        assert response.status_code == 200
+    records = dict(secure_share.metadata_store.iter_files())
+    snapshot = os.path.join(folder, 'index.snapshot')
+    assert save_snapshot(secure_share.metadata_store.store, snapshot) == 3
+
+    # A share whose sidecar is gone is still in the snapshot. One whose blob
+    # is gone is restored, and removed by the reaper's reconciliation.
+    file_ids = sorted(records)
+    secure_share.sidecars.delete(file_ids[0])
+    os.remove(records[file_ids[1]]['filepath'])
+    memory_app(folder)
+    assert not os.path.exists(snapshot)
+    assert sorted(file_id for file_id, _ in secure_share.metadata_store.iter_files()) == file_ids
+    assert secure_share.metadata_store.get(file_ids[2])['sha256'] == records[file_ids[2]]['sha256']
+    # Past the grace period of new records.
+    secure_share.reaper.reconcile(time.time() + 86400)
+    assert secure_share.metadata_store.get(file_ids[1]) is None
+
+    # Loaded once: the next start rescans the sidecars, and so loses the
+    # share whose sidecar was deleted.
+    memory_app(folder)
+    assert [file_id for file_id, _ in secure_share.metadata_store.iter_files()] == [file_ids[2]]
+
+
+def test_unreadable_snapshot_falls_back_to_sidecars(tmp_path, upload):
+    blob = container.encrypt(os.urandom(32), os.urandom(1000))
+    file_id = upload(blob)
+    folder = str(tmp_path / 'uploads')
+    with open(os.path.join(folder, 'index.snapshot'), 'wb') as f:
+        f.write(b'garbage')
+    memory_app(folder)
+    assert secure_share.metadata_store.get(file_id) is not None
+    assert not os.path.exists(os.path.join(folder, 'index.snapshot'))
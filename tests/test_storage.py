@@ -0,0 +1,174 @@
+import datetime
+import io
+import os
+import re
+import types
+
+import pytest
+
+import app as secure_share
+import container
+from storage import S3Storage
+
+
+class ClientError(Exception):
+    def __init__(self, response, operation_name):
+        super().__init__(operation_name)
+        self.response = response
+
+
+class NoSuchKey(ClientError):
+    pass
+
+
+class StubBody:
+    def __init__(self, data):
+        self._data = data
+        self.closed = False
+
+    def iter_chunks(self, chunk_size):
+        for start in range(0, len(self._data), chunk_size):
+            yield self._data[start:start + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class StubS3Client:
+    # The calls S3Storage makes on a boto3 S3 client, on a dict of objects.
+    exceptions = types.SimpleNamespace(ClientError=ClientError, NoSuchKey=NoSuchKey)
+
+    def __init__(self):
+        self.objects = {}
+        self.bodies = []
+
+    def _object(self, bucket, key, operation):
+        try:
+            return self.objects[bucket, key]
+        except KeyError:
+            raise NoSuchKey({'Error': {'Code': 'NoSuchKey'}}, operation)
+
+    def upload_fileobj(self, fileobj, bucket, key, Config=None):
+        data = b''
+        while True:
+            chunk = fileobj.read(1000)
+            if not chunk:
+                break
+            data += chunk
+        self.objects[bucket, key] = data
+
+    def upload_file(self, path, bucket, key, Config=None):
+        with open(path, 'rb') as f:
+            self.objects[bucket, key] = f.read()
+
+    def get_object(self, Bucket, Key, Range=None):
+        data = self._object(Bucket, Key, 'GetObject')
+        if Range is not None:
+            start, end = re.fullmatch(r'bytes=(\d+)-(\d*)', Range).groups()
+            data = data[int(start):int(end) + 1 if end else None]
+        body = StubBody(data)
+        self.bodies.append(body)
+        return {'Body': body, 'ContentLength': len(data)}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return {'ContentLength': len(self.objects[Bucket, Key])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def get_paginator(self, name):
+        assert name == 'list_objects_v2'
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                modified = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+                yield {'Contents': [{'Key': key, 'LastModified': modified}
+                                    for bucket, key in sorted(client.objects)
+                                    if bucket == Bucket and key.startswith(Prefix)]}
+        return Paginator()
+
+
+@pytest.fixture
+def s3():
+    return StubS3Client()
+
+
+@pytest.fixture
+def storage(s3):
+    return S3Storage('bucket', prefix='shares/', buffer_size=1000, client=s3)
+
+
+def test_put_and_get(storage, s3):
+    location = storage.location('abc')
+    assert location == 'shares/abc.enc'
+    data = os.urandom(5000)
+    # Only the declared size is read from the stream.
+    assert storage.put(location, io.BytesIO(data + b'more'), len(data)) == len(data)
+    assert s3.objects['bucket', location] == data
+    assert storage.exists(location) and storage.size(location) == len(data)
+    body = storage.get(location)
+    assert b''.join(body) == data
+    body.close()
+    assert s3.bodies[-1].closed
+    assert list(storage.iter_blobs())[0][:2] == ('abc.enc', location)
+
+
+def test_get_range(storage):
+    data = os.urandom(5000)
+    storage.put('key', io.BytesIO(data), len(data))
+    assert b''.join(storage.get('key', 100, 2500)) == data[100:2500]
+    assert b''.join(storage.get('key', 4000)) == data[4000:]
+
+
+def test_put_file_removes_the_local_file(storage, s3, tmp_path):
+    path = tmp_path / 'part'
+    path.write_bytes(b'data')
+    storage.put_file('key', str(path))
+    assert s3.objects['bucket', 'key'] == b'data' and not path.exists()
+
+
+def test_missing_and_deleted_objects(storage):
+    storage.put('key', io.BytesIO(b'data'), 4)
+    storage.delete('key')
+    assert not storage.exists('key')
+    with pytest.raises(FileNotFoundError):
+        storage.get('key')
+    with pytest.raises(FileNotFoundError):
+        storage.size('key')
+
+
+@pytest.fixture
+def s3_client(client, s3):
+    # The app with its storage swapped for S3Storage on the stub.
+    secure_share.storage = S3Storage('bucket', buffer_size=4096, client=s3)
+    return client
+
+
+def test_download_from_s3_is_delivered(s3_client, s3, upload):
+    blob = container.encrypt(os.urandom(32), os.urandom(64 * 1024))
+    file_id = upload(blob)
+    assert list(s3.objects) == [('bucket', file_id + '.enc')]
+
+    # A download cut off halfway is not delivered.
+    response = s3_client.get('/file/' + file_id, buffered=False)
+    received = next(iter(response.response))
+    response.close()
+    assert s3.bodies[-1].closed
+    assert secure_share.metadata_store.get(file_id) is not None
+
+    # Resumed with a range, the rest is delivered; the cut-off part was not.
+    with s3_client.get('/file/' + file_id,
+                       headers={'Range': 'bytes=%d-' % len(received)}) as response:
+        assert response.status_code == 206
+        assert received + response.data == blob
+    assert secure_share.metadata_store.get(file_id) is not None
+
+    # Once every byte has been delivered, the object goes.
+    with s3_client.get('/file/' + file_id,
+                       headers={'Range': 'bytes=0-%d' % (len(received) - 1)}) as response:
+        assert response.data == received
+    assert secure_share.metadata_store.get(file_id) is None
+    assert not s3.objects
@@ -0,0 +1,57 @@
+import base64
+import hashlib
+import os
+import re
+
+import pytest
+
+import app as secure_share
+import container
+
+CHUNK_SIZE = 64 * 1024
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def client(tmp_path, request):
+    flask_app = secure_share.create_app({
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'METADATA_BACKEND': request.param,
+        'FILE_SERVE_MODE': 'stream',
+        'UPLOAD_CHUNK_SIZE': CHUNK_SIZE,
+        'PASSWORD_PROCESSES': 0,
+    })
+    return flask_app.test_client()
+
+
+def b64(digest):
+    return base64.b64encode(digest).decode('ascii')
+
+
+def test_form_upload_records_file_digest(client, upload):
+    blob = container.encrypt(os.urandom(32), os.urandom(200 * 1024))
+    file_id = upload(blob)
+    response = client.get('/file/' + file_id)
+    assert response.data == blob
+    assert response.headers['Repr-Digest'] == 'sha-256=:%s:' % b64(hashlib.sha256(blob).digest())
+
+
+def test_chunked_upload_digest_covers_chunks_in_order(client):
+    blob = container.encrypt(os.urandom(32), os.urandom(200 * 1024))
+    session = client.post('/upload/start', data={
+        'encrypted_filename': 'AQ' + 'A' * 40, 'size': str(len(blob))}).get_json()
+    chunks = [blob[n:n + CHUNK_SIZE] for n in range(0, len(blob), CHUNK_SIZE)]
+    assert session['chunks'] == len(chunks) == 4
+    # Out of order, with chunk 2 sent twice.
+    for n in (3, 1, 2, 0, 2):
+        url = '/upload/%s/chunk/%d' % (session['upload_id'], n)
+        assert client.put(url, data=chunks[n]).status_code == 204
+    response = client.post('/upload/%s/finish' % session['upload_id'])
+    assert response.status_code == 200
+    file_id = re.search(r'/download/([0-9a-z-]+)', response.get_data(as_text=True)).group(1)
+
+    response = client.get('/file/' + file_id)
+    assert response.data == blob
+    expected = hashlib.sha256(b''.join(hashlib.sha256(chunk).digest() for chunk in chunks))
+    assert 'Repr-Digest' not in response.headers
+    assert response.headers['Chunked-Digest'] == 'sha-256=:%s:; chunk-size=%d' % (
+        b64(expected.digest()), CHUNK_SIZE)